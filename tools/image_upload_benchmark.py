@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#   Copyright 2020 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+"""Benchmark the python image uploader against in-process fake registries
+
+Synthetic images are served by a fake source registry and uploaded with
+ImageUploadManager, to a fake push registry or to a temporary image-serve
+export directory. For example, to compare the transfer engines on a slow
+source:
+
+    python tools/image_upload_benchmark.py --images 50 --latency 0.05 \\
+        --bandwidth 20000000 --transfer-engine shared
+"""
+
+import argparse
+import json
+import logging
+import sys
+
+from tripleo_common.image import image_uploader
+from tripleo_common.tests.image import fake_registry
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark image uploads against fake registries',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--target', choices=('push', 'export', 'both'),
+                        default='both',
+                        help='Upload to a push registry, an export '
+                             'directory, or run both')
+    parser.add_argument('--images', type=int, default=20,
+                        help='Number of images to upload')
+    parser.add_argument('--layers', type=int, default=6,
+                        help='Number of layers per image')
+    parser.add_argument('--shared-layers', type=int, default=4,
+                        help='Number of layers every image has in common')
+    parser.add_argument('--layer-size', type=int, default=4 * 1024 * 1024,
+                        help='Size of every layer in bytes')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every source request')
+    parser.add_argument('--bandwidth', type=int, default=None,
+                        help='Bytes per second per source request')
+    parser.add_argument('--auth', action='store_true',
+                        help='Require bearer tokens on both registries')
+    parser.add_argument('--rate-limit-every', type=int, default=0,
+                        help='Answer every Nth source request with a 429')
+    parser.add_argument('--retry-after', type=int, default=0,
+                        help='Retry-After seconds sent with a 429')
+    parser.add_argument('--transfer-engine',
+                        choices=image_uploader.TRANSFER_ENGINES,
+                        default=image_uploader.TRANSFER_ENGINE_POOL,
+                        help='Uploader transfer engine')
+    parser.add_argument('--destinations', type=int, default=1,
+                        help='Number of push registries every image is '
+                             'uploaded to')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the reports as JSON')
+    parser.add_argument('--debug', action='store_true',
+                        help='Enable debug logging of the uploader')
+    return parser.parse_args(sys.argv[1:])
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.WARNING)
+    if args.shared_layers > args.layers:
+        sys.exit('--shared-layers cannot be more than --layers')
+    targets = ('push', 'export') if args.target == 'both' else (args.target,)
+    source_options = {
+        'auth': args.auth,
+        'latency': args.latency,
+        'bandwidth': args.bandwidth,
+        'rate_limit_every': args.rate_limit_every,
+        'retry_after': args.retry_after,
+    }
+    reports = []
+    for target in targets:
+        reports.append(fake_registry.run_benchmark(
+            target=target,
+            count=args.images,
+            layers_per_image=args.layers,
+            shared_layers=args.shared_layers,
+            layer_size=args.layer_size,
+            source_options=source_options,
+            target_options={'auth': args.auth},
+            transfer_engine=args.transfer_engine,
+            destinations=args.destinations))
+    if args.json:
+        print(json.dumps(reports, indent=2, sort_keys=True))
+        return
+    for report in reports:
+        print(fake_registry.format_report(report))
+        print('')
+
+
+if __name__ == '__main__':
+    main()
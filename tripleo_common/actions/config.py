@@ -36,12 +36,15 @@ class GetOvercloudConfig(base.TripleOAction):
 
     :param container: name of the Swift container / plan name
      config_dir: directory where the config should be written
+     workers: number of software configs fetched and deployment files
+     written at the same time
     """
 
     def __init__(self, container=constants.DEFAULT_CONTAINER_NAME,
                  config_dir=None,
                  container_config=constants.CONFIG_CONTAINER_NAME,
-                 config_type=None):
+                 config_type=None,
+                 workers=constants.CONFIG_DOWNLOAD_WORKERS):
         super(GetOvercloudConfig, self).__init__()
         self.container = container
         self.config_dir = config_dir
@@ -51,6 +54,7 @@ class GetOvercloudConfig(base.TripleOAction):
             self.config_dir = tempfile.mkdtemp(prefix='tripleo-',
                                                suffix='-config')
         self.container_config = container_config
+        self.workers = workers
 
     def run(self, context):
         heat = self.get_orchestration_client(context)
@@ -76,7 +80,7 @@ class GetOvercloudConfig(base.TripleOAction):
         if os.path.exists(old_tarball_path):
             os.unlink(old_tarball_path)
 
-        config = ooo_config.Config(heat)
+        config = ooo_config.Config(heat, workers=self.workers)
         message = ('Automatic commit by Mistral GetOvercloudConfig action.\n\n'
                    'User: {user}\n'
                    'Project: {project}'.format(user=context.user_name,
@@ -69,7 +69,7 @@ LOCAL_CACERT_PATH = '/etc/pki/ca-trust/source/anchors/cm-local-ca.pem'
 # Swift via SwiftPlanStorageBackend to identify them from other containers
 TRIPLEO_META_USAGE_KEY = 'x-container-meta-usage-tripleo'
 
-# 60 minutes maximum to build the child layers at the same time.
+# 60 minutes maximum to build and push a container image.
 BUILD_TIMEOUT = 3600
 
 #: List of names of parameters that contain passwords
@@ -195,6 +195,9 @@ LEGACY_API_NETWORK = 'Internal'
 # Default nested depth when recursing Heat stacks
 NESTED_DEPTH = 7
 
+# Number of concurrent heat requests and file writes of config download
+CONFIG_DOWNLOAD_WORKERS = 8
+
 # Resource name for deployment resources when using config download
 TRIPLEO_DEPLOYMENT_RESOURCE = 'TripleODeployment'
 
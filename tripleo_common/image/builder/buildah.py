@@ -14,10 +14,15 @@
 #
 
 
+import collections
 from concurrent import futures
+import hashlib
+import heapq
+import json
 import os
 import six
 import tenacity
+import time
 
 from oslo_concurrency import processutils
 from oslo_log import log as logging
@@ -28,6 +33,9 @@ from tripleo_common.utils import process
 
 LOG = logging.getLogger(__name__)
 
+# Image label with the digest of the inputs the image was built from
+BUILD_DIGEST_LABEL = 'tripleo.build-digest'
+
 
 class BuildahBuilder(base.BaseBuilder):
     """Builder to build container images with Buildah."""
@@ -35,7 +43,7 @@ class BuildahBuilder(base.BaseBuilder):
     def __init__(self, work_dir, deps, base='fedora', img_type='binary',
                  tag='latest', namespace='master',
                  registry_address='127.0.0.1:8787', push_containers=True,
-                 volumes=[], excludes=[]):
+                 volumes=[], excludes=[], workers=None, build_cache=False):
         """Setup the parameters to build with Buildah.
 
         :params work_dir: Directory where the Dockerfiles or Containerfiles
@@ -57,6 +65,10 @@ class BuildahBuilder(base.BaseBuilder):
         :params volumes: Bind mount volumes used during buildah bud.
             Default to [].
         :params excludes: List of images to skip. Default to [].
+        :params workers: Number of images built at the same time. Default
+            to the CPU count, with a minimum of 2.
+        :params build_cache: Skip building images whose build inputs did not
+            change since the existing image was built. Default to False.
         """
 
         super(BuildahBuilder, self).__init__()
@@ -71,6 +83,16 @@ class BuildahBuilder(base.BaseBuilder):
         self.push_containers = push_containers
         self.volumes = volumes
         self.excludes = excludes
+        self.workers = workers or max(2, processutils.get_worker_count())
+        # Seconds spent building and pushing each image by build_all
+        self.build_times = collections.OrderedDict()
+        self.build_cache = build_cache
+        # Digest of the build inputs of each image, if build_cache is set
+        self.build_digests = {}
+        # Manifest digest of each external base image
+        self.base_digests = {}
+        # Parent image of each container, as known by build_all
+        self.parents = {}
         # Each container image has a Dockerfile or a Containerfile.
         # Buildah needs to know the base directory later.
         self.cont_map = {os.path.basename(root): root for root, dirs,
@@ -108,18 +130,178 @@ class BuildahBuilder(base.BaseBuilder):
         destination += '-' + container_name + ':' + self.tag
         return destination
 
+    def _container_files(self, container_build_path):
+        """Return the files of a container directory, in a stable order.
+
+        Directories of other container images and build logs are not
+        part of the build inputs.
+
+        :params container_build_path: Directory of the container.
+        """
+
+        other_dirs = set(self.cont_map.values())
+        other_dirs.discard(container_build_path)
+        files = []
+        for root, dirs, fnames in os.walk(container_build_path):
+            dirs[:] = sorted(d for d in dirs
+                             if os.path.join(root, d) not in other_dirs)
+            for fname in sorted(fnames):
+                if not fname.endswith('-build.log'):
+                    files.append(os.path.join(root, fname))
+        return files
+
+    def _base_images(self, container_build_path):
+        """Return the images named by the FROM lines of a container.
+
+        Build stages of the same file and scratch are not images.
+
+        :params container_build_path: Directory of the container.
+        """
+
+        images = []
+        stages = set(['scratch'])
+        for fname in ('Containerfile', 'Dockerfile'):
+            path = os.path.join(container_build_path, fname)
+            if os.path.isfile(path):
+                break
+        else:
+            return images
+        with open(path) as f:
+            for line in f:
+                words = [w for w in line.split() if not w.startswith('--')]
+                if len(words) < 2 or words[0].upper() != 'FROM':
+                    continue
+                if words[1] not in stages:
+                    images.append(words[1])
+                if len(words) > 3 and words[2].upper() == 'AS':
+                    stages.add(words[3])
+        return images
+
+    def _base_image_digest(self, image):
+        """Return the manifest digest of an external base image, if found.
+
+        :params image: Name of the image.
+        """
+
+        if image not in self.base_digests:
+            info = self._inspect(['skopeo', 'inspect', '--tls-verify=false',
+                                  'docker://' + image])
+            self.base_digests[image] = info.get('Digest')
+        return self.base_digests[image]
+
+    def _build_digest(self, container_name):
+        """Return the digest of the build inputs of a container image.
+
+        The digest covers the rendered Containerfile and every other file
+        of the container directory, the build volumes and the build digest
+        of the parent image, or the manifest digest of the base images of a
+        container without a parent. A change to an image changes the digest
+        of every image built from it. None is returned when a base image
+        can not be resolved, and the image is always built.
+
+        :params container_name: Name of the container.
+        """
+
+        if container_name in self.build_digests:
+            return self.build_digests[container_name]
+        parent = self.parents.get(container_name)
+        container_build_path = self._find_container_dir(container_name)
+        if parent:
+            parent_digests = [self._build_digest(parent)]
+        else:
+            parent_digests = [
+                self._base_image_digest(image)
+                for image in self._base_images(container_build_path)]
+        if None in parent_digests:
+            LOG.warning('Unable to resolve the base image of %s, it is '
+                        'always built' % container_name)
+            self.build_digests[container_name] = None
+            return None
+        digest = hashlib.sha256()
+        for parent_digest in parent_digests:
+            digest.update(('parent:%s\n' % parent_digest).encode('utf-8'))
+        for v in self.volumes:
+            digest.update(('volume:%s\n' % v).encode('utf-8'))
+        for path in self._container_files(container_build_path):
+            digest.update(('file:%s:%i\n' % (
+                os.path.relpath(path, container_build_path),
+                os.path.getsize(path))).encode('utf-8'))
+            with open(path, 'rb') as f:
+                for data in iter(lambda: f.read(65536), b''):
+                    digest.update(data)
+        result = 'sha256:%s' % digest.hexdigest()
+        self.build_digests[container_name] = result
+        return result
+
+    def _inspect(self, args):
+        try:
+            out, _ = process.execute(*args, run_as_root=False,
+                                     use_standard_locale=True)
+            return json.loads(out) or {}
+        except (processutils.ProcessExecutionError, ValueError):
+            return {}
+
+    def _local_build_digest(self, destination):
+        """Return the build digest label of a local image, if any.
+
+        :params destination: Name of the image.
+        """
+
+        labels = self._inspect(self.buildah_cmd + [
+            'inspect', '--type', 'image',
+            '--format', '{{ json .OCIv1.Config.Labels }}', destination])
+        return labels.get(BUILD_DIGEST_LABEL)
+
+    def _registry_build_digest(self, destination):
+        """Return the build digest label of an image in a registry, if any.
+
+        :params destination: Name of the image.
+        """
+
+        info = self._inspect(['skopeo', 'inspect', '--tls-verify=false',
+                             'docker://' + destination])
+        return (info.get('Labels') or {}).get(BUILD_DIGEST_LABEL)
+
     def _generate_container(self, container_name):
         """Generate a container image by building and pushing the image.
 
+        With build_cache set, the build is skipped if an image with the
+        same build digest label already exists locally or, when pushing,
+        in the registry. An image only found in the registry is pulled
+        when other images are built from it.
+
         :params container_name: Name of the container.
         """
 
         if container_name in self.excludes:
             return
 
+        destination = self._get_destination(container_name)
+        build_digest = None
+        if self.build_cache:
+            build_digest = self._build_digest(container_name)
+        if build_digest:
+            if (self.push_containers and
+                    self._registry_build_digest(destination) ==
+                    build_digest):
+                LOG.info('Skipping %s, %s is up to date' %
+                         (container_name, destination))
+                # children are built from the local image
+                if (container_name in self.parents.values() and
+                        self._local_build_digest(destination) !=
+                        build_digest):
+                    self.pull(destination)
+                return
+            if self._local_build_digest(destination) == build_digest:
+                LOG.info('Skipping build of %s, the local image is up to '
+                         'date' % container_name)
+                if self.push_containers:
+                    self.push(destination)
+                return
+
         self.build(container_name, self._find_container_dir(container_name))
         if self.push_containers:
-            self.push(self._get_destination(container_name))
+            self.push(destination)
 
     def build(self, container_name, container_build_path):
         """Build an image from a given directory.
@@ -137,6 +319,12 @@ class BuildahBuilder(base.BaseBuilder):
         bud_args = ['bud']
         for v in self.volumes:
             bud_args.extend(['--volume', v])
+        build_digest = (self._build_digest(container_name)
+                        if self.build_cache else None)
+        if build_digest:
+            bud_args.extend([
+                '--label', '%s=%s' % (BUILD_DIGEST_LABEL, build_digest)
+            ])
         # TODO(aschultz): drop --format docker when oci format is properly
         # supported by the undercloud registry
         bud_args.extend(['--format', 'docker', '--tls-verify=False',
@@ -173,9 +361,63 @@ class BuildahBuilder(base.BaseBuilder):
         print("Pushing %s image with: %s" % (destination, ' '.join(args)))
         process.execute(*args, run_as_root=False, use_standard_locale=True)
 
+    @tenacity.retry(  # Retry up to 10 times with jittered exponential backoff
+        reraise=True,
+        wait=tenacity.wait_random_exponential(multiplier=1, max=15),
+        stop=tenacity.stop_after_attempt(10)
+    )
+    def pull(self, destination):
+        """Pull an image from a container registry.
+
+        :params destination: URL of the image, as used by push.
+        """
+        args = self.buildah_cmd + ['pull', '--tls-verify=False',
+                                   'docker://' + destination]
+        print("Pulling %s image with: %s" % (destination, ' '.join(args)))
+        process.execute(*args, run_as_root=False, use_standard_locale=True)
+
+    @staticmethod
+    def _dependency_graph(deps, parent=None, graph=None):
+        """Map every container of a dependencies tree to its parent.
+
+        :params deps: Dictionary, list or name of the container images
+            dependencies.
+        :params parent: Name of the container image deps are built from.
+        :returns: Ordered dictionary of container name to parent name, or
+            None for the containers without a parent. A parent is always
+            listed before its children.
+        """
+
+        if graph is None:
+            graph = collections.OrderedDict()
+        if isinstance(deps, (list,)):
+            for dep in deps:
+                BuildahBuilder._dependency_graph(dep, parent, graph)
+        elif isinstance(deps, (dict,)):
+            for container in deps:
+                graph[container] = parent
+                BuildahBuilder._dependency_graph(
+                    deps.get(container), container, graph)
+        elif isinstance(deps, six.string_types):
+            graph[deps] = parent
+        return graph
+
+    def _timed_generate_container(self, container_name):
+        start = time.time()
+        self._generate_container(container_name)
+        return time.time() - start
+
     def build_all(self, deps=None):
         """Function that browse containers dependencies and build them.
 
+        Every container is a node of a dependency graph, and is built as
+        soon as the image of its parent is built, by up to self.workers
+        builds at the same time. Ready containers with the longest chain of
+        children left are started first, so the longest path of the graph
+        is not left until the end. Every build has self.build_timeout
+        seconds to finish, and the time of every build is recorded in
+        self.build_times.
+
         :params deps: Dictionary defining the container images
             dependencies.
         """
@@ -183,67 +425,85 @@ class BuildahBuilder(base.BaseBuilder):
         if deps is None:
             deps = self.deps
 
-        if isinstance(deps, (list,)):
-            # Only a list of images can be multi-processed because they
-            # are the last layer to build. Otherwise we could have issues
-            # to build multiple times the same layer.
-            # Number of workers will be based on CPU count with a min 2,
-            # max 8. Concurrency in Buildah isn't that great so it's not
-            # useful to go above 8.
-            workers = min(8, max(2, processutils.get_worker_count()))
-            with futures.ThreadPoolExecutor(max_workers=workers) as executor:
-                future_to_build = {executor.submit(self.build_all,
-                                   container): container for container in
-                                   deps}
-                done, not_done = futures.wait(
-                    future_to_build,
-                    timeout=self.build_timeout,
-                    return_when=futures.FIRST_EXCEPTION
+        graph = self._dependency_graph(deps)
+        self.parents.update(graph)
+        children = collections.defaultdict(list)
+        for container, parent in graph.items():
+            children[parent].append(container)
+        # children are listed after their parent, so walk the graph
+        # backwards to have the path of every child before its parent
+        path = {}
+        for container in reversed(graph):
+            path[container] = 1 + max(
+                [path[c] for c in children[container]] or [0])
+
+        order = dict((c, i) for i, c in enumerate(graph))
+
+        def ready(containers):
+            for c in containers:
+                heapq.heappush(ready_heap, (-path[c], order[c], c))
+
+        ready_heap = []
+        ready(children[None])
+        running = {}
+        exceptions = list()
+        timed_out = False
+        start = time.time()
+        executor = futures.ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            while ready_heap or running:
+                while (ready_heap and len(running) < self.workers and
+                       not exceptions):
+                    _, _, container = heapq.heappop(ready_heap)
+                    job = executor.submit(
+                        self._timed_generate_container, container)
+                    running[job] = (container, time.time())
+                if not running:
+                    break
+                # the earliest started build is the first one to time out
+                deadline = (min(x[1] for x in running.values()) +
+                            self.build_timeout)
+                done, _ = futures.wait(
+                    running,
+                    timeout=max(0, deadline - time.time()),
+                    return_when=futures.FIRST_COMPLETED
                 )
-            # NOTE(cloudnull): Once the job has been completed all completed
-            #                  jobs are checked for exceptions. If any jobs
-            #                  failed a SystemError will be raised using the
-            #                  exception information. If any job was loaded
-            #                  but not executed a SystemError will be raised.
-            exceptions = list()
-            for job in done:
-                if job._exception:
-                    exceptions.append(
-                        "\nException information: {exception}".format(
-                            exception=job._exception
+                if not done:
+                    timed_out = True
+                    break
+                for job in done:
+                    container, _ = running.pop(job)
+                    if job.exception():
+                        exceptions.append(
+                            "\nException information: {exception}".format(
+                                exception=job.exception()
+                            )
                         )
-                    )
-            else:
-                if exceptions:
-                    raise RuntimeError(
-                        '\nThe following errors were detected during '
-                        'container build(s):\n{exceptions}'.format(
-                            exceptions='\n'.join(exceptions)
-                        )
-                    )
-
-                if not_done:
-                    error_msg = ('The following jobs were '
-                                 'incomplete: {}'.format(
-                                     [future_to_build[job] for job
-                                         in not_done]))
-
-                    jobs_with_exceptions = [{
-                        'container': future_to_build[job],
-                        'exception': job._exception}
-                        for job in not_done if job._exception]
-                    if jobs_with_exceptions:
-                        for job_with_exception in jobs_with_exceptions:
-                            error_msg = error_msg + os.linesep + (
-                                "%(container)s raised the following "
-                                "exception: %(exception)s" %
-                                job_with_exception)
-
-                    raise SystemError(error_msg)
-
-        elif isinstance(deps, (dict,)):
-            for container in deps:
-                self._generate_container(container)
-                self.build_all(deps.get(container))
-        elif isinstance(deps, six.string_types):
-            self._generate_container(deps)
+                        continue
+                    self.build_times[container] = job.result()
+                    ready(children[container])
+        finally:
+            executor.shutdown(wait=not timed_out)
+
+        self._log_build_times(time.time() - start)
+        if exceptions:
+            raise RuntimeError(
+                '\nThe following errors were detected during '
+                'container build(s):\n{exceptions}'.format(
+                    exceptions='\n'.join(exceptions)
+                )
+            )
+        if timed_out:
+            raise SystemError(
+                'The following jobs were incomplete: {}'.format(
+                    [c for c in graph if c not in self.build_times]))
+
+    def _log_build_times(self, elapsed):
+        if not self.build_times:
+            return
+        lines = ['%8.1fs %s' % (seconds, container) for container, seconds
+                 in sorted(self.build_times.items(),
+                           key=lambda x: x[1], reverse=True)]
+        LOG.info('Built %i container images in %.1fs with %i workers:\n%s'
+                 % (len(self.build_times), elapsed, self.workers,
+                    '\n'.join(lines)))
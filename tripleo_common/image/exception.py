@@ -30,10 +30,5 @@ class ImageUploaderException(Exception):
     pass
 
 
-class ImageUploaderThreadException(Exception):
-    """Conflict during thread processing"""
-    pass
-
-
 class ImageNotFoundException(Exception):
     pass
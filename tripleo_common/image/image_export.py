@@ -14,15 +14,21 @@
 #
 
 import collections
+import contextlib
 import errno
+import fcntl
 import hashlib
+import io
 import json
 import os
 import requests
 import six
 import shutil
+import stat
+import tempfile
 
 from oslo_log import log as logging
+from six.moves.urllib import parse
 from tripleo_common.utils import image as image_utils
 
 LOG = logging.getLogger(__name__)
@@ -52,6 +58,17 @@ TYPE_KEYS = (
 
 TYPE_MAP_EXTENSION = '.type-map'
 
+# Size of the reads used to copy and hash piped layer data
+BLOB_CHUNK_SIZE = 2 ** 20
+
+# Content addressed store of every exported blob, image blobs directories
+# hold hard links into it
+BLOB_STORE_DIR = '_blobs'
+
+# Directory of the manifests referencing each stored blob, with one empty
+# file per reference so references are added and removed without a lock
+BLOB_REFS_DIR = 'refs'
+
 
 def skip_if_exists(f):
     @six.wraps(f)
@@ -74,6 +91,165 @@ def make_dir(path):
     os.makedirs(path, 0o775)
 
 
+@contextlib.contextmanager
+def file_lock(lock_path):
+    """Hold an exclusive lock on lock_path for the duration of the context"""
+    make_dir(os.path.dirname(lock_path))
+    with open(lock_path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def write_atomic(path, data):
+    """Replace the file at path so readers never see partial data"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.%s' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def blob_store_path(digest, compressed=True):
+    algorithm, _, hex_digest = digest.partition(':')
+    return os.path.join(IMAGE_EXPORT_DIR, 'v2', BLOB_STORE_DIR, algorithm,
+                        '%s.gz' % hex_digest if compressed else hex_digest)
+
+
+@skip_if_exists
+def link_blob(store_path, blob_path):
+    if not os.path.exists(blob_path):
+        os.link(store_path, blob_path)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+        return True
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+
+
+def _remove_dir(path):
+    try:
+        os.rmdir(path)
+    except OSError as e:
+        # a reference was added meanwhile
+        if e.errno not in (errno.ENOENT, errno.ENOTEMPTY, errno.EEXIST):
+            raise
+
+
+def manifest_blobs(manifest):
+    """Return the blob digests referenced by a manifest"""
+    if manifest.get('schemaVersion', 2) == 1:
+        blobs = [x.get('blobSum') for x in manifest.get('fsLayers', [])]
+    else:
+        blobs = [x.get('digest') for x in manifest.get('layers', [])]
+        blobs.append(manifest.get('config', {}).get('digest'))
+    return set(b for b in blobs if b)
+
+
+def blob_refs_path(digest):
+    algorithm, _, hex_digest = digest.partition(':')
+    return os.path.join(IMAGE_EXPORT_DIR, 'v2', BLOB_STORE_DIR,
+                        BLOB_REFS_DIR, algorithm, hex_digest)
+
+
+def _blob_refs(digest):
+    """Return the set of references to a stored blob, None if unrecorded"""
+    try:
+        return set(parse.unquote(r)
+                   for r in os.listdir(blob_refs_path(digest)))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+
+def update_blob_refs(ref, add=(), remove=()):
+    """Add or remove a manifest reference to stored blobs
+
+    :param ref: reference in the form <image>@<manifest digest>
+    :param add: blob digests referenced by ref
+    :param remove: blob digests no longer referenced by ref
+    :returns: dict of each removed digest to the set of references left,
+              or None for digests which were never recorded
+    """
+    ref_name = parse.quote(ref, safe='')
+    for digest in add:
+        refs_path = blob_refs_path(digest)
+        while True:
+            make_dir(refs_path)
+            try:
+                with open(os.path.join(refs_path, ref_name), 'a'):
+                    break
+            except (IOError, OSError) as e:
+                # removed with the last reference of a concurrent delete
+                if e.errno != errno.ENOENT:
+                    raise
+    left = {}
+    for digest in remove:
+        refs_path = blob_refs_path(digest)
+        if not os.path.isdir(refs_path):
+            left[digest] = None
+            continue
+        _remove_file(os.path.join(refs_path, ref_name))
+        digest_refs = _blob_refs(digest) or set()
+        if not digest_refs:
+            _remove_dir(refs_path)
+        left[digest] = digest_refs
+    return left
+
+
+def _sweep_blob(digest):
+    """Remove a stored blob no manifest and no image references"""
+    if _blob_refs(digest):
+        return
+    for compressed in (True, False):
+        store_path = blob_store_path(digest, compressed=compressed)
+        try:
+            # image blobs directories hold hard links to the blob
+            if os.stat(store_path).st_nlink > 1:
+                continue
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+        if _remove_file(store_path):
+            LOG.debug('Deleting stored blob %s' % store_path)
+
+
+def sweep_blob_store():
+    """Remove every stored blob no manifest and no image references
+
+    Blobs are left in the store by exports which were interrupted before
+    the image manifest was written.
+    """
+    store_path = os.path.join(IMAGE_EXPORT_DIR, 'v2', BLOB_STORE_DIR)
+    if not os.path.isdir(store_path):
+        return
+    for algorithm in os.listdir(store_path):
+        algorithm_path = os.path.join(store_path, algorithm)
+        if algorithm == BLOB_REFS_DIR or not os.path.isdir(algorithm_path):
+            continue
+        for f in os.listdir(algorithm_path):
+            # skip the temporary files of exports in progress
+            if f.startswith('.'):
+                continue
+            hex_digest = f[:-3] if f.endswith('.gz') else f
+            _sweep_blob('%s:%s' % (algorithm, hex_digest))
+
+
 def image_tag_from_url(image_url):
     parts = image_url.path.split(':')
     if len(parts) == 1:
@@ -90,18 +266,115 @@ def image_tag_from_url(image_url):
     return image, tag
 
 
-@skip_if_exists
-def export_stream(target_url, layer, layer_stream, verify_digest=True):
+def _kernel_copy(pipe):
+    """Return a function copying a chunk of pipe in the kernel, if any
+
+    Regular files, such as cached local layers, are copied with
+    os.sendfile and pipes with os.splice, where Python provides them.
+    """
+    try:
+        fd_in = pipe.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return None
+    mode = os.fstat(fd_in).st_mode
+    if stat.S_ISREG(mode) and hasattr(os, 'sendfile'):
+        return lambda fd_out: os.sendfile(fd_out, fd_in, None,
+                                          BLOB_CHUNK_SIZE)
+    if stat.S_ISFIFO(mode) and hasattr(os, 'splice'):
+        return lambda fd_out: os.splice(fd_in, fd_out, BLOB_CHUNK_SIZE)
+    return None
+
+
+def copy_pipe(pipe, f, calc_digest):
+    """Copy a readable file to the end of a blob file, hashing every byte once
+
+    Where the kernel can copy the data from the file to the blob file it is
+    then hashed from the page cache, so it is never copied through a Python
+    write.
+
+    :param pipe: readable file object, such as a cached layer file or a
+                 subprocess stdout
+    :param f: file object opened for reading and writing
+    :param calc_digest: digest to update with the copied data
+    :returns: number of bytes copied
+    """
+    f.flush()
+    start = f.tell()
+    length = 0
+    copy = _kernel_copy(pipe)
+    if copy is not None:
+        fd_out = f.fileno()
+        try:
+            while True:
+                n = copy(fd_out)
+                if not n:
+                    break
+                length += n
+        except OSError as e:
+            # in kernel copies are not supported by every file system
+            if length or e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+            copy = None
+        else:
+            offset = start
+            while offset < start + length:
+                data = os.pread(fd_out, BLOB_CHUNK_SIZE, offset)
+                if not data:
+                    break
+                calc_digest.update(data)
+                offset += len(data)
+            f.seek(start + length)
+    if copy is None:
+        while True:
+            data = pipe.read(BLOB_CHUNK_SIZE)
+            if not data:
+                break
+            f.write(data)
+            calc_digest.update(data)
+            length += len(data)
+    return length
+
+
+def export_stream(target_url, layer, layer_stream, verify_digest=True,
+                  calc_digest=None):
+    """Export a layer stream to a blob file
+
+    The blob is written once to the content addressed store and hard linked
+    into the blobs directory of the image.
+
+    :param target_url: URL of the exported image
+    :param layer: layer entry, updated with the exported digest and size
+    :param layer_stream: iterable of data chunks. A chunk may instead be a
+                         readable file or pipe, which is copied with
+                         copy_pipe
+    :param verify_digest: check the data matches the layer digest
+    :param calc_digest: digest the stream already updates with every data
+                        chunk it yields, so the data is not hashed again here
+    :returns: tuple of the layer digest and the blob path
+    """
     image, _ = image_tag_from_url(target_url)
     digest = layer['digest']
     blob_dir_path = os.path.join(IMAGE_EXPORT_DIR, 'v2', image, 'blobs')
     make_dir(blob_dir_path)
     blob_path = os.path.join(blob_dir_path, '%s.gz' % digest)
-
+    store_path = blob_store_path(digest)
+
+    if verify_digest and os.path.isfile(store_path):
+        # the digest is trusted, so the stored blob can be reused without
+        # starting the stream at all
+        LOG.debug('[%s] Layer already stored at %s' % (image, store_path))
+        link_blob(store_path, blob_path)
+        layer['size'] = os.stat(store_path).st_size
+        return (digest, blob_path)
+
+    store_dir_path = os.path.dirname(store_path)
+    make_dir(store_dir_path)
     LOG.debug('[%s] Export layer to %s' % (image, blob_path))
 
     length = 0
-    calc_digest = hashlib.sha256()
+    hash_chunks = calc_digest is None
+    if hash_chunks:
+        calc_digest = hashlib.sha256()
 
     def remove_layer(image, blob_path):
         if os.path.isfile(blob_path):
@@ -109,38 +382,45 @@ def export_stream(target_url, layer, layer_stream, verify_digest=True):
             LOG.error('[%s] Broken layer found and removed %s' %
                       (image, blob_path))
 
+    # write to a temporary file so concurrent exports never link a partial
+    # blob from the store
+    fd, tmp_path = tempfile.mkstemp(dir=store_dir_path, prefix='.export')
     try:
-        fd = os.open(blob_path, os.O_WRONLY | os.O_CREAT)
         os.fchmod(fd, 0o0644)
         with os.fdopen(fd, 'wb') as f:
             count = 0
             for chunk in layer_stream:
                 count += 1
+                if not isinstance(chunk, six.binary_type):
+                    LOG.debug('[%s] Copying pipe for %s' % (image, digest))
+                    length += copy_pipe(chunk, f, calc_digest)
+                    continue
                 if not chunk:
                     break
                 LOG.debug('[%s] Writing chunk %i for %s' %
                           (image, count, digest))
                 f.write(chunk)
-                calc_digest.update(chunk)
+                if hash_chunks:
+                    calc_digest.update(chunk)
                 length += len(chunk)
                 LOG.debug('[%s] Written %i bytes for %s' %
                           (image, length, digest))
     except MemoryError as e:
         memory_error = '[{}] Memory Error: {}'.format(image, str(e))
         LOG.error(memory_error)
-        remove_layer(image, blob_path)
+        remove_layer(image, tmp_path)
         raise MemoryError(memory_error)
     except requests.exceptions.HTTPError as e:
         # catch http errors seperately as those can be retried in
         # the image uploader
         http_error = '[{}] HTTP error: {}'.format(image, str(e))
         LOG.error(http_error)
-        remove_layer(image, blob_path)
+        remove_layer(image, tmp_path)
         raise
     except Exception as e:
         write_error = '[{}] Write Failure: {}'.format(image, str(e))
         LOG.error(write_error)
-        remove_layer(image, blob_path)
+        remove_layer(image, tmp_path)
         raise IOError(write_error)
     else:
         LOG.info('[%s] Layer written successfully %s' % (image, blob_path))
@@ -164,18 +444,25 @@ def export_stream(target_url, layer, layer_stream, verify_digest=True):
                 )
             )
             LOG.error(error_msg)
-            if os.path.isfile(blob_path):
-                os.remove(blob_path)
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
             raise requests.exceptions.HTTPError(error_msg)
-    else:
-        # if the original layer is uncompressed
-        # the digest may change on export
-        expected_blob_path = os.path.join(
-            blob_dir_path, '%s.gz' % layer_digest
-        )
-        if blob_path != expected_blob_path:
-            os.rename(blob_path, expected_blob_path)
-            blob_path = expected_blob_path
+
+    # if the original layer is uncompressed the digest may change on
+    # export, so the blob is always stored by the calculated digest
+    store_path = blob_store_path(layer_digest)
+    blob_path = os.path.join(blob_dir_path, '%s.gz' % layer_digest)
+    try:
+        os.link(tmp_path, store_path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        # a concurrent export stored the same blob first, link that one
+        LOG.debug('[%s] Layer stored concurrently at %s' %
+                  (image, store_path))
+    finally:
+        _remove_file(tmp_path)
+    link_blob(store_path, blob_path)
 
     layer['digest'] = layer_digest
     layer['size'] = length
@@ -229,8 +516,11 @@ def cross_repo_mount(target_image_url, image_layers, source_layers,
             dir_path = os.path.join(IMAGE_EXPORT_DIR, 'v2', image, 'blobs')
             blob_path = os.path.join(dir_path, '%s.gz' % layer)
             if not os.path.exists(blob_path):
-                LOG.debug('[%s] Layer not found: %s' % (image, blob_path))
-                continue
+                store_path = blob_store_path(layer)
+                if not os.path.exists(store_path):
+                    LOG.debug('[%s] Layer not found: %s' % (image, blob_path))
+                    continue
+                blob_path = store_path
 
         layer_cross_link(layer, image, blob_path, target_image_url)
         linked_layers.update({layer: {'known_path': blob_path,
@@ -251,9 +541,12 @@ def export_manifest_config(target_url,
         make_dir(blob_dir_path)
         config_digest = manifest['config']['digest']
         config_path = os.path.join(blob_dir_path, config_digest)
+        store_path = blob_store_path(config_digest, compressed=False)
 
-        with open(config_path, 'w+b') as f:
-            f.write(config_str.encode('utf-8'))
+        if not os.path.isfile(store_path):
+            make_dir(os.path.dirname(store_path))
+            write_atomic(store_path, config_str.encode('utf-8'))
+        link_blob(store_path, config_path)
 
     calc_digest = hashlib.sha256()
     calc_digest.update(manifest_str.encode('utf-8'))
@@ -267,7 +560,7 @@ def export_manifest_config(target_url,
     htaccess_path = os.path.join(manifest_dir_path, '.htaccess')
 
     make_dir(manifest_dir_path)
-    build_catalog()
+    add_repository(image)
 
     with open(manifests_htaccess_path, 'w+') as f:
         f.write('AddHandler type-map %s\n' % TYPE_MAP_EXTENSION)
@@ -309,7 +602,9 @@ def export_manifest_config(target_url,
 
     if manifest_dict:
         write_type_map_file(image, tag, manifest_dict)
-    build_tags_list(image)
+        add_tag(image, tag)
+    update_blob_refs('%s@%s' % (image, manifest_digest),
+                     add=manifest_blobs(manifest))
 
 
 def write_type_map_file(image, tag, manifest_dict):
@@ -324,6 +619,23 @@ def write_type_map_file(image, tag, manifest_dict):
             f.write('URI: %s/index.json\n\n' % digest)
 
 
+def tag_digest(image_url):
+    """Return the manifest digest an exported tag points to
+
+    When the tag has a manifest of more than one type the digests are
+    joined in a stable order. None is returned for a missing tag.
+    """
+    image, tag = image_tag_from_url(image_url)
+    type_map_path = os.path.join(
+        IMAGE_EXPORT_DIR, 'v2', image, 'manifests',
+        '%s%s' % (tag, TYPE_MAP_EXTENSION))
+    if not os.path.isfile(type_map_path):
+        return None
+    type_map = parse_type_map_file(type_map_path)
+    digests = sorted(uri.split('/')[0] for uri in type_map.values())
+    return ','.join(digests) or None
+
+
 def parse_type_map_file(type_map_path):
     uri = None
     content_type = None
@@ -353,13 +665,50 @@ def migrate_to_type_map_file(image, manifest_symlink_path):
     os.remove(manifest_symlink_path)
 
 
-def build_tags_list(image):
+def _update_index(index_path, data, key, scan, add=None, remove=None,
+                  rebuild=False):
+    """Add or remove a single entry of a JSON list index
+
+    The index is read, updated and atomically replaced under a file lock,
+    so the cost does not depend on the size of the export tree. The
+    entries are only scanned from the tree when the index is missing or a
+    rebuild is requested.
+
+    :param index_path: path of the index file
+    :param data: other keys to write to the index
+    :param key: key of the list of entries in the index
+    :param scan: callable returning the entries found in the tree
+    :param add: entry to add
+    :param remove: entry to remove
+    :param rebuild: replace the entries with the result of scan
+    """
+    with file_lock('%s.lock' % index_path):
+        entries = None
+        if not rebuild and os.path.isfile(index_path):
+            try:
+                with open(index_path) as f:
+                    entries = json.load(f).get(key)
+            except ValueError:
+                LOG.warning('Rebuilding corrupt index %s' % index_path)
+        changed = entries is None
+        if changed:
+            LOG.debug('Rebuilding %s' % index_path)
+            entries = scan()
+        if add is not None and add not in entries:
+            entries.append(add)
+            changed = True
+        if remove is not None and remove in entries:
+            entries.remove(remove)
+            changed = True
+        if changed:
+            data[key] = entries
+            write_atomic(index_path, json.dumps(
+                data, ensure_ascii=False).encode('utf-8'))
+
+
+def _scan_tags(image):
     manifests_path = os.path.join(
         IMAGE_EXPORT_DIR, 'v2', image, 'manifests')
-    tags_dir_path = os.path.join(IMAGE_EXPORT_DIR, 'v2', image, 'tags')
-    tags_list_path = os.path.join(tags_dir_path, 'list')
-    LOG.debug('[%s] Rebuilding %s' % (image, tags_dir_path))
-    make_dir(tags_dir_path)
     tags = []
     for f in os.listdir(manifests_path):
         f_path = os.path.join(manifests_path, f)
@@ -368,31 +717,106 @@ def build_tags_list(image):
             migrate_to_type_map_file(image, f_path)
         if f.endswith(TYPE_MAP_EXTENSION):
             tags.append(f[:-len(TYPE_MAP_EXTENSION)])
+    return tags
 
-    tags_data = {
-        "name": image,
-        "tags": tags
-    }
-    with open(tags_list_path, 'w+b') as f:
-        f.write(json.dumps(tags_data, ensure_ascii=False).encode('utf-8'))
 
+def _update_tags_list(image, add=None, remove=None, rebuild=False):
+    tags_dir_path = os.path.join(IMAGE_EXPORT_DIR, 'v2', image, 'tags')
+    make_dir(tags_dir_path)
+    _update_index(os.path.join(tags_dir_path, 'list'), {'name': image},
+                  'tags', lambda: _scan_tags(image),
+                  add=add, remove=remove, rebuild=rebuild)
 
-def build_catalog():
-    catalog_path = os.path.join(IMAGE_EXPORT_DIR, 'v2', '_catalog')
+
+def add_tag(image, tag):
+    _update_tags_list(image, add=tag)
+
+
+def remove_tag(image, tag):
+    _update_tags_list(image, remove=tag)
+
+
+def build_tags_list(image):
+    _update_tags_list(image, rebuild=True)
+
+
+def _scan_catalog():
     catalog_entries = []
-    LOG.debug('Rebuilding %s' % catalog_path)
     images_path = os.path.join(IMAGE_EXPORT_DIR, 'v2')
 
     for namespace in os.listdir(images_path):
         namespace_path = os.path.join(images_path, namespace)
-        if not os.path.isdir(namespace_path):
+        if namespace == BLOB_STORE_DIR or not os.path.isdir(namespace_path):
             continue
         for image in os.listdir(namespace_path):
             catalog_entries.append('%s/%s' % (namespace, image))
+    return catalog_entries
+
+
+def _update_catalog(add=None, remove=None, rebuild=False):
+    catalog_path = os.path.join(IMAGE_EXPORT_DIR, 'v2', '_catalog')
+    _update_index(catalog_path, {}, 'repositories', _scan_catalog,
+                  add=add, remove=remove, rebuild=rebuild)
+
+
+def add_repository(image):
+    _update_catalog(add=image)
+
+
+def remove_repository(image):
+    _update_catalog(remove=image)
+
+
+def build_catalog():
+    _update_catalog(rebuild=True)
+
+
+def repair():
+    """Rebuild the catalog and every tags list from the export tree
+
+    Image and stored blobs no longer referenced are removed too, so no
+    export must be running.
+    """
+    images_path = os.path.join(IMAGE_EXPORT_DIR, 'v2')
+    if not os.path.isdir(images_path):
+        return
+    build_catalog()
+    for image in _scan_catalog():
+        if os.path.isdir(os.path.join(images_path, image, 'manifests')):
+            build_tags_list(image)
+        _sweep_image_blobs(image)
+    sweep_blob_store()
 
-    catalog = {'repositories': catalog_entries}
-    with open(catalog_path, 'w+b') as f:
-        f.write(json.dumps(catalog, ensure_ascii=False).encode('utf-8'))
+
+def _delete_blob(image, blobs_path, digest):
+    for blob_path in (os.path.join(blobs_path, '%s.gz' % digest),
+                      os.path.join(blobs_path, digest)):
+        if _remove_file(blob_path):
+            LOG.debug('[%s] Deleting layer blob %s' % (image, blob_path))
+
+
+def _sweep_image_blobs(image):
+    """Remove the blobs of an image none of its manifests references
+
+    Such blobs are left by exports interrupted before the image manifest
+    was written. Blobs exported before references were recorded are not
+    in the store and are kept.
+    """
+    blobs_path = os.path.join(IMAGE_EXPORT_DIR, 'v2', image, 'blobs')
+    if not os.path.isdir(blobs_path):
+        return
+    for b in os.listdir(blobs_path):
+        digest = b[:-3] if b.endswith('.gz') else b
+        digest_refs = _blob_refs(digest)
+        if digest_refs is None:
+            store_path = blob_store_path(digest, compressed=b != digest)
+            if not (os.path.exists(store_path) and os.path.samefile(
+                    store_path, os.path.join(blobs_path, b))):
+                continue
+        elif any(r.startswith('%s@' % image) for r in digest_refs):
+            continue
+        _delete_blob(image, blobs_path, digest)
+        _sweep_blob(digest)
 
 
 def delete_image(image_url):
@@ -412,13 +836,16 @@ def delete_image(image_url):
         LOG.debug('[%s] Deleting typemap file %s' % (image, type_map_path))
         os.remove(type_map_path)
 
-    build_tags_list(image)
+    remove_tag(image, tag)
 
     # build list of manifest_dir_path without symlinks
     linked_manifest_dirs = set()
     manifest_dirs = set()
     for f in os.listdir(manifests_path):
         f_path = os.path.join(manifests_path, f)
+        if os.path.islink(f_path):
+            migrate_to_type_map_file(image, f_path)
+            f_path = '%s%s' % (f_path, TYPE_MAP_EXTENSION)
         if f_path.endswith(TYPE_MAP_EXTENSION):
             for uri in parse_type_map_file(f_path).values():
                 linked_manifest_dir = os.path.dirname(
@@ -429,44 +856,36 @@ def delete_image(image_url):
 
     delete_manifest_dirs = manifest_dirs.difference(linked_manifest_dirs)
 
-    # delete list of manifest_dir_path without symlinks
+    # drop the references of the deleted manifests to their blobs, and
+    # delete the blobs no other manifest of the image references
+    blobs_path = os.path.join(IMAGE_EXPORT_DIR, 'v2', image, 'blobs')
+    untracked_blobs = set()
     for manifest_dir in delete_manifest_dirs:
         LOG.debug('[%s] Deleting manifest %s' % (image, manifest_dir))
-        shutil.rmtree(manifest_dir)
-
-    # load all remaining manifests and build the set of of in-use blobs,
-    # delete any layer blob not in-use
-    reffed_blobs = set()
-    blobs_path = os.path.join(IMAGE_EXPORT_DIR, 'v2', image, 'blobs')
-
-    def add_reffed_blob(digest):
-        blob_path = os.path.join(blobs_path, digest)
-        gz_blob_path = os.path.join(blobs_path, '%s.gz' % digest)
-        if os.path.isfile(gz_blob_path):
-            reffed_blobs.add(gz_blob_path)
-        elif os.path.isfile(blob_path):
-            reffed_blobs.add(blob_path)
-
-    for manifest_dir in linked_manifest_dirs:
         manifest_path = os.path.join(manifest_dir, 'index.json')
-        with open(manifest_path) as f:
-            manifest = json.load(f)
-        v1manifest = manifest.get('schemaVersion', 2) == 1
-
-        if v1manifest:
-            for layer in manifest.get('fsLayers', []):
-                add_reffed_blob(layer.get('blobSum'))
-        else:
-            for layer in manifest.get('layers', []):
-                add_reffed_blob(layer.get('digest'))
-            add_reffed_blob(manifest.get('config', {}).get('digest'))
+        blobs = set()
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                blobs = manifest_blobs(json.load(f))
+        ref = '%s@%s' % (image, os.path.basename(manifest_dir))
+        left = update_blob_refs(ref, remove=blobs)
+        for digest, digest_refs in left.items():
+            if digest_refs is None:
+                untracked_blobs.add(digest)
+            elif not any(r.startswith('%s@' % image) for r in digest_refs):
+                _delete_blob(image, blobs_path, digest)
+                _sweep_blob(digest)
+        shutil.rmtree(manifest_dir)
 
-    all_blobs = set([os.path.join(blobs_path, b)
-                     for b in os.listdir(blobs_path)])
-    delete_blobs = all_blobs.difference(reffed_blobs)
-    for blob in delete_blobs:
-        LOG.debug('[%s] Deleting layer blob %s' % (image, blob))
-        os.remove(blob)
+    if untracked_blobs:
+        # blobs exported before references were recorded, check them
+        # against the remaining manifests of the image
+        for manifest_dir in linked_manifest_dirs:
+            manifest_path = os.path.join(manifest_dir, 'index.json')
+            with open(manifest_path) as f:
+                untracked_blobs -= manifest_blobs(json.load(f))
+        for digest in untracked_blobs:
+            _delete_blob(image, blobs_path, digest)
 
     # if no files left in manifests_path, delete the whole image
     remaining = os.listdir(manifests_path)
@@ -474,6 +893,4 @@ def delete_image(image_url):
         image_path = os.path.join(IMAGE_EXPORT_DIR, 'v2', image)
         LOG.debug('[%s] Deleting image directory %s' % (image, image_path))
         shutil.rmtree(image_path)
-
-    # rebuild the catalog for the current image list
-    build_catalog()
+        remove_repository(image)
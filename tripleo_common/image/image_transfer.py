@@ -0,0 +1,407 @@
+#   Copyright 2020 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+import collections
+from concurrent import futures
+import contextlib
+import email.utils
+import threading
+import time
+
+from oslo_log import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+# Total number of layer transfers which can be in flight at once
+DEFAULT_MAX_WORKERS = 32
+
+# Number of concurrent transfers allowed against a single registry host
+DEFAULT_REGISTRY_LIMIT = 8
+
+# Bounds of the adaptive number of requests in flight per registry host
+LIMIT_MIN = 1
+LIMIT_MAX = 64
+
+# The limit only grows while the smoothed request latency stays within this
+# factor of the best smoothed latency seen for the host
+LATENCY_TOLERANCE = 2.0
+
+# Pause after a 429 or 503 without a Retry-After, doubled for every further
+# one in a row up to the maximum
+BACKOFF_PAUSE = 1.0
+BACKOFF_PAUSE_MAX = 60.0
+
+# Status codes a registry uses to ask clients to slow down
+BACKOFF_STATUS = (429, 503)
+
+# Chunks a stream tee buffers for its slowest consumer
+TEE_MAX_CHUNKS = 16
+
+
+class RegistryBudget(object):
+    """Limit the number of concurrent transfers against a registry host
+
+    The budget is re-entrant per thread so code which already holds a slot
+    for a host (for example a layer copy) can make further requests to that
+    host (HEAD checks, upload PATCHes) without deadlocking against itself.
+    """
+
+    def __init__(self, host, limit):
+        self.host = host
+        self.limit = limit
+        self._semaphore = threading.BoundedSemaphore(limit)
+        self._local = threading.local()
+
+    def _depth(self):
+        return getattr(self._local, 'depth', 0)
+
+    def acquire(self):
+        depth = self._depth()
+        if not depth:
+            self._semaphore.acquire()
+        self._local.depth = depth + 1
+
+    def release(self):
+        depth = self._depth() - 1
+        self._local.depth = depth
+        if not depth:
+            self._semaphore.release()
+
+
+def retry_after_seconds(value, now=None):
+    """Parse a Retry-After header, in seconds or as an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    date = email.utils.parsedate_tz(value)
+    if not date:
+        return None
+    return max(email.utils.mktime_tz(date) - (now or time.time()), 0.0)
+
+
+class AdaptiveLimiter(object):
+    """Adapt the number of requests in flight against a registry host
+
+    The limit follows additive increase, multiplicative decrease. It grows
+    by one for every limit requests completed while the limit was in use
+    and the latency stays healthy. It halves when the registry answers
+    with 429 or 503, or a request fails to connect, at most once per
+    smoothed latency so a burst of rejected requests only counts once.
+
+    A 429 or 503 also pauses every new request to the host for the time
+    asked by Retry-After, or an exponential backoff when it is missing.
+
+    :param host: registry host name and port
+    :param initial: starting limit
+    :param minimum: lowest limit
+    :param maximum: highest limit
+    """
+
+    def __init__(self, host, initial=DEFAULT_REGISTRY_LIMIT,
+                 minimum=LIMIT_MIN, maximum=LIMIT_MAX):
+        self.host = host
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.latency = None
+        self.best_latency = None
+        self._backoffs = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition(threading.Lock())
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                pause = self.paused_until - time.time()
+                if pause <= 0 and self.in_flight < int(self.limit):
+                    break
+                self._cond.wait(pause if pause > 0 else None)
+            self.in_flight += 1
+
+    def release(self, status_code=None, latency=None, retry_after=None,
+                failed=False):
+        """Release a request slot and adapt the limit to its outcome
+
+        :param status_code: response status, None if there was none
+        :param latency: seconds until the response headers arrived
+        :param retry_after: value of the Retry-After response header
+        :param failed: the request failed without a response
+        """
+        with self._cond:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if failed or status_code in BACKOFF_STATUS:
+                self._decrease(status_code in BACKOFF_STATUS, retry_after)
+            elif latency is not None:
+                self._backoffs = 0
+                self._track_latency(latency)
+                if saturated and self._healthy():
+                    self.limit = min(self.limit + 1.0 / self.limit,
+                                     self.maximum)
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Hold a request slot, releasing it as failed on an exception
+
+        The caller records the outcome of a successful request by calling
+        the yielded function with release arguments.
+        """
+        outcome = {}
+
+        def record(**kwargs):
+            outcome.update(kwargs)
+
+        self.acquire()
+        try:
+            yield record
+        except Exception:
+            self.release(failed=True)
+            raise
+        self.release(**outcome)
+
+    def _track_latency(self, latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * latency
+        if self.best_latency is None or self.latency < self.best_latency:
+            self.best_latency = self.latency
+
+    def _healthy(self):
+        return (self.best_latency is None or
+                self.latency <= self.best_latency * LATENCY_TOLERANCE)
+
+    def _decrease(self, backoff, retry_after):
+        now = time.time()
+        if now - self._last_decrease > (self.latency or 0.0):
+            self.limit = max(self.limit / 2.0, self.minimum)
+            self._last_decrease = now
+            LOG.debug('Limiting requests to %s to %i in flight' %
+                      (self.host, int(self.limit)))
+        if not backoff:
+            return
+        pause = retry_after_seconds(retry_after, now)
+        if pause is None:
+            pause = min(BACKOFF_PAUSE * 2 ** self._backoffs,
+                        BACKOFF_PAUSE_MAX)
+        self._backoffs += 1
+        if now + pause > self.paused_until:
+            LOG.info('Pausing requests to %s for %.1f seconds' %
+                     (self.host, pause))
+            self.paused_until = now + pause
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def registry_limiter(host):
+    """Return the limiter shared by every request to host in this process"""
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if not limiter:
+            limiter = AdaptiveLimiter(host)
+            _limiters[host] = limiter
+        return limiter
+
+
+def reset_limiters():
+    with _limiters_lock:
+        _limiters.clear()
+
+
+class TransferEngine(object):
+    """Run registry transfers on a single pool with per-registry budgets
+
+    The default uploader behaviour nests a 4 thread layer pool inside every
+    upload task, so the number of requests in flight against a registry
+    depends on how many tasks happen to run at once. The engine instead
+    runs every layer transfer of every task on one shared pool and bounds
+    the number of concurrent transfers per registry host.
+
+    :param max_workers: total number of transfers in flight
+    :param registry_limit: number of concurrent transfers per registry host
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS,
+                 registry_limit=DEFAULT_REGISTRY_LIMIT):
+        self.max_workers = max_workers
+        self.registry_limit = registry_limit
+        self._budgets = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def registry_budget(self, host):
+        with self._lock:
+            budget = self._budgets.get(host)
+            if not budget:
+                budget = RegistryBudget(host, self.registry_limit)
+                self._budgets[host] = budget
+            return budget
+
+    @contextlib.contextmanager
+    def budget(self, *hosts):
+        """Hold a transfer slot for every given registry host
+
+        Slots are always taken in sorted host order so two transfers between
+        the same pair of registries cannot deadlock each other.
+        """
+        budgets = [self.registry_budget(h) for h in sorted(set(hosts)) if h]
+        acquired = []
+        try:
+            for b in budgets:
+                b.acquire()
+                acquired.append(b)
+            yield
+        finally:
+            for b in reversed(acquired):
+                b.release()
+
+    def _get_executor(self):
+        with self._lock:
+            if not self._executor:
+                self._executor = futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers)
+            return self._executor
+
+    def _run(self, hosts, fn, args, kwargs):
+        with self.budget(*hosts):
+            return fn(*args, **kwargs)
+
+    def submit(self, hosts, fn, *args, **kwargs):
+        """Schedule fn on the shared pool within the budget of hosts"""
+        return self._get_executor().submit(
+            self._run, hosts, fn, args, kwargs)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor:
+            executor.shutdown(wait=wait)
+
+
+class NullDigest(object):
+    """Digest which hashes nothing, for a stream its consumers hash"""
+
+    def update(self, data):
+        pass
+
+
+class StreamTee(object):
+    """Read a stream once on behalf of several consumers
+
+    Every consumer iterates the generator returned by consumer(), usually
+    from its own thread. The consumer which gets ahead reads the next chunk
+    of the source, and waits once it is max_chunks ahead of the slowest
+    consumer still reading. A consumer which stops early must be closed,
+    so the others are not held back.
+
+    :param stream: iterable of chunks read by a single consumer at a time
+    :param count: number of consumers
+    :param max_chunks: number of chunks buffered for the slowest consumer
+    """
+
+    def __init__(self, stream, count, max_chunks=TEE_MAX_CHUNKS):
+        self._stream = iter(stream)
+        self._count = count
+        self.max_chunks = max_chunks
+        self._cond = threading.Condition()
+        # chunks not read by every open consumer yet, the first being the
+        # chunk at index _base of the stream
+        self._chunks = collections.deque()
+        self._base = 0
+        # index of the next chunk of every consumer, None once closed
+        self._positions = [0] * count
+        self._reading = False
+        self._done = False
+        self._error = None
+
+    def consumer(self, index):
+        """Return the generator of chunks of a consumer
+
+        :param index: consumer number, from 0 to count - 1
+        """
+        try:
+            while True:
+                chunk = self._next(index)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            self.close(index)
+
+    def close(self, index):
+        """Stop feeding a consumer"""
+        with self._cond:
+            if self._positions[index] is not None:
+                self._positions[index] = None
+                self._trim()
+
+    def _trim(self):
+        positions = [p for p in self._positions if p is not None]
+        last = min(positions) if positions else self._base + len(
+            self._chunks)
+        while self._chunks and self._base < last:
+            self._chunks.popleft()
+            self._base += 1
+        self._cond.notify_all()
+
+    def _next(self, index):
+        with self._cond:
+            while True:
+                position = self._positions[index]
+                if position is None:
+                    return None
+                if position < self._base + len(self._chunks):
+                    self._positions[index] = position + 1
+                    chunk = self._chunks[position - self._base]
+                    if position == self._base:
+                        self._trim()
+                    return chunk
+                if self._error is not None:
+                    raise self._error
+                if self._done:
+                    return None
+                if self._reading or len(self._chunks) >= self.max_chunks:
+                    self._cond.wait()
+                    continue
+                self._reading = True
+                break
+        chunk = None
+        error = None
+        try:
+            chunk = next(self._stream)
+        except StopIteration:
+            pass
+        except Exception as e:
+            error = e
+        with self._cond:
+            self._reading = False
+            if error is not None:
+                self._error = error
+            elif chunk is None:
+                self._done = True
+            else:
+                self._chunks.append(chunk)
+            self._cond.notify_all()
+        return self._next(index)
@@ -14,11 +14,11 @@
 #
 
 import base64
+import collections
 from concurrent import futures
 import hashlib
 import json
 import os
-import random
 import re
 import requests
 from requests import auth as requests_auth
@@ -28,8 +28,12 @@ import six
 from six.moves.urllib import parse
 import socket
 import subprocess
+import sys
 import tempfile
 import tenacity
+import threading
+import time
+from urllib3.util.retry import Retry
 import yaml
 
 from oslo_concurrency import processutils
@@ -39,8 +43,11 @@ from tripleo_common.image.base import BaseImageManager
 from tripleo_common.image.exception import ImageNotFoundException
 from tripleo_common.image.exception import ImageRateLimitedException
 from tripleo_common.image.exception import ImageUploaderException
-from tripleo_common.image.exception import ImageUploaderThreadException
 from tripleo_common.image import image_export
+from tripleo_common.image import image_transfer
+from tripleo_common.image import layer_index
+from tripleo_common.image import tar_split
+from tripleo_common.image import upload_metrics
 from tripleo_common.utils import image as image_utils
 from tripleo_common.utils.locks import threadinglock
 
@@ -64,6 +71,24 @@ CLEANUP = (
     'full', 'partial', 'none'
 )
 
+TRANSFER_ENGINES = (
+    TRANSFER_ENGINE_POOL, TRANSFER_ENGINE_SHARED
+) = (
+    'pool', 'shared'
+)
+
+REGISTRY_TLS = (
+    REGISTRY_TLS_SECURE, REGISTRY_TLS_NO_VERIFY, REGISTRY_TLS_INSECURE
+) = (
+    'secure', 'no-verify', 'insecure'
+)
+
+REGISTRY_TARGETS = (
+    REGISTRY_TARGET_PUSH, REGISTRY_TARGET_EXPORT
+) = (
+    'push', 'export'
+)
+
 CALL_TYPES = (
     CALL_PING,
     CALL_MANIFEST,
@@ -104,6 +129,36 @@ MEDIA_TYPES = (
 
 DEFAULT_UPLOADER = 'python'
 
+# Number of times a chunked layer upload is resumed before starting over
+UPLOAD_RESUME_ATTEMPTS = 5
+
+# Layers larger than this are downloaded as concurrent Range segments
+LAYER_SEGMENT_THRESHOLD = 64 * 1024 * 1024
+LAYER_SEGMENT_SIZE = 16 * 1024 * 1024
+LAYER_SEGMENT_WORKERS = 4
+# Each segment is streamed in chunks of this size, and at most
+# LAYER_SEGMENT_BUFFER chunks of a segment are held until yielded
+LAYER_SEGMENT_CHUNK_SIZE = 256 * 1024
+LAYER_SEGMENT_BUFFER = 4
+
+# Lifetime assumed for bearer tokens which do not state expires_in, as
+# specified by the docker token authentication spec
+DEFAULT_TOKEN_EXPIRES_IN = 60
+
+# Cached tokens are refreshed once this fraction of their lifetime is spent
+TOKEN_REFRESH_RATIO = 0.75
+
+# Default number of keep-alive connections kept per registry host
+DEFAULT_POOL_MAXSIZE = 24
+
+# Seconds the probed capabilities of a registry are trusted for
+REGISTRY_CACHE_TTL = 24 * 60 * 60
+
+# Number of registries probed at the same time
+REGISTRY_PROBE_WORKERS = 8
+
+CONTAINERS_STORAGE_DIR = '/var/lib/containers/storage'
+
 
 def get_undercloud_registry():
     ctlplane_hostname = '.'.join([socket.gethostname().split('.')[0],
@@ -124,6 +179,32 @@ def get_undercloud_registry():
     return '%s:%s' % (address, '8787')
 
 
+class SharedHTTPAdapter(HTTPAdapter):
+    """HTTP adapter shared by every session created in a process
+
+    Sessions are closed by their users once a task is done, which would
+    drop the keep-alive connections every other session is still using.
+    The connection pools of a shared adapter live as long as the process.
+
+    Every request also holds a slot of the adaptive limiter of its registry
+    host until the response headers arrive, so all code paths talking to a
+    host share one limit of requests in flight and one backoff when the
+    host answers 429 or 503.
+    """
+    def send(self, request, **kwargs):
+        host = parse.urlparse(request.url).netloc
+        with image_transfer.registry_limiter(host).slot() as record:
+            start = time.time()
+            resp = super(SharedHTTPAdapter, self).send(request, **kwargs)
+            record(status_code=resp.status_code,
+                   latency=time.time() - start,
+                   retry_after=resp.headers.get('Retry-After'))
+        return resp
+
+    def close(self):
+        pass
+
+
 class MakeSession(object):
     """Class method to uniformly create sessions.
 
@@ -133,19 +214,50 @@ class MakeSession(object):
     404. This is being done because registries commonly return 401 when an
     image is not found, which is commonly a cache miss. See the adapter
     definitions for more on retry details.
+
+    All sessions of a process share one adapter, so connections to a
+    registry are kept alive between sessions. Its pools are sized with
+    init_pool to the number of concurrent requests expected per registry.
     """
+    pool_maxsize = DEFAULT_POOL_MAXSIZE
+    _adapter = None
+    _adapter_pid = None
+    _adapter_lock = threading.Lock()
+
     def __init__(self, verify=True):
         self.session = requests.Session()
         self.session.verify = verify
-        adapter = HTTPAdapter(
-            max_retries=8,
-            pool_connections=24,
-            pool_maxsize=24,
-            pool_block=False
-        )
+        adapter = self.shared_adapter()
         self.session.mount('http://', adapter)
         self.session.mount('https://', adapter)
 
+    @classmethod
+    def init_pool(cls, maxsize=DEFAULT_POOL_MAXSIZE):
+        """Size the keep-alive pools of the shared adapter
+
+        :param: maxsize: number of connections kept per registry host
+        """
+        with cls._adapter_lock:
+            cls.pool_maxsize = max(maxsize, 1)
+            cls._adapter = None
+
+    @classmethod
+    def shared_adapter(cls):
+        # connections must not be shared with forked worker processes
+        pid = os.getpid()
+        with cls._adapter_lock:
+            if cls._adapter is None or cls._adapter_pid != pid:
+                cls._adapter = SharedHTTPAdapter(
+                    # 429 and 503 are left to the registry limiter, which
+                    # holds back every request to the host, not just this
+                    max_retries=Retry(8, respect_retry_after_header=False),
+                    pool_connections=24,
+                    pool_maxsize=cls.pool_maxsize,
+                    pool_block=False
+                )
+                cls._adapter_pid = pid
+            return cls._adapter
+
     def create(self):
         return self.__enter__()
 
@@ -156,6 +268,46 @@ class MakeSession(object):
         self.session.close()
 
 
+class UploadedLayersView(object):
+    """Read only view of the layers processed by every upload worker
+
+    Layers are looked up one at a time, first in the manager dict shared
+    by the worker processes of a ProcessLock, then in the layers of this
+    process, so a lookup costs a single request to the manager and never
+    copies the whole view. Use copy() to take a snapshot of all layers.
+
+    :param: local: dict of the layers processed by this process
+    :param: shared: dict proxy of the layers of every process, if any
+    """
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+
+    def get(self, layer, default=None):
+        if self.shared is not None:
+            value = self.shared.get(layer)
+            if value is not None:
+                return value
+        return self.local.get(layer, default)
+
+    def __getitem__(self, layer):
+        value = self.get(layer)
+        if value is None:
+            raise KeyError(layer)
+        return value
+
+    def __contains__(self, layer):
+        return self.get(layer) is not None
+
+    def copy(self):
+        """Return a dict with every layer of the view"""
+        view = self.local.copy()
+        if self.shared is not None:
+            view.update(self.shared.copy())
+        return view
+
+
 class RegistrySessionHelper(object):
     """ Class with various registry session helpers
 
@@ -251,9 +403,24 @@ class RegistrySessionHelper(object):
 
         request.raise_for_status()
 
+    @staticmethod
+    def refresh_token(session):
+        """Re-authenticate a session before its token expires
+
+        Long running sessions, such as those shared by the layer transfers
+        of a task, would otherwise only notice an expired token when a
+        request fails with a 401.
+        """
+        refresh_at = getattr(session, 'auth_refresh_at', None)
+        if not isinstance(refresh_at, float) or time.time() < refresh_at:
+            return
+        if hasattr(session, 'reauthenticate'):
+            LOG.debug('Refreshing token before it expires')
+            session.reauthenticate(**session.auth_args)
+
     @staticmethod
     def check_redirect_trusted(request_response, request_session,
-                               stream=True, timeout=30):
+                               stream=True, timeout=30, headers=None):
         """Check if we've been redirected to a trusted source
 
         Because we may be using auth, we may not want to leak authentication
@@ -267,6 +434,7 @@ class RegistrySessionHelper(object):
         :param: request_session: Session to use when redirecting
         :param: stream: Should we stream the response of the redirect
         :param: tiemout: Timeout for the redirect request
+        :param: headers: Extra headers for the redirect request, such as Range
         """
         # we're not a redirect, just return the original response
         if not (request_response.status_code >= 300
@@ -276,6 +444,9 @@ class RegistrySessionHelper(object):
         redir_url = parse.urlparse(request_response.headers['Location'])
         # close the response since we're going to replace it
         request_response.close()
+        get_kwargs = {'stream': stream, 'timeout': timeout}
+        if headers:
+            get_kwargs['headers'] = headers
         auth_header = request_session.headers.pop('Authorization', None)
         # ok we got a redirect, let's check where we are going
         if len([h for h in SECURE_REGISTRIES if h in redir_url.netloc]) > 0:
@@ -283,14 +454,12 @@ class RegistrySessionHelper(object):
             # return response
             request_session.headers.update({'Authorization': auth_header})
             request_response = request_session.get(redir_url.geturl(),
-                                                   stream=stream,
-                                                   timeout=timeout)
+                                                   **get_kwargs)
         else:
             # we didn't trust the place we're going, request without auth but
             # add the auth back to the request session afterwards
             request_response = request_session.get(redir_url.geturl(),
-                                                   stream=stream,
-                                                   timeout=timeout)
+                                                   **get_kwargs)
             request_session.headers.update({'Authorization': auth_header})
 
         request_response.encoding = 'utf-8'
@@ -301,12 +470,15 @@ class RegistrySessionHelper(object):
         return request_response
 
     @staticmethod
-    @tenacity.retry(  # Retry up to 5 times with longer time for rate limit
+    @tenacity.retry(  # Retry up to 5 times when rate limited
+        before=upload_metrics.count_retry,
         reraise=True,
         retry=tenacity.retry_if_exception_type(
             ImageRateLimitedException
         ),
-        wait=tenacity.wait_random_exponential(multiplier=1.5, max=60),
+        # the registry limiter already holds every request to the host back
+        # for the Retry-After time, or its own backoff
+        wait=tenacity.wait_random(0, 1),
         stop=tenacity.stop_after_attempt(5)
     )
     def _action(action, request_session, *args, **kwargs):
@@ -318,6 +490,7 @@ class RegistrySessionHelper(object):
         fails with a 401.
         """
         _action = getattr(request_session, action)
+        RegistrySessionHelper.refresh_token(request_session)
         try:
             req = _action(*args, **kwargs)
             RegistrySessionHelper.check_status(session=request_session,
@@ -394,7 +567,10 @@ class ImageUploadManager(BaseImageManager):
     def __init__(self, config_files=None,
                  cleanup=CLEANUP_FULL,
                  mirrors=None, registry_credentials=None,
-                 multi_arch=False, lock=None):
+                 multi_arch=False, lock=None,
+                 transfer_engine=TRANSFER_ENGINE_POOL,
+                 layer_index_path=None, inspect_cache_path=None,
+                 layer_cache_path=None, modify_batch_size=0):
         if config_files is None:
             config_files = []
         super(ImageUploadManager, self).__init__(config_files)
@@ -403,6 +579,21 @@ class ImageUploadManager(BaseImageManager):
             'python': PythonImageUploader()
         }
         self.uploaders['python'].init_global_state(lock)
+        self.uploaders['python'].init_token_cache(lock)
+        if transfer_engine not in TRANSFER_ENGINES:
+            raise ImageUploaderException(
+                'Unknown transfer engine %s' % transfer_engine)
+        engine = None
+        if transfer_engine == TRANSFER_ENGINE_SHARED:
+            engine = image_transfer.TransferEngine()
+            MakeSession.init_pool(engine.max_workers)
+        else:
+            MakeSession.init_pool()
+        self.uploaders['python'].init_transfer_engine(engine)
+        self.uploaders['python'].init_layer_index(layer_index_path)
+        self.uploaders['python'].init_inspect_cache(inspect_cache_path)
+        self.uploaders['python'].init_local_layer_cache(layer_cache_path)
+        self.uploaders['python'].init_modify_batch(modify_batch_size)
         self.cleanup = cleanup
         if mirrors:
             for uploader in self.uploaders.values():
@@ -476,6 +667,11 @@ class ImageUploadManager(BaseImageManager):
 
             # This updates the parsed upload_images dict with real values
             item['push_destination'] = push_destination
+            extra_push_destinations = None
+            if isinstance(push_destination, list):
+                # the image is fetched once and pushed to every destination
+                push_destination, extra_push_destinations = (
+                    push_destination[0], push_destination[1:])
             append_tag = item.get('modify_append_tag')
             modify_role = item.get('modify_role')
             modify_vars = item.get('modify_vars')
@@ -485,20 +681,15 @@ class ImageUploadManager(BaseImageManager):
             tasks.append(UploadTask(
                 image_name, pull_source, push_destination,
                 append_tag, modify_role, modify_vars,
-                self.cleanup, multi_arch))
-
-        # NOTE(mwhahaha): We want to randomize the upload process because of
-        # the shared nature of container layers. Because we multiprocess the
-        # handling of containers, if performed in an alphabetical order (the
-        # default) we end up duplicating fetching of container layers. Things
-        # Like cinder-volume and cinder-backup share almost all of the same
-        # layers so when they are fetched at the same time, we will duplicate
-        # the processing. By randomizing the list we will reduce the amount
-        # of duplicating that occurs. In my testing I went from ~30mins to
-        # ~20mins to run. In the future this could be improved if we added
-        # some locking to the container fetching based on layer hashes but
-        # will require a significant rewrite.
-        random.shuffle(tasks)
+                self.cleanup, multi_arch,
+                extra_push_destinations=extra_push_destinations))
+
+        # NOTE(mwhahaha): Images like cinder-volume and cinder-backup share
+        # almost all of the same layers. The python uploader runs a planning
+        # pass over all tasks before uploading (see
+        # PythonImageUploader._schedule_shared_layers) so that each shared
+        # layer is fetched exactly once and then mounted or linked into
+        # every other image which references it.
         for task in tasks:
             uploader.add_upload_task(task)
 
@@ -516,6 +707,16 @@ class BaseImageUploader(object):
     secure_registries = set(SECURE_REGISTRIES)
     export_registries = set()
     push_registries = set()
+    # inspect results keyed by registry/repo:tag, revalidated on use
+    inspect_cache = {}
+    inspect_cache_path = None
+    # authorization headers keyed by registry, scope and user, shared
+    # between processes when a ProcessLock is used
+    token_cache = {}
+    # probed capabilities keyed by registry, trusted for registry_cache_ttl
+    registry_cache = {}
+    registry_cache_path = None
+    registry_cache_ttl = REGISTRY_CACHE_TTL
 
     def __init__(self):
         self.upload_tasks = []
@@ -534,6 +735,210 @@ class BaseImageUploader(object):
         cls.mirrors.clear()
         cls.export_registries.clear()
         cls.push_registries.clear()
+        cls.registry_cache.clear()
+        cls.registry_cache_path = None
+
+    @classmethod
+    def init_registry_cache(cls, path=None, ttl=REGISTRY_CACHE_TTL):
+        """Load the registry capabilities persisted at path
+
+        The TLS mode, push or export support and authentication challenge
+        of every probed registry are cached for ttl seconds, and kept
+        between runs with a path. An entry probed through a different
+        mirror than the one configured now is not used. The cache is left
+        as it is when path is the one already loaded, or None.
+        """
+        cls.registry_cache_ttl = ttl
+        if not path or path == cls.registry_cache_path:
+            return
+        cls.registry_cache.clear()
+        cls.registry_cache_path = path
+        if not os.path.isfile(path):
+            return
+        try:
+            with open(path) as f:
+                cls.registry_cache.update(json.load(f))
+        except (IOError, ValueError) as e:
+            LOG.warning('Ignoring unreadable registry cache %s: %s' %
+                        (path, e))
+
+    @classmethod
+    def _save_registry_cache(cls):
+        path = cls.registry_cache_path
+        if not path:
+            return
+        # keep what other processes saved since the cache was loaded
+        saved = {}
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            pass
+        for netloc, entry in cls.registry_cache.items():
+            old = saved.get(netloc)
+            if old and old.get('mirror') == entry.get('mirror'):
+                saved[netloc] = dict(old, **entry)
+            else:
+                saved[netloc] = entry
+        now = time.time()
+        saved = dict((k, v) for k, v in saved.items()
+                     if now - v.get('time', 0) < cls.registry_cache_ttl)
+        try:
+            image_export.make_dir(os.path.dirname(os.path.abspath(path)))
+            image_export.write_atomic(path, json.dumps(
+                saved, sort_keys=True).encode('utf-8'))
+        except (IOError, OSError) as e:
+            LOG.warning('Unable to save registry cache %s: %s' % (path, e))
+
+    @classmethod
+    def _registry_entry(cls, netloc):
+        entry = cls.registry_cache.get(netloc)
+        if not entry or entry.get('mirror') != cls.mirrors.get(netloc):
+            return None
+        if time.time() - entry.get('time', 0) >= cls.registry_cache_ttl:
+            return None
+        return entry
+
+    @classmethod
+    def _registry_capability(cls, netloc, key):
+        """Return a cached capability of a registry, or None"""
+        entry = cls._registry_entry(netloc)
+        return entry.get(key) if entry else None
+
+    @classmethod
+    def _record_registry_capability(cls, netloc, **capabilities):
+        entry = cls._registry_entry(netloc)
+        if entry:
+            entry = dict(entry, **capabilities)
+        else:
+            entry = dict(capabilities, mirror=cls.mirrors.get(netloc),
+                         time=time.time())
+        cls.registry_cache[netloc] = entry
+
+    @classmethod
+    def _forget_registry_capability(cls, netloc, key):
+        entry = cls.registry_cache.get(netloc)
+        if entry and key in entry:
+            entry = dict(entry)
+            del entry[key]
+            cls.registry_cache[netloc] = entry
+
+    @classmethod
+    def init_token_cache(cls, lock=None):
+        """Share cached tokens between the processes using lock
+
+        A ProcessLock provides a manager dict which every worker process
+        reads and updates. Otherwise tokens are cached per process.
+        """
+        cache = getattr(lock, '_token_cache', None)
+        if cache is not None:
+            BaseImageUploader.token_cache = cache
+
+    @staticmethod
+    def _token_cache_key(netloc, scope, username=None):
+        return '%s|%s|%s' % (netloc, scope, username or '')
+
+    @classmethod
+    def _cached_token(cls, key):
+        """Return the cached (auth_header, refresh_at) unless it is due
+
+        A refresh_at of None means the entry does not expire, which is the
+        case for basic auth and registries without authentication.
+        """
+        entry = cls.token_cache.get(key)
+        if not entry:
+            return None
+        auth_header, refresh_at = entry
+        if refresh_at is not None and time.time() >= refresh_at:
+            return None
+        return auth_header, refresh_at
+
+    @classmethod
+    def _forget_token(cls, key, auth_header):
+        """Drop a cached token which the registry rejected
+
+        Another session may already have replaced it with a fresh token,
+        which is kept.
+        """
+        entry = cls.token_cache.get(key)
+        if entry and entry[0] == auth_header:
+            cls.token_cache.pop(key, None)
+
+    @classmethod
+    def init_inspect_cache(cls, path=None):
+        """Load the inspect cache persisted at path
+
+        Inspect results are always cached for the life of the process. With
+        a path they are also kept between runs. The cache is left as it is
+        when path is the one already loaded, or None.
+        """
+        if not path or path == cls.inspect_cache_path:
+            return
+        cls.inspect_cache.clear()
+        cls.inspect_cache_path = path
+        if not os.path.isfile(path):
+            return
+        try:
+            with open(path) as f:
+                cls.inspect_cache.update(json.load(f))
+        except (IOError, ValueError) as e:
+            LOG.warning('Ignoring unreadable inspect cache %s: %s' %
+                        (path, e))
+
+    @classmethod
+    def _save_inspect_cache(cls):
+        path = cls.inspect_cache_path
+        if not path:
+            return
+        try:
+            image_export.make_dir(os.path.dirname(os.path.abspath(path)))
+            image_export.write_atomic(path, json.dumps(
+                dict(cls.inspect_cache), sort_keys=True).encode('utf-8'))
+        except (IOError, OSError) as e:
+            LOG.warning('Unable to save inspect cache %s: %s' % (path, e))
+
+    @classmethod
+    def _inspect_cache_key(cls, image_url):
+        return '%s%s' % (image_url.netloc, image_url.path)
+
+    @classmethod
+    def _forget_inspect(cls, image_url):
+        return cls.inspect_cache.pop(
+            cls._inspect_cache_key(image_url), None) is not None
+
+    @classmethod
+    def _inspect_cached(cls, image_url, session):
+        """Return the cached inspect result if the manifest is unchanged
+
+        The manifest is revalidated with a conditional HEAD request, a
+        changed digest or any error means the image is inspected again.
+        """
+        entry = cls.inspect_cache.get(cls._inspect_cache_key(image_url))
+        if not entry or session is None:
+            return None
+        image, tag = cls._image_tag_from_url(image_url)
+        manifest_url = cls._build_url(
+            image_url, CALL_MANIFEST % {'image': image, 'tag': tag})
+        digest = entry['Digest']
+        try:
+            r = session.head(
+                manifest_url,
+                headers={
+                    'Accept': MEDIA_MANIFEST_V2,
+                    'If-None-Match': '"%s"' % digest
+                },
+                timeout=30
+            )
+        except requests.exceptions.RequestException as e:
+            LOG.debug('[%s] Inspect cache revalidation failed: %s' %
+                      (image, e))
+            return None
+        if r.status_code == 304 or (
+                r.status_code == 200 and
+                r.headers.get('Docker-Content-Digest') == digest):
+            LOG.debug('[%s] Using cached inspect for %s' % (image, tag))
+            return dict(entry)
+        return None
 
     def cleanup(self):
         pass
@@ -549,6 +954,7 @@ class BaseImageUploader(object):
         return username, password
 
     @classmethod
+    @upload_metrics.timed('modify')
     def run_modify_playbook(cls, modify_role, modify_vars,
                             source_image, target_image, append_tag,
                             container_build_tool='buildah'):
@@ -599,6 +1005,106 @@ class BaseImageUploader(object):
             raise ImageUploaderException(
                 'Modifying image %s failed' % target_image)
 
+    @classmethod
+    @upload_metrics.timed('modify_batch')
+    def run_modify_playbook_batch(cls, tasks, forks=None,
+                                  container_build_tool='buildah'):
+        """Run the modify roles of many upload tasks in one playbook
+
+        Every task is a host of the inventory, connecting locally, with the
+        variables run_modify_playbook would pass to its role. Tasks with the
+        same role and variable names share a play, and up to forks images
+        are modified at the same time. A failing image does not stop the
+        others.
+
+        :param: tasks: UploadTask objects with a modify_role
+        :param: forks: number of images modified at the same time, defaults
+                       to the number of tasks
+        :returns: list of the tasks which were modified successfully
+        """
+        if not tasks:
+            return []
+        work_dir = tempfile.mkdtemp(prefix='tripleo-modify-image-playbook-')
+        status_dir = os.path.join(work_dir, 'modified')
+        os.mkdir(status_dir)
+        hosts = collections.OrderedDict()
+        inventory = {}
+        plays = collections.OrderedDict()
+        for i, t in enumerate(tasks):
+            host = 'image_%i' % i
+            hosts[host] = t
+            run_vars = {}
+            if t.modify_vars:
+                run_vars.update(t.modify_vars)
+            run_vars['source_image'] = t.target_image_source_tag
+            run_vars['target_image'] = t.target_image_source_tag
+            run_vars['modified_append_tag'] = t.append_tag
+            run_vars['container_build_tool'] = container_build_tool
+            play_key = (t.modify_role, tuple(sorted(run_vars)))
+            if play_key not in plays:
+                plays[play_key] = 'modify_%i' % len(plays)
+            group = inventory.setdefault(plays[play_key], {'hosts': {}})
+            group['hosts'][host] = {
+                'ansible_connection': 'local',
+                'ansible_python_interpreter': '{{ ansible_playbook_python }}',
+                'tripleo_modify_vars': run_vars,
+            }
+        LOG.info('Batch inventory: \n%s' % yaml.safe_dump(
+            inventory, default_flow_style=False))
+
+        playbook = []
+        for (modify_role, var_names), group in plays.items():
+            playbook.append({
+                'hosts': group,
+                'gather_facts': 'no',
+                'strategy': 'free',
+                'tasks': [{
+                    'name': 'Import role %s' % modify_role,
+                    'import_role': {
+                        'name': modify_role
+                    },
+                    'vars': dict(
+                        (k, '{{ tripleo_modify_vars[%r] }}' % str(k))
+                        for k in var_names)
+                }, {
+                    'name': 'Record modified image',
+                    'file': {
+                        'path': os.path.join(
+                            status_dir, '{{ inventory_hostname }}'),
+                        'state': 'touch'
+                    }
+                }]
+            })
+        LOG.info('Playbook: \n%s' % yaml.safe_dump(
+            playbook, default_flow_style=False))
+        try:
+            action = ansible.AnsiblePlaybookAction(
+                playbook=playbook,
+                inventory=inventory,
+                forks=forks or len(tasks),
+                work_dir=work_dir,
+                verbosity=1,
+                extra_env_variables=dict(os.environ),
+                override_ansible_cfg=(
+                    "[defaults]\n"
+                    "stdout_callback=yaml\n"
+                )
+            )
+            result = action.run(None)
+            log_path = result.get('log_path')
+            if log_path and os.path.isfile(log_path):
+                with open(log_path) as f:
+                    for line in f:
+                        LOG.info(line.rstrip())
+        except processutils.ProcessExecutionError as e:
+            LOG.error('%s\nError running playbook in directory: %s'
+                      % (e.stdout, work_dir))
+        modified = [t for host, t in hosts.items()
+                    if os.path.exists(os.path.join(status_dir, host))]
+        if len(modified) == len(tasks):
+            shutil.rmtree(work_dir)
+        return modified
+
     @classmethod
     def _images_match(cls, image1, image2, session1=None):
         try:
@@ -636,7 +1142,9 @@ class BaseImageUploader(object):
         else:
             return True
 
+    @upload_metrics.timed('authenticate')
     @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
+        before=upload_metrics.count_retry,
         reraise=True,
         retry=tenacity.retry_if_exception_type(
             requests.exceptions.RequestException
@@ -646,20 +1154,60 @@ class BaseImageUploader(object):
     )
     def authenticate(self, image_url, username=None, password=None,
                      session=None):
+        """Return a session authenticated for pulling image_url
+
+        Tokens are cached per registry, repository scope and user until
+        they are due for refresh, so a new session for the same repository
+        does not need to request one again. A session is only passed in to
+        re-authenticate it after its token was rejected or is expiring.
+        """
         netloc = image_url.netloc
         image, tag = self._image_tag_from_url(image_url)
         self.is_insecure_registry(registry_host=netloc)
         url = self._build_url(image_url, path='/')
         verify = (netloc not in self.no_verify_registries)
+        scope = 'repository:%s:pull' % image[1:]
+        cache_key = self._token_cache_key(netloc, scope, username)
         if not session:
             session = MakeSession(verify=verify).create()
         else:
-            session.headers.pop('Authorization', None)
+            self._forget_token(
+                cache_key, session.headers.pop('Authorization', None))
             session.verify = verify
 
+        cached = self._cached_token(cache_key)
+        upload_metrics.METRICS.add_dedup('token', bool(cached))
+        if cached:
+            auth_header, refresh_at = cached
+            LOG.debug('Using cached authentication for %s' % scope)
+            return self._authenticated_session(
+                session, auth_header, refresh_at, image_url, username,
+                password)
+
+        # only challenges are cached, an open registry is pinged again
+        # since its sessions could not recover if it started requiring
+        # authentication
+        challenge = self._registry_capability(netloc, 'auth')
+        if challenge:
+            try:
+                auth_header, refresh_at = self._request_token(
+                    session, url, challenge, scope, username, password)
+            except requests.exceptions.RequestException as e:
+                # the authentication of the registry may have changed
+                LOG.debug('Cached authentication challenge of %s failed: '
+                          '%s' % (netloc, e))
+                self._forget_registry_capability(netloc, 'auth')
+                return self.authenticate(image_url, username, password,
+                                         session)
+            self.token_cache[cache_key] = (auth_header, refresh_at)
+            return self._authenticated_session(
+                session, auth_header, refresh_at, image_url, username,
+                password)
+
         r = session.get(url, timeout=30)
         LOG.debug('%s status code %s' % (url, r.status_code))
         if r.status_code == 200:
+            self.token_cache[cache_key] = (None, None)
             return session
         if r.status_code != 401:
             r.raise_for_status()
@@ -667,9 +1215,24 @@ class BaseImageUploader(object):
             raise ImageUploaderException(
                 'Unknown authentication method for headers: %s' % r.headers)
 
-        auth = None
         www_auth = r.headers['www-authenticate']
+        auth_header, refresh_at = self._request_token(
+            session, url, www_auth, scope, username, password)
+        self._record_registry_capability(netloc, auth=www_auth)
+        self.token_cache[cache_key] = (auth_header, refresh_at)
+        return self._authenticated_session(
+            session, auth_header, refresh_at, image_url, username, password)
+
+    @staticmethod
+    def _request_token(session, url, www_auth, scope, username, password):
+        """Answer the www-authenticate challenge of a registry
+
+        :returns: tuple of the Authorization header and the time it is due
+                  for refresh, or None
+        """
+        auth = None
         token_param = {}
+        refresh_at = None
 
         if www_auth.startswith('Bearer '):
             LOG.debug('Using bearer token auth')
@@ -677,15 +1240,19 @@ class BaseImageUploader(object):
             if 'service=' in www_auth:
                 token_param['service'] = re.search(
                     'service="(.*?)"', www_auth).group(1)
-            token_param['scope'] = 'repository:%s:pull' % image[1:]
+            token_param['scope'] = scope
 
             if username:
                 auth = requests_auth.HTTPBasicAuth(username, password)
             LOG.debug('Token parameters: params {}'.format(token_param))
+            issued = time.time()
             rauth = session.get(realm, params=token_param, auth=auth,
                                 timeout=30)
             rauth.raise_for_status()
-            auth_header = 'Bearer %s' % rauth.json()['token']
+            token = rauth.json()
+            auth_header = 'Bearer %s' % token['token']
+            expires_in = token.get('expires_in') or DEFAULT_TOKEN_EXPIRES_IN
+            refresh_at = issued + expires_in * TOKEN_REFRESH_RATIO
         elif www_auth.startswith('Basic '):
             LOG.debug('Using basic auth')
             if not username or not password:
@@ -707,8 +1274,15 @@ class BaseImageUploader(object):
                 hash_request_id.hexdigest()
             )
         )
+        return auth_header, refresh_at
+
+    def _authenticated_session(self, session, auth_header, refresh_at,
+                               image_url, username, password):
+        if not auth_header:
+            return session
         session.headers['Authorization'] = auth_header
 
+        setattr(session, 'auth_refresh_at', refresh_at)
         setattr(session, 'reauthenticate', self.authenticate)
         setattr(
             session,
@@ -767,7 +1341,9 @@ class BaseImageUploader(object):
         return image, tag
 
     @classmethod
+    @upload_metrics.timed('inspect')
     @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
+        before=upload_metrics.count_retry,
         reraise=True,
         retry=tenacity.retry_if_exception_type(
             requests.exceptions.RequestException
@@ -776,6 +1352,10 @@ class BaseImageUploader(object):
         stop=tenacity.stop_after_attempt(5)
     )
     def _inspect(cls, image_url, session=None, default_tag=False):
+        cached = cls._inspect_cached(image_url, session)
+        if cached:
+            return cached
+
         image, tag = cls._image_tag_from_url(image_url)
         parts = {
             'image': image,
@@ -861,7 +1441,7 @@ class BaseImageUploader(object):
         architecture = config['architecture']
         image_os = config['os']
 
-        return {
+        inspected = {
             'Name': name,
             'Tag': tag,
             'Digest': digest,
@@ -873,6 +1453,12 @@ class BaseImageUploader(object):
             'Os': image_os,
             'Layers': layers,
         }
+        if parts['tag'] == tag:
+            # results for a default tag stand in for another tag, so they
+            # can't be revalidated against the requested one
+            cls.inspect_cache[cls._inspect_cache_key(image_url)] = dict(
+                inspected)
+        return inspected
 
     def list(self, registry, session=None):
         self.is_insecure_registry(registry_host=registry)
@@ -912,6 +1498,53 @@ class BaseImageUploader(object):
         image_url = self._image_to_url(image)
         return self._inspect(image_url, session)
 
+    def _authenticate_image(self, image_url):
+        username, password = self.credentials_for_registry(image_url.netloc)
+        try:
+            return self.authenticate(
+                image_url, username=username, password=password)
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code == 401:
+                raise ImageUploaderException(
+                    'Unable to authenticate. This may indicate '
+                    'missing registry credentials or the provided '
+                    'container or namespace does not exist. %s' % e)
+            raise
+
+    def inspect_many(self, images, default_tag=False):
+        """Inspect images, sharing one session per repository
+
+        Images are grouped by registry and repository so every tag of a
+        repository is inspected with a single authenticated session, as
+        the registry token is scoped to the repository.
+
+        :param images: list of image references
+        :param default_tag: use the last tag of a repository when the
+                            image tag does not exist
+        :returns: dict of image reference to inspect result
+        """
+        repos = collections.OrderedDict()
+        for image in images:
+            image_url = self._image_to_url(image)
+            repo = image_url.path.split('@')[0].split(':')[0]
+            repos.setdefault((image_url.netloc, repo), []).append(
+                (image, image_url))
+
+        def inspect_repo(entries):
+            session = self._authenticate_image(entries[0][1])
+            try:
+                return [(image, self._inspect(image_url, session=session,
+                                              default_tag=default_tag))
+                        for image, image_url in entries]
+            finally:
+                session.close()
+
+        inspected = {}
+        with futures.ThreadPoolExecutor(max_workers=16) as p:
+            for results in p.map(inspect_repo, repos.values()):
+                inspected.update(results)
+        return inspected
+
     def delete(self, image, session=None):
         image_url = self._image_to_url(image)
         return self._delete(image_url, session)
@@ -922,6 +1555,7 @@ class BaseImageUploader(object):
 
     @classmethod
     @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
+        before=upload_metrics.count_retry,
         reraise=True,
         retry=tenacity.retry_if_exception_type(
             requests.exceptions.RequestException
@@ -1004,22 +1638,39 @@ class BaseImageUploader(object):
                             default_tag=False):
         image_urls = [self._image_to_url(i) for i in images]
 
-        # prime self.insecure_registries by testing every image
-        for url in image_urls:
-            self.is_insecure_registry(registry_host=url)
+        # prime self.insecure_registries by testing every registry
+        self.probe_registries(url.netloc for url in image_urls)
 
-        discover_args = []
-        for image in images:
-            discover_args.append((self, image, tag_from_label,
-                                  default_tag))
+        inspected = self.inspect_many(images, default_tag=default_tag)
 
         versioned_images = {}
-        with futures.ThreadPoolExecutor(max_workers=16) as p:
-            for image, versioned_image in p.map(discover_tag_from_inspect,
-                                                discover_args):
-                versioned_images[image] = versioned_image
+        for image in images:
+            image_url = self._image_to_url(image)
+            try:
+                image_name, versioned_image = self._discover_versioned_image(
+                    inspected[image], image, tag_from_label)
+            except ImageUploaderException:
+                if not self._forget_inspect(image_url):
+                    raise
+                # the cached tags may be out of date, inspect again
+                image_name, versioned_image = discover_tag_from_inspect(
+                    (self, image, tag_from_label, default_tag))
+            versioned_images[image_name] = versioned_image
+        self._save_inspect_cache()
         return versioned_images
 
+    @classmethod
+    def _discover_versioned_image(cls, i, image, tag_from_label):
+        if ':' in cls._image_to_url(image).path:
+            # break out the tag from the url to be the fallback tag
+            path = image.rpartition(':')
+            fallback_tag = path[2]
+            image = path[0]
+        else:
+            fallback_tag = None
+        return image, cls._discover_tag_from_inspect(
+            i, image, tag_from_label, fallback_tag)
+
     def discover_image_tag(self, image, tag_from_label=None,
                            fallback_tag=None, username=None, password=None):
         image_url = self._image_to_url(image)
@@ -1035,6 +1686,14 @@ class BaseImageUploader(object):
                     'container or namespace does not exist. %s' % e)
             raise
 
+        i = self._inspect(image_url, session)
+        try:
+            return self._discover_tag_from_inspect(i, image, tag_from_label,
+                                                   fallback_tag)
+        except ImageUploaderException:
+            if not self._forget_inspect(image_url):
+                raise
+        # the cached tags may be out of date, inspect again
         i = self._inspect(image_url, session)
         return self._discover_tag_from_inspect(i, image, tag_from_label,
                                                fallback_tag)
@@ -1042,9 +1701,9 @@ class BaseImageUploader(object):
     def filter_images_with_labels(self, images, labels,
                                   username=None, password=None):
         images_with_labels = []
+        self.probe_registries(self._image_to_url(i).netloc for i in images)
         for image in images:
             url = self._image_to_url(image)
-            self.is_insecure_registry(registry_host=url.netloc)
             try:
                 session = self.authenticate(
                     url, username=username, password=password)
@@ -1067,6 +1726,7 @@ class BaseImageUploader(object):
                     images_with_labels.append(image)
                     break
 
+        self._save_inspect_cache()
         return images_with_labels
 
     def add_upload_task(self, task):
@@ -1075,20 +1735,18 @@ class BaseImageUploader(object):
                 'Cannot run a modify role on multi-arch image %s' %
                 task.image_name
             )
-        # prime insecure_registries
-        if task.pull_source:
-            self.is_insecure_registry(
-                registry_host=self._image_to_url(task.pull_source).netloc
-            )
-        else:
-            self.is_insecure_registry(
-                registry_host=self._image_to_url(task.image_name).netloc
-            )
-        self.is_insecure_registry(
-            registry_host=self._image_to_url(task.push_destination).netloc
-        )
         self.upload_tasks.append((self, task))
 
+    def probe_task_registries(self):
+        """Prime insecure_registries with the registries of every task"""
+        hosts = []
+        for _, task in self.upload_tasks:
+            hosts.append(self._image_to_url(
+                task.pull_source or task.image_name).netloc)
+            for d in [task.push_destination] + task.extra_push_destinations:
+                hosts.append(self._image_to_url(d).netloc)
+        self.probe_registries(hosts)
+
     @classmethod
     def is_insecure_registry(cls, registry_host):
         if registry_host in cls.secure_registries:
@@ -1096,6 +1754,16 @@ class BaseImageUploader(object):
         if (registry_host in cls.insecure_registries or
                 registry_host in cls.no_verify_registries):
             return True
+        tls = cls._registry_capability(registry_host, 'tls')
+        if tls == REGISTRY_TLS_NO_VERIFY:
+            cls.no_verify_registries.add(registry_host)
+            return True
+        if tls == REGISTRY_TLS_INSECURE:
+            cls.insecure_registries.add(registry_host)
+            return True
+        if tls == REGISTRY_TLS_SECURE:
+            cls.secure_registries.add(registry_host)
+            return False
         with requests.Session() as s:
             try:
                 s.get('https://%s/v2' % registry_host, timeout=30)
@@ -1106,6 +1774,8 @@ class BaseImageUploader(object):
                     s.get('https://%s/v2' % registry_host, timeout=30,
                           verify=False)
                     cls.no_verify_registries.add(registry_host)
+                    cls._record_registry_capability(
+                        registry_host, tls=REGISTRY_TLS_NO_VERIFY)
                     # Techinically these type of registries are insecure when
                     # the container engine tries to do a pull. The python
                     # uploader ignores the certificate problem, but they are
@@ -1115,17 +1785,45 @@ class BaseImageUploader(object):
                 except requests.exceptions.SSLError:
                     # So nope, it's really not a certificate verification issue
                     cls.insecure_registries.add(registry_host)
+                    cls._record_registry_capability(
+                        registry_host, tls=REGISTRY_TLS_INSECURE)
                     return True
             except Exception:
                 # for any other error assume it is a secure registry, because:
                 # - it is secure registry
                 # - the host is not accessible
-                pass
+                # which is not cached past this run, so an unreachable host
+                # is probed again next time
+                cls.secure_registries.add(registry_host)
+                return False
         cls.secure_registries.add(registry_host)
+        cls._record_registry_capability(
+            registry_host, tls=REGISTRY_TLS_SECURE)
         return False
 
     @classmethod
+    def probe_registries(cls, registry_hosts):
+        """Find out the TLS mode of every registry not known yet
+
+        The registries are probed at the same time, so unreachable hosts
+        only hold the run up for one probe timeout. The results are saved
+        to the registry cache.
+
+        :param: registry_hosts: iterable of registry hosts
+        """
+        known = (cls.secure_registries | cls.insecure_registries |
+                 cls.no_verify_registries)
+        hosts = set(h for h in registry_hosts if h and h not in known)
+        if hosts:
+            with futures.ThreadPoolExecutor(
+                    max_workers=REGISTRY_PROBE_WORKERS) as p:
+                list(p.map(cls.is_insecure_registry, hosts))
+        cls._save_registry_cache()
+
+    @classmethod
+    @upload_metrics.timed('cross_repo_mount')
     @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
+        before=upload_metrics.count_retry,
         reraise=True,
         retry=tenacity.retry_if_exception_type(
             requests.exceptions.RequestException
@@ -1267,6 +1965,10 @@ class SkopeoImageUploader(BaseImageUploader):
                 t.source_image_url,
                 t.target_image_url,
             )
+            # the extra destinations are copied from the first one, so the
+            # source is only fetched once
+            for extra_url in t.extra_target_image_urls:
+                self._copy(t.target_image_url, extra_url)
             LOG.warning('[%s] Completed upload for image' % t.image_name)
         for layer in source_layers:
             self.image_layers.setdefault(layer, t.target_image_url)
@@ -1274,6 +1976,7 @@ class SkopeoImageUploader(BaseImageUploader):
 
     @classmethod
     @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
+        before=upload_metrics.count_retry,
         reraise=True,
         wait=tenacity.wait_random_exponential(multiplier=1, max=10),
         stop=tenacity.stop_after_attempt(5)
@@ -1348,6 +2051,7 @@ class SkopeoImageUploader(BaseImageUploader):
         if not self.upload_tasks:
             return
         local_images = []
+        self.probe_task_registries()
 
         # Pull a single image first, to avoid duplicate pulls of the
         # same base layers
@@ -1370,6 +2074,17 @@ class PythonImageUploader(BaseImageUploader):
 
     uploaded_layers = {}  # provides global view for multi-threading workers
     lock = None  # provides global locking info plus global view, if MP is used
+    transfer_engine = None  # shared pool for all layer transfers, if selected
+    layer_index = None  # persistent index of processed layers, if enabled
+    uploaded_manifests = {}  # source manifest digest to target images
+    unverified_layers = set()  # index layers not yet seen in a registry
+    metrics_path = None  # JSON summary of the upload metrics, if set
+    metrics_textfile = None  # Prometheus textfile of the metrics, if set
+    metrics_pid = None  # process which collects the worker metrics
+    local_layer_cache = None  # compressed local layers, if enabled
+    containers_index = {}  # parsed containers-storage layer and image lists
+    modify_batch_size = 0  # modify tasks per batch playbook, if batched
+    modify_forks = None  # images modified at the same time in a batch
 
     @classmethod
     def init_global_state(cls, lock):
@@ -1377,30 +2092,192 @@ class PythonImageUploader(BaseImageUploader):
             cls.lock = lock
 
     @classmethod
-    @tenacity.retry(  # Retry until we no longer have collisions
-        retry=tenacity.retry_if_exception_type(ImageUploaderThreadException),
-        wait=tenacity.wait_random_exponential(multiplier=1, max=10)
-    )
+    def init_transfer_engine(cls, engine):
+        cls.transfer_engine = engine
+
+    @classmethod
+    def init_metrics(cls, path=None, textfile=None):
+        """Start collecting upload metrics
+
+        A summary is logged at the end of every run_tasks. It is also
+        written as JSON to path and in the Prometheus text format to
+        textfile, when they are set.
+        """
+        cls.metrics_path = path
+        cls.metrics_textfile = textfile
+        upload_metrics.METRICS.reset()
+
+    @classmethod
+    def _write_metrics(cls):
+        summary = upload_metrics.METRICS.summary()
+        LOG.info('Upload metrics: %s' % json.dumps(summary, sort_keys=True))
+        outputs = (
+            (cls.metrics_path, lambda: json.dumps(
+                summary, indent=2, sort_keys=True)),
+            (cls.metrics_textfile, upload_metrics.METRICS.prometheus),
+        )
+        for path, render in outputs:
+            if not path:
+                continue
+            try:
+                image_export.write_atomic(path, render().encode('utf-8'))
+            except (IOError, OSError) as e:
+                LOG.warning('Unable to write upload metrics to %s: %s' %
+                            (path, e))
+
+    @classmethod
+    def init_modify_batch(cls, size=0, forks=None):
+        """Run the modify roles of upload tasks in batches
+
+        Instead of one playbook per image, the unmodified images of a batch
+        of modify tasks are pulled, modified by one playbook and pushed.
+        Pulling the next batch and pushing the previous one overlap with
+        the playbook of the current batch.
+
+        :param: size: number of images per batch playbook, 0 to run a
+                      playbook per image
+        :param: forks: number of images modified at the same time, defaults
+                       to the batch size
+        """
+        cls.modify_batch_size = size or 0
+        cls.modify_forks = forks
+
+    @classmethod
+    def init_local_layer_cache(cls, path=None):
+        """Keep compressed local layers in a cache directory
+
+        Layers uploaded from containers-storage, such as the layers of
+        modified images, are then compressed once per layer id instead of
+        once per image. Without a path, a run_tasks where a local layer
+        is uploaded by more than one task uses a temporary cache which is
+        removed when it finishes, other runs stream the layers directly.
+
+        :param: path: directory of the cache
+        """
+        cls.local_layer_cache = tar_split.LayerCache(path) if path else None
+
+    @classmethod
+    def init_layer_index(cls, path):
+        """Load the persistent layer index into the global view
+
+        Locally exported layers are only trusted if their blob file still
+        exists, remote layers are checked in the registry the first time
+        they are hit. Passing no path disables the index, as does a path
+        inside the image-serve directory where it would be published.
+
+        :param: path: file path of the index
+        """
+        cls.layer_index = None
+        cls.uploaded_manifests = {}
+        cls.unverified_layers = set()
+        if not path:
+            return
+        export_dir = os.path.join(image_export.IMAGE_EXPORT_DIR, '')
+        if os.path.abspath(path).startswith(export_dir):
+            LOG.warning('Layer index disabled, %s is served from %s' %
+                        (path, image_export.IMAGE_EXPORT_DIR))
+            return
+        index_dir = os.path.dirname(path)
+        if not os.path.isdir(index_dir):
+            LOG.warning('Layer index disabled, missing directory %s' %
+                        index_dir)
+            return
+        index = layer_index.LayerIndex(path)
+        try:
+            layers, manifests = index.load()
+        except Exception as e:
+            LOG.warning('Layer index disabled, unable to load %s: %s' %
+                        (path, e))
+            return
+
+        known_layers = {}
+        for layer, scopes in layers.items():
+            local = scopes.get('local')
+            if local and not (local.get('path') and
+                              os.path.isfile(local['path'])):
+                scopes.pop('local')
+            if scopes:
+                known_layers[layer] = scopes
+        LOG.info('Loaded %i layers and %i manifests from layer index %s' %
+                 (len(known_layers), len(manifests), path))
+        cls.layer_index = index
+        cls.uploaded_manifests = manifests
+        cls.unverified_layers = set(
+            layer for layer, scopes in known_layers.items()
+            if 'remote' in scopes)
+        if known_layers:
+            cls._global_view_proxy(value=known_layers)
+
+    @classmethod
+    def _run_layer_jobs(cls, name, jobs, hosts):
+        """Run layer copy jobs and wait for all of them to finish
+
+        Without a transfer engine a private pool of 4 threads is used for
+        the jobs of a single image. With a transfer engine the jobs join
+        every other layer transfer on the shared pool, within the transfer
+        budget of the registry hosts involved.
+
+        :param: name: image name used for logging
+        :param: jobs: list of (callable, args, kwargs) tuples
+        :param: hosts: registry hosts the jobs transfer data between
+        """
+        engine = cls.transfer_engine
+        if engine:
+            copy_jobs = [engine.submit(hosts, fn, *args, **kwargs)
+                         for fn, args, kwargs in jobs]
+            cls._wait_layer_jobs(name, copy_jobs)
+            return
+        with futures.ThreadPoolExecutor(max_workers=4) as p:
+            copy_jobs = [p.submit(fn, *args, **kwargs)
+                         for fn, args, kwargs in jobs]
+            cls._wait_layer_jobs(name, copy_jobs)
+
+    @classmethod
+    def _wait_layer_jobs(cls, name, copy_jobs):
+        jobs_count = len(copy_jobs)
+        jobs_finished = 0
+        LOG.debug('[%s] Waiting for %i jobs to finish' %
+                  (name, jobs_count))
+        for job in futures.as_completed(copy_jobs):
+            e = job.exception()
+            if e:
+                raise e
+            layer = job.result()
+            if layer:
+                LOG.debug('[%s] Upload complete for layer %s' %
+                          (name, layer))
+            jobs_finished += 1
+            LOG.debug('[%s] Waiting for next job: %i of %i complete' %
+                      (name, jobs_finished, jobs_count))
+        LOG.debug('[%s] Completed %i jobs' % (name, jobs_count))
+
+    @classmethod
+    def _layer_processed(cls, layer):
+        view = cls._global_view_proxy()
+        entry = view.get(layer) or {}
+        return any(entry.get(scope, {}).get('path') and
+                   entry.get(scope, {}).get('ref')
+                   for scope in ('local', 'remote'))
+
+    @classmethod
     def _layer_fetch_lock(cls, layer):
+        """Hold a layer while this thread fetches it
+
+        A layer which is being fetched by another thread or process is
+        waited for, and its waiters are woken up as soon as it is released.
+        A layer which was processed already is not held.
+        """
         if not cls.lock:
             LOG.warning('No lock information provided for layer %s' % layer)
             return
-        if layer in cls.lock.objects():
-            LOG.debug('[%s] Layer is being fetched by another thread' % layer)
-            raise ImageUploaderThreadException('layer being fetched')
-        known_path, image = image_utils.uploaded_layers_details(
-            cls._global_view_proxy(), layer, scope='local')
-        if not known_path or not image:
-            known_path, image = image_utils.uploaded_layers_details(
-                cls._global_view_proxy(), layer, scope='remote')
-        if image and known_path:
+        if cls._layer_processed(layer):
             # already processed layers needs no further locking
             return
-        with cls.lock.get_lock():
-            if layer in cls.lock.objects():
-                LOG.debug('Collision for lock %s' % layer)
-                raise ImageUploaderThreadException('layer conflict')
-            cls.lock.objects().append(layer)
+        cls.lock.hold_object(layer)
+        if cls._layer_processed(layer):
+            # processed by the holder this thread waited for
+            cls.lock.release_object(layer)
+            return
         LOG.debug('Got lock on layer %s' % layer)
 
     @classmethod
@@ -1408,9 +2285,7 @@ class PythonImageUploader(BaseImageUploader):
         if not cls.lock:
             LOG.warning('No lock information provided for layer %s' % layer)
             return
-        with cls.lock.get_lock():
-            while layer in cls.lock.objects():
-                cls.lock.objects().remove(layer)
+        cls.lock.release_object(layer)
         LOG.debug('Released lock on layer %s' % layer)
 
     @classmethod
@@ -1418,28 +2293,31 @@ class PythonImageUploader(BaseImageUploader):
         if not cls.lock:
             LOG.warning('No lock information provided for value %s' % value)
             return
+        if not value:
+            # return global view consolidated among MP/MT workers state,
+            # entries are looked up one at a time so reads need no lock
+            return UploadedLayersView(
+                cls.uploaded_layers, getattr(cls.lock, '_global_view', None))
+
         with cls.lock.get_lock():
-            if value and forget:
+            if forget:
                 cls.uploaded_layers.pop(value, None)
                 if hasattr(cls.lock, '_global_view'):
                     cls.lock._global_view.pop(value, None)
-            elif value:
+            else:
                 cls.uploaded_layers.update(value)
                 if hasattr(cls.lock, '_global_view'):
                     cls.lock._global_view.update(value)
 
-        if not value:
-            # return global view consolidated among MP/MT workers state
-            if hasattr(cls.lock, '_global_view'):
-                consolidated_view = cls.uploaded_layers.copy()
-                consolidated_view.update(cls.lock._global_view)
-                return consolidated_view
-            else:
-                return cls.uploaded_layers
+    @classmethod
+    def _global_view_snapshot(cls):
+        """Return a dict copy of the global view of uploaded layers"""
+        view = cls._global_view_proxy()
+        return view.copy() if view is not None else None
 
     @classmethod
     def _track_uploaded_layers(cls, layer, known_path=None, image_ref=None,
-                               forget=False, scope='remote'):
+                               forget=False, scope='remote', size=None):
         if forget:
             LOG.debug('Untracking processed layer %s for any scope' % layer)
             cls._global_view_proxy(value=layer, forget=True)
@@ -1448,7 +2326,86 @@ class PythonImageUploader(BaseImageUploader):
                       % (layer, scope))
             cls._global_view_proxy(
                 value={layer: {scope: {'ref': image_ref, 'path': known_path}}})
+            if scope == 'remote':
+                cls.unverified_layers.discard(layer)
+        if not cls.layer_index:
+            return
+        try:
+            if forget:
+                cls.layer_index.forget_layer(layer)
+            else:
+                cls.layer_index.add_layer(layer, scope, path=known_path,
+                                          ref=image_ref, size=size)
+        except Exception as e:
+            LOG.warning('Unable to update layer index for %s: %s' %
+                        (layer, e))
+
+    @staticmethod
+    def _manifest_digest(manifest_str):
+        calc_digest = hashlib.sha256()
+        calc_digest.update(manifest_str.encode('utf-8'))
+        return 'sha256:%s' % calc_digest.hexdigest()
+
+    @classmethod
+    def _target_manifest_digest(cls, target_url, session):
+        """Return the digest of the manifest a target tag points to"""
+        if target_url.netloc in cls.export_registries:
+            return image_export.tag_digest(target_url)
+        image, tag = cls._image_tag_from_url(target_url)
+        manifest_url = cls._build_url(
+            target_url, CALL_MANIFEST % {'image': image, 'tag': tag})
+        r = session.head(
+            manifest_url,
+            headers={'Accept': ', '.join((MEDIA_MANIFEST_V2,
+                                          MEDIA_MANIFEST_V2_LIST))},
+            timeout=30)
+        if r.status_code != 200:
+            return None
+        return r.headers.get('Docker-Content-Digest')
+
+    @classmethod
+    def _index_manifest(cls, manifest_str, target_url, session):
+        if not cls.layer_index:
+            return
+        digest = cls._manifest_digest(manifest_str)
+        image = target_url.netloc + target_url.path
+        try:
+            target_digest = cls._target_manifest_digest(target_url, session)
+        except Exception as e:
+            LOG.warning('Unable to find the manifest digest of %s: %s' %
+                        (image, e))
+            return
+        if not target_digest:
+            return
+        cls.uploaded_manifests.setdefault(digest, {})[image] = target_digest
+        try:
+            cls.layer_index.add_manifest(digest, image, target_digest)
+        except Exception as e:
+            LOG.warning('Unable to update layer index for %s: %s' %
+                        (image, e))
+
+    @classmethod
+    def _manifest_uploaded(cls, manifest_str, target_url, session):
+        """Check whether a source manifest was already copied to a target
+
+        The layer index is checked first, the target is only asked for the
+        tag when the index says the same manifest was copied there before.
+        The tag must still point to the manifest digest recorded then.
+        """
+        if not cls.layer_index:
+            return False
+        digest = cls._manifest_digest(manifest_str)
+        image = target_url.netloc + target_url.path
+        target_digest = cls.uploaded_manifests.get(digest, {}).get(image)
+        if not target_digest:
+            upload_metrics.METRICS.add_dedup('manifest', False)
+            return False
+        uploaded = (cls._target_manifest_digest(target_url, session) ==
+                    target_digest)
+        upload_metrics.METRICS.add_dedup('manifest', uploaded)
+        return uploaded
 
+    @upload_metrics.timed('upload_image')
     def upload_image(self, task):
         """Upload image from a task
 
@@ -1467,16 +2424,98 @@ class PythonImageUploader(BaseImageUploader):
         t = task
         LOG.info('[%s] Starting upload image process' % t.image_name)
 
-        source_local = t.source_image.startswith('containers-storage:')
-        target_image_local_url = parse.urlparse('containers-storage:%s' %
-                                                t.target_image)
-        target_username, target_password = self.credentials_for_registry(
-            t.target_image_url.netloc)
+        state = self._start_upload(t)
+        if state is None:
+            return []
+
+        if not t.modify_role:
+            LOG.info('[%s] Completed upload for image' % t.image_name)
+        else:
+            try:
+                self._pull_unmodified_image(t, state)
+                self.run_modify_playbook(
+                    t.modify_role,
+                    t.modify_vars,
+                    t.target_image_source_tag,
+                    t.target_image_source_tag,
+                    t.append_tag,
+                    container_build_tool='buildah')
+                if t.cleanup == CLEANUP_FULL:
+                    state['cleanup'].append(t.target_image)
+                self._push_modified_image(t, state)
+            except Exception:
+                LOG.error('[%s] Failed processing the target '
+                          'image' % t.target_image)
+                # Close the sessions before raising it for more of
+                # retrying perhaps
+                self._close_sessions(state)
+                raise
+        return self._finish_upload(t, state)
+
+    def pull_modify_image(self, task):
+        """Copy and pull the unmodified image of a batched modify task
+
+        This is the part of upload_image before the modify playbook runs.
+        The playbook is then run for a batch of tasks at once with
+        run_modify_playbook_batch, and push_modify_image completes the
+        upload.
+
+        :param: task: UploadTask with a modify_role
+        :returns: state to pass to push_modify_image, or None if the
+                  modified image needs no upload
+        """
+        LOG.info('[%s] Starting upload image process' % task.image_name)
+        state = self._start_upload(task)
+        if state is None:
+            return None
         try:
-            target_session = self.authenticate(
-                t.target_image_url,
-                username=target_username,
-                password=target_password
+            self._pull_unmodified_image(task, state)
+        except Exception:
+            LOG.error('[%s] Failed processing the target '
+                      'image' % task.target_image)
+            raise
+        finally:
+            self._close_sessions(state)
+        # sessions are not kept, the state may be passed to another process
+        return {
+            'manifests': state['manifests'],
+            'layers': state['layers'],
+            'cleanup': state['cleanup'],
+        }
+
+    def push_modify_image(self, task, state):
+        """Push a modified image, once its batch playbook succeeded
+
+        :param: task: UploadTask with a modify_role
+        :param: state: state returned by pull_modify_image
+        :returns: list of local images to clean up
+        """
+        state = dict(state)
+        state['target_session'] = self._authenticate_upload(
+            task.target_image_url)
+        state['source_session'] = None
+        try:
+            self._detect_target_export(task.target_image_url,
+                                       state['target_session'])
+            state['source_session'] = self._authenticate_upload(
+                task.source_image_url)
+            if task.cleanup == CLEANUP_FULL:
+                state['cleanup'].append(task.target_image)
+            self._push_modified_image(task, state)
+        except Exception:
+            LOG.error('[%s] Failed processing the target '
+                      'image' % task.target_image)
+            self._close_sessions(state)
+            raise
+        return self._finish_upload(task, state)
+
+    def _authenticate_upload(self, image_url):
+        username, password = self.credentials_for_registry(image_url.netloc)
+        try:
+            return self.authenticate(
+                image_url,
+                username=username,
+                password=password
             )
         except requests.exceptions.HTTPError as e:
             if e.response.status_code == 401:
@@ -1486,6 +2525,42 @@ class PythonImageUploader(BaseImageUploader):
                     'container or namespace does not exist. %s' % e)
             raise
 
+    @staticmethod
+    def _close_sessions(state):
+        for key in ('target_session', 'source_session'):
+            if state.get(key):
+                state[key].close()
+        for _, session in state.get('extra_targets') or []:
+            session.close()
+
+    def _open_extra_targets(self, t):
+        """Authenticate to the extra push destinations of a task
+
+        :returns: list of (target_url, session) tuples
+        """
+        targets = []
+        try:
+            for target_url in t.extra_target_image_urls:
+                session = self._authenticate_upload(target_url)
+                targets.append((target_url, session))
+                self._detect_target_export(target_url, session)
+        except Exception:
+            LOG.error('[%s] Failed uploading the target image to %s' %
+                      (t.target_image, target_url.netloc))
+            self._close_sessions({'extra_targets': targets})
+            raise
+        return targets
+
+    def _start_upload(self, t):
+        """Copy the unmodified image of a task to its target registry
+
+        :returns: dict with the open target_session and source_session,
+                  the source manifests and layers and the list of local
+                  images to clean up, or None if the task is complete
+        """
+        source_local = t.source_image.startswith('containers-storage:')
+        target_session = self._authenticate_upload(t.target_image_url)
+
         try:
             self._detect_target_export(t.target_image_url, target_session)
         except Exception:
@@ -1517,7 +2592,7 @@ class PythonImageUploader(BaseImageUploader):
                             'to the target registry' % t.target_image)
                 pass
             target_session.close()
-            return []
+            return None
 
         if t.modify_role:
             image_exists = False
@@ -1532,52 +2607,68 @@ class PythonImageUploader(BaseImageUploader):
                 LOG.warning('[%s] Skipping upload for modified image %s' %
                             (t.image_name, t.target_image))
                 target_session.close()
-                return []
+                return None
             copy_target_url = t.target_image_source_tag_url
         else:
             copy_target_url = t.target_image_url
         # Keep the target session open yet
 
-        source_username, source_password = self.credentials_for_registry(
-            t.source_image_url.netloc)
         try:
-            source_session = self.authenticate(
-                t.source_image_url,
-                username=source_username,
-                password=source_password
-            )
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 401:
-                raise ImageUploaderException(
-                    'Unable to authenticate. This may indicate '
-                    'missing registry credentials or the provided '
-                    'container or namespace does not exist. %s' % e)
+            extra_targets = self._open_extra_targets(t)
+        except Exception:
+            target_session.close()
+            raise
+        try:
+            source_session = self._authenticate_upload(t.source_image_url)
+        except Exception:
+            target_session.close()
+            self._close_sessions({'extra_targets': extra_targets})
             raise
 
         source_layers = []
         manifests_str = []
         try:
-            self._collect_manifests_layers(
-                t.source_image_url, source_session,
-                manifests_str, source_layers,
-                t.multi_arch
-            )
+            if t.source_manifests:
+                # already collected by the layer planning pass
+                manifests_str.extend(t.source_manifests)
+                source_layers.extend(t.source_layers)
+            else:
+                self._collect_manifests_layers(
+                    t.source_image_url, source_session,
+                    manifests_str, source_layers,
+                    t.multi_arch
+                )
 
-            self._cross_repo_mount(
-                copy_target_url, self.image_layers, source_layers,
-                session=target_session)
-            to_cleanup = []
+            targets = [(copy_target_url, target_session)] + extra_targets
+            if not t.modify_role:
+                targets = [(url, session) for url, session in targets
+                           if not self._manifest_uploaded(
+                               manifests_str[0], url, session)]
+            if not targets:
+                LOG.info('[%s] Image already uploaded to %s' %
+                         (t.image_name, t.target_image))
+                source_session.close()
+                target_session.close()
+                self._close_sessions({'extra_targets': extra_targets})
+                return None
+
+            for url, session in targets:
+                self._cross_repo_mount(
+                    url, self.image_layers, source_layers, session=session)
 
-            # Copy unmodified images from source to target
+            # Copy unmodified images from source to every target
             self._copy_registry_to_registry(
                 t.source_image_url,
-                copy_target_url,
+                targets[0][0],
                 source_manifests=manifests_str,
                 source_session=source_session,
-                target_session=target_session,
+                target_session=targets[0][1],
                 source_layers=source_layers,
-                multi_arch=t.multi_arch
+                multi_arch=t.multi_arch,
+                extra_targets=targets[1:]
             )
+            for url, session in targets:
+                self._index_manifest(manifests_str[0], url, session)
         except Exception:
             LOG.error('[%s] Failed uploading the target '
                       'image' % t.target_image)
@@ -1585,64 +2676,68 @@ class PythonImageUploader(BaseImageUploader):
             # retrying perhaps
             source_session.close()
             target_session.close()
+            self._close_sessions({'extra_targets': extra_targets})
             raise
+        return {
+            'target_session': target_session,
+            'source_session': source_session,
+            'extra_targets': extra_targets,
+            'manifests': manifests_str,
+            'layers': source_layers,
+            'cleanup': [],
+        }
 
-        if not t.modify_role:
-            LOG.info('[%s] Completed upload for image' % t.image_name)
-        else:
-            LOG.info('[%s] Copy ummodified image from target to local' %
-                     t.image_name)
-            try:
-                self._copy_registry_to_local(t.target_image_source_tag_url)
-
-                if t.cleanup in (CLEANUP_FULL, CLEANUP_PARTIAL):
-                    to_cleanup.append(t.target_image_source_tag)
+    def _pull_unmodified_image(self, t, state):
+        LOG.info('[%s] Copy ummodified image from target to local' %
+                 t.image_name)
+        self._copy_registry_to_local(t.target_image_source_tag_url)
 
-                self.run_modify_playbook(
-                    t.modify_role,
-                    t.modify_vars,
-                    t.target_image_source_tag,
-                    t.target_image_source_tag,
-                    t.append_tag,
-                    container_build_tool='buildah')
-                if t.cleanup == CLEANUP_FULL:
-                    to_cleanup.append(t.target_image)
+        if t.cleanup in (CLEANUP_FULL, CLEANUP_PARTIAL):
+            state['cleanup'].append(t.target_image_source_tag)
 
-                # cross-repo mount the unmodified image to the modified image
-                self._cross_repo_mount(
-                    t.target_image_url, self.image_layers, source_layers,
-                    session=target_session)
+    def _push_modified_image(self, t, state):
+        target_session = state['target_session']
+        target_image_local_url = parse.urlparse('containers-storage:%s' %
+                                                t.target_image)
+        # cross-repo mount the unmodified image to the modified image
+        self._cross_repo_mount(
+            t.target_image_url, self.image_layers, state['layers'],
+            session=target_session)
 
-                # Copy from local storage to target registry
-                self._copy_local_to_registry(
-                    target_image_local_url,
-                    t.target_image_url,
-                    session=target_session
-                )
-                LOG.info('[%s] Completed modify and upload for image' %
-                         t.image_name)
-            except Exception:
-                LOG.error('[%s] Failed processing the target '
-                          'image' % t.target_image)
-                # Close the sessions before raising it for more of
-                # retrying perhaps
-                source_session.close()
-                target_session.close()
-                raise
+        # Copy from local storage to target registry, reusing the
+        # compressed source layers the playbook did not change
+        try:
+            source_diff_layers = self._source_layers_by_diff_id(
+                t.source_image_url, state['manifests'],
+                state['source_session'])
+        except Exception as e:
+            LOG.warning('[%s] Unable to map the source layers, '
+                        'every layer will be compressed: %s' %
+                        (t.image_name, e))
+            source_diff_layers = None
+        self._copy_local_to_registry(
+            target_image_local_url,
+            t.target_image_url,
+            session=target_session,
+            source_layers=source_diff_layers
+        )
+        LOG.info('[%s] Completed modify and upload for image' %
+                 t.image_name)
 
+    def _finish_upload(self, t, state):
         try:
-            for layer in source_layers:
+            for layer in state['layers']:
                 self.image_layers.setdefault(layer, t.target_image_url)
         except Exception:
             LOG.warning('[%s] Failed setting default layer %s for the '
                         'target image' % (t.target_image, layer))
             pass
-        target_session.close()
-        source_session.close()
-        return to_cleanup
+        self._close_sessions(state)
+        return state['cleanup']
 
     @classmethod
     @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
+        before=upload_metrics.count_retry,
         reraise=True,
         retry=tenacity.retry_if_exception_type(
             requests.exceptions.RequestException
@@ -1655,6 +2750,13 @@ class PythonImageUploader(BaseImageUploader):
             return True
         if image_url.netloc in cls.push_registries:
             return False
+        target = cls._registry_capability(image_url.netloc, 'target')
+        if target == REGISTRY_TARGET_EXPORT:
+            cls.export_registries.add(image_url.netloc)
+            return True
+        if target == REGISTRY_TARGET_PUSH:
+            cls.push_registries.add(image_url.netloc)
+            return False
 
         # detect if the registry is push-capable by requesting an upload URL.
         image, _ = cls._image_tag_from_url(image_url)
@@ -1670,14 +2772,22 @@ class PythonImageUploader(BaseImageUploader):
         except requests.exceptions.HTTPError as e:
             if e.response.status_code in (501, 403, 404, 405):
                 cls.export_registries.add(image_url.netloc)
+                cls._record_registry_capability(
+                    image_url.netloc, target=REGISTRY_TARGET_EXPORT)
+                cls._save_registry_cache()
                 return True
             else:
                 raise
         cls.push_registries.add(image_url.netloc)
+        cls._record_registry_capability(
+            image_url.netloc, target=REGISTRY_TARGET_PUSH)
+        cls._save_registry_cache()
         return False
 
     @classmethod
+    @upload_metrics.timed('manifest_fetch')
     @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
+        before=upload_metrics.count_retry,
         reraise=True,
         retry=tenacity.retry_if_exception_type(
             requests.exceptions.RequestException
@@ -1737,8 +2847,53 @@ class PythonImageUploader(BaseImageUploader):
                     multi_arch=False
                 )
 
+    @classmethod
+    def _source_layers_by_diff_id(cls, image_url, manifests_str, session):
+        """Map the diff-ids of an image to its compressed layers
+
+        The rootfs diff-ids of the image config are in the order of the
+        manifest layers, so a local image built on top of this one can
+        reuse the compressed blobs for every layer it did not change.
+
+        :param: image_url: URL of the image the manifests were fetched from
+        :param: manifests_str: manifests of the image, as collected by
+                               _collect_manifests_layers
+        :param: session: session for the registry of the image
+        :returns: dict of diff-id to a layer dict with the digest, size and
+                  mediaType of the compressed blob
+        """
+        image, tag = cls._image_tag_from_url(image_url)
+        layers_by_diff_id = {}
+        for manifest_str in manifests_str:
+            manifest = json.loads(manifest_str)
+            if manifest.get('mediaType') != MEDIA_MANIFEST_V2:
+                continue
+            config_url = cls._build_url(image_url, CALL_BLOB % {
+                'image': image,
+                'digest': manifest['config']['digest']
+            })
+            r = RegistrySessionHelper.get(
+                session, config_url, timeout=30, allow_redirects=False)
+            r = RegistrySessionHelper.check_redirect_trusted(
+                r, session, stream=False)
+            config = json.loads(cls._get_response_text(r))
+            diff_ids = config.get('rootfs', {}).get('diff_ids') or []
+            if len(diff_ids) != len(manifest['layers']):
+                LOG.warning('[%s] Layers of config %s do not match the '
+                            'manifest' % (image, manifest['config']['digest']))
+                continue
+            for diff_id, layer in zip(diff_ids, manifest['layers']):
+                layers_by_diff_id[diff_id] = {
+                    'digest': layer['digest'],
+                    'size': layer.get('size'),
+                    'mediaType': layer.get('mediaType',
+                                           MEDIA_BLOB_COMPRESSED),
+                }
+        return layers_by_diff_id
+
     @classmethod
     @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
+        before=upload_metrics.count_retry,
         reraise=True,
         retry=tenacity.retry_if_exception_type(
             requests.exceptions.RequestException
@@ -1763,6 +2918,7 @@ class PythonImageUploader(BaseImageUploader):
 
     @classmethod
     @tenacity.retry(  # Retry up to 5 times with longer time
+        before=upload_metrics.count_retry,
         reraise=True,
         retry=tenacity.retry_if_exception_type(
             (requests.exceptions.RequestException,
@@ -1772,7 +2928,7 @@ class PythonImageUploader(BaseImageUploader):
         stop=tenacity.stop_after_attempt(5)
     )
     def _layer_stream_registry(cls, digest, source_url, calc_digest,
-                               session):
+                               session, offset=0):
         image, tag = cls._image_tag_from_url(source_url)
         parts = {
             'image': image,
@@ -1783,32 +2939,199 @@ class PythonImageUploader(BaseImageUploader):
             source_url, CALL_BLOB % parts)
         # NOTE(aschultz): We specify None and let requests figure it out
         chunk_size = None
-        LOG.info("[%s] Fetching layer %s from %s" %
-                 (image, digest, source_blob_url))
-        with session.get(source_blob_url,
-                         stream=True,
-                         timeout=30,
-                         allow_redirects=False) as blob_req:
+        get_kwargs = {}
+        if offset:
+            get_kwargs['headers'] = {'Range': 'bytes=%i-' % offset}
+            LOG.info("[%s] Fetching layer %s from %s at offset %i" %
+                     (image, digest, source_blob_url, offset))
+        else:
+            LOG.info("[%s] Fetching layer %s from %s" %
+                     (image, digest, source_blob_url))
+        # the retry decorator only covers creating this generator, so the
+        # helper retries a rate limited or unauthorized request instead
+        with RegistrySessionHelper.get(session,
+                                       source_blob_url,
+                                       stream=True,
+                                       timeout=30,
+                                       allow_redirects=False,
+                                       **get_kwargs) as blob_req:
             blob_req.encoding = 'utf-8'
-            # raise for status here to ensure we didn't got a 401
-            RegistrySessionHelper.check_status(session=session,
-                                               request=blob_req)
             # Requests to docker.io redirect to CDN for the actual content
             # so we need to check if our initial blob request is a redirect
             # and follow as necessary.
-            blob_req = RegistrySessionHelper.check_redirect_trusted(blob_req,
-                                                                    session)
+            blob_req = RegistrySessionHelper.check_redirect_trusted(
+                blob_req, session, **get_kwargs)
+            # a source which ignores the range sends the whole blob, so skip
+            # the part we already have
+            skip = offset if offset and blob_req.status_code != 206 else 0
+            segments = cls._layer_segments(blob_req, offset)
+            # the rest of the blob is fetched in segments, only stream the
+            # first one from this response
+            remaining = segments[0][0] - offset if segments else None
             for data in blob_req.iter_content(chunk_size):
                 LOG.debug("[%s] Read %i bytes for %s" %
                           (image, len(data), digest))
                 if not data:
                     break
+                if skip:
+                    if len(data) <= skip:
+                        skip -= len(data)
+                        continue
+                    data = data[skip:]
+                    skip = 0
+                if remaining is not None:
+                    data = data[:remaining]
+                    remaining -= len(data)
                 calc_digest.update(data)
                 yield data
+                if remaining == 0:
+                    break
+            blob_req.close()
+
+            if segments:
+                LOG.info("[%s] Fetching %i segments of layer %s from %s" %
+                         (image, len(segments), digest, blob_req.url))
+                headers = {}
+                if not cls._trusted_redirect(source_blob_url, blob_req.url):
+                    # keep the registry token from the redirect target
+                    headers['Authorization'] = None
+                for data in cls._layer_segments_stream(
+                        blob_req.url, segments, session, headers):
+                    calc_digest.update(data)
+                    yield data
         LOG.info("[%s] Done fetching layer %s from registry" % (image, digest))
 
+    @staticmethod
+    def _trusted_redirect(source_blob_url, blob_url):
+        blob_netloc = parse.urlparse(blob_url).netloc
+        if parse.urlparse(source_blob_url).netloc == blob_netloc:
+            return True
+        return len([h for h in SECURE_REGISTRIES if h in blob_netloc]) > 0
+
+    @staticmethod
+    def _layer_segments(blob_req, offset=0):
+        """Split the remainder of a large blob into Range segments
+
+        :returns: list of (start, end) inclusive byte ranges to fetch after
+                  the first segment, or an empty list if the blob is too
+                  small or the source does not support ranged requests
+        """
+        if blob_req.status_code == 206:
+            start = offset
+        elif blob_req.headers.get('Accept-Ranges') == 'bytes':
+            start = 0
+        else:
+            return []
+        length = blob_req.headers.get('Content-Length')
+        if not length or blob_req.headers.get('Content-Encoding'):
+            return []
+        end = start + int(length)
+        if end - offset <= LAYER_SEGMENT_THRESHOLD:
+            return []
+        return [(s, min(s + LAYER_SEGMENT_SIZE, end) - 1)
+                for s in six.moves.range(offset + LAYER_SEGMENT_SIZE, end,
+                                         LAYER_SEGMENT_SIZE)]
+
     @classmethod
+    def _layer_segments_stream(cls, blob_url, segments, session, headers):
+        """Fetch segments concurrently and yield them in order
+
+        Every segment is streamed into a queue of at most
+        LAYER_SEGMENT_BUFFER chunks, for at most LAYER_SEGMENT_WORKERS
+        segments at once, so large layers are never buffered whole.
+        """
+        segments = iter(segments)
+        pending = collections.deque()
+        cancel = threading.Event()
+        with futures.ThreadPoolExecutor(
+                max_workers=LAYER_SEGMENT_WORKERS) as p:
+
+            def submit():
+                for start, end in segments:
+                    buf = six.moves.queue.Queue(LAYER_SEGMENT_BUFFER)
+                    pending.append((p.submit(
+                        cls._layer_segment_registry, blob_url, start, end,
+                        session, headers, buf, cancel), buf))
+                    return
+
+            try:
+                for i in six.moves.range(LAYER_SEGMENT_WORKERS):
+                    submit()
+                while pending:
+                    job, buf = pending[0]
+                    for data in iter(buf.get, None):
+                        yield data
+                    # raise the error of a failed segment
+                    job.result()
+                    pending.popleft()
+                    submit()
+            finally:
+                cancel.set()
+                for job, _ in pending:
+                    job.cancel()
+
+    @classmethod
+    def _layer_segment_registry(cls, blob_url, start, end, session, headers,
+                                buf, cancel):
+        """Stream a Range segment of a blob into a queue
+
+        The data chunks are put in buf, followed by None once the segment
+        is done or failed. Setting cancel stops the segment.
+        """
+        def put(data):
+            while not cancel.is_set():
+                try:
+                    buf.put(data, timeout=1)
+                    return True
+                except six.moves.queue.Full:
+                    pass
+            return False
+
+        position = [start]
+        try:
+            cls._layer_segment_fetch(blob_url, position, end, session,
+                                     headers, put)
+        finally:
+            put(None)
+
+    @staticmethod
     @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
+        before=upload_metrics.count_retry,
+        reraise=True,
+        retry=tenacity.retry_if_exception_type(
+            requests.exceptions.RequestException
+        ),
+        wait=tenacity.wait_random_exponential(multiplier=1, max=10),
+        stop=tenacity.stop_after_attempt(5)
+    )
+    def _layer_segment_fetch(blob_url, position, end, session, headers, put):
+        """Fetch a segment from position[0] to end, advancing position
+
+        A retry resumes from the first byte which was not put yet.
+        """
+        headers = dict(headers)
+        headers['Range'] = 'bytes=%i-%i' % (position[0], end)
+        with RegistrySessionHelper.get(session, blob_url, stream=True,
+                                       timeout=30, headers=headers) as r:
+            if r.status_code != 206:
+                raise requests.exceptions.RequestException(
+                    'Unexpected response for range %i-%i of %s' %
+                    (position[0], end, blob_url))
+            for data in r.iter_content(LAYER_SEGMENT_CHUNK_SIZE):
+                data = data[:end + 1 - position[0]]
+                if not data:
+                    break
+                if not put(data):
+                    return
+                position[0] += len(data)
+        if position[0] != end + 1:
+            raise requests.exceptions.RequestException(
+                'Short response for range %i-%i of %s' %
+                (position[0], end, blob_url))
+
+    @classmethod
+    @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
+        before=upload_metrics.count_retry,
         reraise=True,
         retry=tenacity.retry_if_exception_type(
             IOError
@@ -1819,58 +3142,128 @@ class PythonImageUploader(BaseImageUploader):
     def _copy_layer_registry_to_registry(cls, source_url, target_url,
                                          layer,
                                          source_session=None,
-                                         target_session=None):
-        layer_entry = {'digest': layer}
+                                         target_session=None,
+                                         extra_targets=None):
+        """Copy a layer from a source registry to target registries
+
+        The layer is fetched once from the source. When more than one
+        target lacks it, the source stream is teed to an upload to each of
+        them, all running at the same time.
+
+        :param: extra_targets: list of (target_url, target_session) tuples
+            the layer is also copied to
+        """
+        targets = []
         try:
-            cls._layer_fetch_lock(layer)
-            if cls._target_layer_exists_registry(
-                    target_url, layer_entry, [layer_entry], target_session):
-                cls._layer_fetch_unlock(layer)
-                return
-            known_path, ref_image = image_utils.uploaded_layers_details(
-                cls._global_view_proxy(), layer, scope='local')
-            if known_path and ref_image:
-                # cross-link target from local source, skip fetching it again
-                image_export.layer_cross_link(
-                    layer, ref_image, known_path, target_url)
+            with upload_metrics.METRICS.timer('layer_lock_wait'):
+                cls._layer_fetch_lock(layer)
+            for url, session in ([(target_url, target_session)] +
+                                 list(extra_targets or [])):
+                layer_entry = {'digest': layer}
+                if cls._target_layer_exists_registry(
+                        url, layer_entry, [layer_entry], session):
+                    continue
+                known_path, ref_image = image_utils.uploaded_layers_details(
+                    cls._global_view_proxy(), layer, scope='local')
+                if known_path and ref_image:
+                    # cross-link target from local source, skip fetching it
+                    # again
+                    image_export.layer_cross_link(
+                        layer, ref_image, known_path, url)
+                    continue
+                targets.append((url, session, layer_entry))
+            if not targets:
                 cls._layer_fetch_unlock(layer)
                 return
-        except ImageUploaderThreadException:
-            # skip trying to unlock, because that's what threw the exception
-            raise
         except Exception:
             cls._layer_fetch_unlock(layer)
             raise
 
-        digest = layer_entry['digest']
-        LOG.debug('[%s] Uploading layer' % digest)
+        LOG.debug('[%s] Uploading layer' % layer)
 
-        calc_digest = hashlib.sha256()
-        known_path = None
-        layer_val = None
+        def resume_stream(offset, calc_digest):
+            return upload_metrics.count_stream(
+                cls._layer_stream_registry(
+                    layer, source_url, calc_digest, source_session,
+                    offset=offset),
+                source_url.netloc, upload_metrics.TRANSFER_PULL)
+
+        try:
+            if len(targets) == 1:
+                url, session, layer_entry = targets[0]
+                calc_digest = hashlib.sha256()
+                return cls._copy_layer_stream_to_registry(
+                    url, session, layer_entry, calc_digest,
+                    resume_stream(0, calc_digest), resume_stream)
+
+            # every upload hashes the chunks it reads from the tee, so the
+            # source is not hashed
+            tee = image_transfer.StreamTee(
+                resume_stream(0, image_transfer.NullDigest()), len(targets))
+
+            def copy_target(index):
+                url, session, layer_entry = targets[index]
+                calc_digest = hashlib.sha256()
+
+                def tee_stream():
+                    for chunk in tee.consumer(index):
+                        calc_digest.update(chunk)
+                        yield chunk
+
+                def resume_target(offset, calc_digest):
+                    # a failed upload fetches the rest on its own
+                    tee.close(index)
+                    return resume_stream(offset, calc_digest)
+
+                try:
+                    return cls._copy_layer_stream_to_registry(
+                        url, session, layer_entry, calc_digest,
+                        tee_stream(), resume_target)
+                finally:
+                    tee.close(index)
+
+            with futures.ThreadPoolExecutor(
+                    max_workers=len(targets) - 1) as p:
+                extra_jobs = [p.submit(copy_target, i)
+                              for i in range(1, len(targets))]
+                primary_error = None
+                try:
+                    layer_val = copy_target(0)
+                except Exception:
+                    primary_error = sys.exc_info()
+                # wait for every upload before raising the first error
+                errors = [job.exception() for job in extra_jobs]
+            if primary_error:
+                six.reraise(*primary_error)
+            for e in errors:
+                if e:
+                    raise e
+            return layer_val
+        finally:
+            cls._layer_fetch_unlock(layer)
+
+    @classmethod
+    def _copy_layer_stream_to_registry(cls, target_url, target_session,
+                                       layer_entry, calc_digest,
+                                       layer_stream, resume_stream):
+        layer = layer_entry['digest']
         try:
-            layer_stream = cls._layer_stream_registry(
-                digest, source_url, calc_digest, source_session)
             layer_val, known_path = cls._copy_stream_to_registry(
                 target_url, layer_entry, calc_digest, layer_stream,
-                target_session)
+                target_session, resume_stream=resume_stream)
         except (IOError, requests.exceptions.HTTPError):
             cls._track_uploaded_layers(layer, forget=True, scope='remote')
             LOG.error('[%s] Failed processing layer for the target '
                       'image %s' % (layer, target_url.geturl()))
             raise
-        except Exception:
-            raise
-        else:
-            if layer_val and known_path:
-                image_ref = target_url.path.split(':')[0][1:]
-                uploaded = parse.urlparse(known_path).scheme
-                cls._track_uploaded_layers(
-                    layer_val, known_path=known_path, image_ref=image_ref,
-                    scope=('remote' if uploaded else 'local'))
-            return layer_val
-        finally:
-            cls._layer_fetch_unlock(layer)
+        if layer_val and known_path:
+            image_ref = target_url.path.split(':')[0][1:]
+            uploaded = parse.urlparse(known_path).scheme
+            cls._track_uploaded_layers(
+                layer_val, known_path=known_path, image_ref=image_ref,
+                scope=('remote' if uploaded else 'local'),
+                size=layer_entry.get('size'))
+        return layer_val
 
     @classmethod
     def _assert_scheme(cls, url, scheme):
@@ -1880,6 +3273,7 @@ class PythonImageUploader(BaseImageUploader):
 
     @classmethod
     @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
+        before=upload_metrics.count_retry,
         reraise=True,
         retry=tenacity.retry_if_exception_type(
             requests.exceptions.RequestException
@@ -1892,9 +3286,19 @@ class PythonImageUploader(BaseImageUploader):
                                    source_session=None,
                                    target_session=None,
                                    source_layers=None,
-                                   multi_arch=False):
+                                   multi_arch=False,
+                                   extra_targets=None):
+        """Copy an image from a source registry to target registries
+
+        :param: extra_targets: list of (target_url, target_session) tuples
+            the image is also copied to. Every layer is fetched once from
+            the source and streamed to all the targets which lack it.
+        """
         cls._assert_scheme(source_url, 'docker')
         cls._assert_scheme(target_url, 'docker')
+        extra_targets = extra_targets or []
+        for url, _ in extra_targets:
+            cls._assert_scheme(url, 'docker')
 
         image, tag = cls._image_tag_from_url(source_url)
         parts = {
@@ -1904,35 +3308,19 @@ class PythonImageUploader(BaseImageUploader):
 
         # Upload all layers
         copy_jobs = []
-        jobs_count = 0
-        jobs_finished = 0
-        with futures.ThreadPoolExecutor(max_workers=4) as p:
-            if source_layers:
-                for layer in source_layers:
-                    copy_jobs.append(p.submit(
-                        cls._copy_layer_registry_to_registry,
-                        source_url, target_url,
-                        layer=layer,
-                        source_session=source_session,
-                        target_session=target_session
-                    ))
-
-            jobs_count = len(copy_jobs)
-            LOG.debug('[%s] Waiting for %i jobs to finish' %
-                      (image, jobs_count))
-            for job in futures.as_completed(copy_jobs):
-                e = job.exception()
-                if e:
-                    raise e
-                layer = job.result()
-                if layer:
-                    LOG.debug('[%s] Upload complete for layer %s' %
-                              (image, layer))
-                jobs_finished += 1
-                LOG.debug('[%s] Waiting for next job: %i of %i complete' %
-                          (image, jobs_finished, jobs_count))
-
-        LOG.debug('[%s] Completed %i jobs' % (image, jobs_count))
+        for layer in source_layers or []:
+            copy_jobs.append((
+                cls._copy_layer_registry_to_registry,
+                (source_url, target_url),
+                dict(layer=layer,
+                     source_session=source_session,
+                     target_session=target_session,
+                     extra_targets=extra_targets)
+            ))
+        cls._run_layer_jobs(
+            image, copy_jobs,
+            (source_url.netloc, target_url.netloc) +
+            tuple(url.netloc for url, _ in extra_targets))
 
         for source_manifest in source_manifests:
             manifest = json.loads(source_manifest)
@@ -1962,16 +3350,19 @@ class PythonImageUploader(BaseImageUploader):
                 manifest['config']['size'] = len(config_str)
                 manifest['config']['mediaType'] = MEDIA_CONFIG
 
-            cls._copy_manifest_config_to_registry(
-                target_url=target_url,
-                manifest_str=source_manifest,
-                config_str=config_str,
-                target_session=target_session,
-                multi_arch=multi_arch
-            )
+            for url, session in [(target_url, target_session)] + \
+                    extra_targets:
+                cls._copy_manifest_config_to_registry(
+                    target_url=url,
+                    manifest_str=source_manifest,
+                    config_str=config_str,
+                    target_session=session,
+                    multi_arch=multi_arch
+                )
         LOG.debug('[%s] Finished copying image' % image)
 
     @classmethod
+    @upload_metrics.timed('manifest_push')
     def _copy_manifest_config_to_registry(cls, target_url,
                                           manifest_str,
                                           config_str,
@@ -2059,6 +3450,7 @@ class PythonImageUploader(BaseImageUploader):
 
     @classmethod
     @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
+        before=upload_metrics.count_retry,
         reraise=True,
         wait=tenacity.wait_random_exponential(multiplier=1, max=10),
         stop=tenacity.stop_after_attempt(5)
@@ -2100,6 +3492,7 @@ class PythonImageUploader(BaseImageUploader):
         return out
 
     @classmethod
+    @upload_metrics.timed('layer_check')
     def _target_layer_exists_registry(cls, target_url, layer, check_layers,
                                       session):
         image, tag = cls._image_tag_from_url(target_url)
@@ -2116,7 +3509,11 @@ class PythonImageUploader(BaseImageUploader):
                 continue
             known_path, ref_image = image_utils.uploaded_layers_details(
                 cls._global_view_proxy(), x['digest'], scope='remote')
-            if ref_image == norm_image:
+            # entries loaded from the layer index may be for another
+            # registry, or gone from it since, and are checked once
+            if ref_image == norm_image and known_path.startswith(
+                    cls._build_url(target_url, '/')) and (
+                    x['digest'] not in cls.unverified_layers):
                 LOG.debug('[%s] Layer %s already exists at %s' %
                           (image, x['digest'], known_path))
                 layer_found = x
@@ -2128,8 +3525,10 @@ class PythonImageUploader(BaseImageUploader):
                 if session.head(blob_url, timeout=30).status_code == 200:
                     LOG.debug('[%s] Layer already exists: %s' %
                               (image, x['digest']))
+                    cls.unverified_layers.discard(x['digest'])
                     layer_found = x
                     break
+        upload_metrics.METRICS.add_dedup('layer', bool(layer_found))
         if layer_found:
             layer['digest'] = layer_found['digest']
             if 'size' in layer_found:
@@ -2140,9 +3539,7 @@ class PythonImageUploader(BaseImageUploader):
         return False
 
     @classmethod
-    def _layer_stream_local(cls, layer_id, calc_digest):
-        LOG.debug('[%s] Exporting layer' % layer_id)
-
+    def _local_layer_paths(cls, layer_id):
         tar_split_path = cls._containers_file_path(
             'overlay-layers',
             '%s.tar-split.gz' % layer_id
@@ -2150,32 +3547,74 @@ class PythonImageUploader(BaseImageUploader):
         overlay_path = cls._containers_file_path(
             'overlay', layer_id, 'diff'
         )
-        cmd = [
-            'tar-split', 'asm',
-            '--input', tar_split_path,
-            '--path', overlay_path,
-            '--compress'
-        ]
-        LOG.debug(' '.join(cmd))
+        return tar_split_path, overlay_path
+
+    @classmethod
+    def _local_layer_cached(cls, layer_id, compress=False):
+        """Return the local layer cache entry of a layer
+
+        :param compress: compress the layer into the cache if it is missing
+        :returns: dict with the path, digest and size of the compressed
+                  layer, or None if it is not cached
+        """
+        cache = cls.local_layer_cache
+        if not cache:
+            return None
+        tar_split_path, overlay_path = cls._local_layer_paths(layer_id)
         try:
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+            if compress:
+                return cache.get(layer_id, tar_split_path, overlay_path)
+            return cache.lookup(layer_id, tar_split_path)
+        except (IOError, OSError, ValueError,
+                tar_split.TarSplitException) as e:
+            LOG.error('[%s] Extracting layer failed: %s' % (layer_id, e))
+            raise ImageUploaderException('Extracting layer failed')
 
-            chunk_size = 2 ** 20
+    @classmethod
+    def _layer_stream_local(cls, layer_id, calc_digest, pipe=False):
+        """Stream a compressed local layer
 
-            while True:
-                data = p.stdout.read(chunk_size)
-                if not data:
-                    break
+        The layer tar is reassembled from its tar-split metadata and diff
+        directory, then compressed. With a local layer cache the compressed
+        layer is kept by layer id, so layers shared by many images are only
+        compressed once.
+
+        :param pipe: yield a readable file of the compressed layer instead
+                     of data chunks, for consumers which copy and hash it
+                     directly. The consumer must read the file to the end.
+        """
+        LOG.debug('[%s] Exporting layer' % layer_id)
+
+        try:
+            cached = cls._local_layer_cached(layer_id, compress=True)
+            if cached:
+                with open(cached['path'], 'rb') as f:
+                    if pipe:
+                        yield f
+                        return
+                    while True:
+                        data = f.read(tar_split.CHUNK_SIZE)
+                        if not data:
+                            break
+                        calc_digest.update(data)
+                        yield data
+                return
+
+            tar_split_path, overlay_path = cls._local_layer_paths(layer_id)
+            for data in tar_split.compress(
+                    tar_split.assemble(tar_split_path, overlay_path)):
                 calc_digest.update(data)
                 yield data
-            p.wait()
-            if p.returncode != 0:
-                raise ImageUploaderException('Extracting layer failed')
+        except (IOError, OSError, ValueError,
+                tar_split.TarSplitException) as e:
+            LOG.error('[%s] Extracting layer failed: %s' % (layer_id, e))
+            raise ImageUploaderException('Extracting layer failed')
         except KeyboardInterrupt:
             raise Exception('Action interrupted with ctrl+c')
 
     @classmethod
     @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
+        before=upload_metrics.count_retry,
         reraise=True,
         retry=tenacity.retry_if_exception_type(
             requests.exceptions.RequestException
@@ -2184,11 +3623,21 @@ class PythonImageUploader(BaseImageUploader):
         stop=tenacity.stop_after_attempt(5)
     )
     def _copy_layer_local_to_registry(cls, target_url,
-                                      session, layer, layer_entry):
+                                      session, layer, layer_entry,
+                                      source_layer=None):
+        """Copy a layer from the local storage to the target registry
+
+        :param source_layer: layer of the source image with the same
+                             diff-digest, whose compressed blob is reused
+                             when the target has it
+        """
 
-        # Check in global view or do a HEAD call for the compressed-diff-digest
-        # and diff-digest to see if the layer is already in the registry
+        # Check in global view or do a HEAD call for the source layer,
+        # compressed-diff-digest and diff-digest to see if the layer is
+        # already in the registry
         check_layers = []
+        if source_layer:
+            check_layers.append(dict(source_layer))
         compressed_digest = layer_entry.get('compressed-diff-digest')
         if compressed_digest:
             check_layers.append({
@@ -2204,21 +3653,38 @@ class PythonImageUploader(BaseImageUploader):
                 'size': layer_entry.get('diff-size'),
                 'mediaType': MEDIA_BLOB,
             })
+
+        # the digest this layer was compressed to by an earlier upload
+        layer_id = layer_entry['id']
+        cached = cls._local_layer_cached(layer_id)
+        if cached:
+            check_layers.append({
+                'digest': cached['digest'],
+                'size': cached['size'],
+                'mediaType': MEDIA_BLOB_COMPRESSED,
+            })
         if cls._target_layer_exists_registry(target_url, layer, check_layers,
                                              session):
             return
 
-        layer_id = layer_entry['id']
         LOG.debug('[%s] Uploading layer' % layer_id)
 
         calc_digest = hashlib.sha256()
         known_path = None
         layer_val = None
         try:
-            layer_stream = cls._layer_stream_local(layer_id, calc_digest)
+            cached = cls._local_layer_cached(layer_id, compress=True)
+            if cached:
+                # exports can link an already stored blob of that digest
+                layer['digest'] = cached['digest']
+                layer['size'] = cached['size']
+            # exports copy the compressed layer file straight to the blob
+            layer_stream = cls._layer_stream_local(
+                layer_id, calc_digest,
+                pipe=target_url.netloc in cls.export_registries)
             layer_val, known_path = cls._copy_stream_to_registry(
                 target_url, layer, calc_digest, layer_stream, session,
-                verify_digest=False)
+                verify_digest=bool(cached))
         except (IOError, requests.exceptions.HTTPError):
             cls._track_uploaded_layers(
                 layer['digest'], forget=True, scope='remote')
@@ -2233,46 +3699,117 @@ class PythonImageUploader(BaseImageUploader):
                 uploaded = parse.urlparse(known_path).scheme
                 cls._track_uploaded_layers(
                     layer_val, known_path=known_path, image_ref=image_ref,
-                    scope=('remote' if uploaded else 'local'))
+                    scope=('remote' if uploaded else 'local'),
+                    size=layer.get('size'))
             return layer_val
 
     @classmethod
+    def _upload_status(cls, upload_url, session):
+        """Query an upload session for the bytes the registry has committed
+
+        :returns: tuple of the committed length and the status response, or
+                  None instead of the response if it has no Location to
+                  continue the upload with
+        """
+        r = RegistrySessionHelper.get(session, upload_url, timeout=30)
+        upload_range = r.headers.get('Range', '')
+        offset = 0
+        if '-' in upload_range:
+            end = int(upload_range.rpartition('-')[2])
+            # an empty upload is also reported as 0-0
+            offset = end + 1 if end else 0
+        if 'Location' not in r.headers:
+            r = None
+        return offset, r
+
+    @classmethod
+    @upload_metrics.timed('layer_transfer')
     def _copy_stream_to_registry(cls, target_url, layer, calc_digest,
-                                 layer_stream, session, verify_digest=True):
+                                 layer_stream, session, verify_digest=True,
+                                 resume_stream=None):
+        """Copy a layer stream to the target registry
+
+        The stream is uploaded with chunked PATCH requests. When a
+        resume_stream callable is given, a failed chunk does not restart
+        the whole layer. The upload session is kept, the registry is asked
+        for the offset it committed, and resume_stream(offset, calc_digest)
+        is used to fetch only the missing tail from the source.
+        """
         layer['mediaType'] = MEDIA_BLOB_COMPRESSED
         length = 0
         upload_resp = None
+        upload_url = None
+        layer_stream = upload_metrics.count_stream(
+            layer_stream, target_url.netloc, upload_metrics.TRANSFER_PUSH)
 
         export = target_url.netloc in cls.export_registries
         if export:
             return image_export.export_stream(
-                target_url, layer, layer_stream, verify_digest=verify_digest)
-
-        for chunk in layer_stream:
-            if not chunk:
+                target_url, layer, layer_stream, verify_digest=verify_digest,
+                calc_digest=calc_digest)
+
+        # digest state for the bytes the registry has committed
+        committed_digest = calc_digest.copy()
+        resumes = 0
+        skip = 0
+        while True:
+            try:
+                for chunk in layer_stream:
+                    if not chunk:
+                        break
+                    if skip:
+                        # committed by the registry before the failure but
+                        # never acknowledged, so only account for it
+                        data = chunk[:skip]
+                        chunk = chunk[skip:]
+                        skip -= len(data)
+                        length += len(data)
+                        if not chunk:
+                            committed_digest = calc_digest.copy()
+                            continue
+
+                    chunk_length = len(chunk)
+                    if upload_resp is not None or not upload_url:
+                        upload_url = cls._upload_url(
+                            target_url, session, upload_resp)
+                    upload_resp = RegistrySessionHelper.patch(
+                        session,
+                        upload_url,
+                        timeout=30,
+                        data=chunk,
+                        headers={
+                            'Content-Length': str(chunk_length),
+                            'Content-Range': '%d-%d' % (
+                                length, length + chunk_length - 1),
+                            'Content-Type': 'application/octet-stream'
+                        }
+                    )
+                    length += chunk_length
+                    committed_digest = calc_digest.copy()
                 break
-
-            chunk_length = len(chunk)
-            upload_url = cls._upload_url(
-                target_url, session, upload_resp)
-            upload_resp = RegistrySessionHelper.patch(
-                session,
-                upload_url,
-                timeout=30,
-                data=chunk,
-                headers={
-                    'Content-Length': str(chunk_length),
-                    'Content-Range': '%d-%d' % (
-                        length, length + chunk_length - 1),
-                    'Content-Type': 'application/octet-stream'
-                }
-            )
-            length += chunk_length
+            except (IOError, requests.exceptions.RequestException) as e:
+                if (not resume_stream or not upload_url or
+                        resumes >= UPLOAD_RESUME_ATTEMPTS):
+                    raise
+                resumes += 1
+                offset, upload_resp = cls._upload_status(upload_url, session)
+                if offset < length:
+                    # the registry lost data we have no digest state for
+                    raise
+                LOG.warning('[%s] Resuming upload from byte %i, registry '
+                            'has %i bytes, after: %s' %
+                            (layer.get('digest'), length, offset, e))
+                skip = offset - length
+                calc_digest = committed_digest.copy()
+                layer_stream = upload_metrics.count_stream(
+                    resume_stream(length, calc_digest), target_url.netloc,
+                    upload_metrics.TRANSFER_PUSH)
 
         layer_digest = 'sha256:%s' % calc_digest.hexdigest()
         LOG.debug('[%s] Calculated layer digest' % layer_digest)
-        upload_url = cls._upload_url(
-            target_url, session, upload_resp)
+        if upload_resp is not None or not upload_url:
+            upload_url = cls._upload_url(
+                target_url, session, upload_resp)
         upload_resp = RegistrySessionHelper.put(
             session,
             upload_url,
@@ -2287,6 +3824,7 @@ class PythonImageUploader(BaseImageUploader):
 
     @classmethod
     @tenacity.retry(  # Retry up to 5 times with jittered exponential backoff
+        before=upload_metrics.count_retry,
         reraise=True,
         retry=tenacity.retry_if_exception_type(
             requests.exceptions.RequestException
@@ -2294,41 +3832,33 @@ class PythonImageUploader(BaseImageUploader):
         wait=tenacity.wait_random_exponential(multiplier=1, max=10),
         stop=tenacity.stop_after_attempt(5)
     )
-    def _copy_local_to_registry(cls, source_url, target_url, session):
+    def _copy_local_to_registry(cls, source_url, target_url, session,
+                                source_layers=None):
+        """Copy an image from the local storage to the target registry
+
+        :param source_layers: dict of diff-digest to the layers of the image
+                              it was built from, as returned by
+                              _source_layers_by_diff_id. Local layers with
+                              the same content are not compressed again.
+        """
         cls._assert_scheme(source_url, 'containers-storage')
         cls._assert_scheme(target_url, 'docker')
 
         name = '%s%s' % (source_url.netloc, source_url.path)
         image, manifest, config_str = cls._image_manifest_config(name)
         layers_by_digest = cls._get_all_local_layers_by_digest()
+        source_layers = source_layers or {}
 
         # Upload all layers
         copy_jobs = []
-        jobs_count = 0
-        jobs_finished = 0
-        with futures.ThreadPoolExecutor(max_workers=4) as p:
-            for layer in manifest['layers']:
-                layer_entry = layers_by_digest[layer['digest']]
-                copy_jobs.append(p.submit(
-                    cls._copy_layer_local_to_registry,
-                    target_url, session, layer, layer_entry
-                ))
-            jobs_count = len(copy_jobs)
-            LOG.debug('[%s] Waiting for %i jobs to finish' %
-                      (name, jobs_count))
-            for job in futures.as_completed(copy_jobs):
-                e = job.exception()
-                if e:
-                    raise e
-                layer = job.result()
-                if layer:
-                    LOG.debug('[%s] Upload complete for layer: %s' %
-                              (name, layer))
-                jobs_finished += 1
-                LOG.debug('[%s] Waiting for next job: %i of %i complete' %
-                          (name, jobs_finished, jobs_count))
-
-        LOG.debug('[%s] Completed %i jobs' % (name, jobs_count))
+        for layer in manifest['layers']:
+            layer_entry = layers_by_digest[layer['digest']]
+            copy_jobs.append((
+                cls._copy_layer_local_to_registry,
+                (target_url, session, layer, layer_entry),
+                {'source_layer': source_layers.get(layer['digest'])}
+            ))
+        cls._run_layer_jobs(name, copy_jobs, (target_url.netloc,))
 
         manifest_str = json.dumps(manifest, indent=3)
         cls._copy_manifest_config_to_registry(
@@ -2341,7 +3871,7 @@ class PythonImageUploader(BaseImageUploader):
 
     @classmethod
     def _containers_file_path(cls, *path):
-        full_path = os.path.join('/var/lib/containers/storage/', *path)
+        full_path = os.path.join(CONTAINERS_STORAGE_DIR, *path)
         if not os.path.exists(full_path):
             raise ImageUploaderException('Missing file %s' % full_path)
         return full_path
@@ -2361,8 +3891,31 @@ class PythonImageUploader(BaseImageUploader):
         return json.loads(cls._containers_file(*path))
 
     @classmethod
-    def _get_all_local_layers_by_digest(cls):
-        all_layers = cls._containers_json('overlay-layers', 'layers.json')
+    def _containers_index(cls, build, *path):
+        """Return an index built from a containers-storage JSON file
+
+        The layers.json and images.json files list everything in the
+        storage, so they are parsed and indexed once and the index is kept
+        until the file is replaced.
+
+        :param build: callable building the index from the parsed file
+        """
+        try:
+            st = os.stat(os.path.join(CONTAINERS_STORAGE_DIR, *path))
+            version = (st.st_ino, st.st_size, st.st_mtime)
+        except OSError:
+            version = None
+        key = '/'.join(path)
+        cached = cls.containers_index.get(key)
+        if version and cached and cached[0] == version:
+            return cached[1]
+        index = build(cls._containers_json(*path))
+        if version:
+            cls.containers_index[key] = (version, index)
+        return index
+
+    @staticmethod
+    def _index_layers(all_layers):
         layers_by_digest = {}
         for x in all_layers:
             if 'diff-digest' in x:
@@ -2371,6 +3924,19 @@ class PythonImageUploader(BaseImageUploader):
                 layers_by_digest[x['compressed-diff-digest']] = x
         return layers_by_digest
 
+    @staticmethod
+    def _index_images(images):
+        images_by_name = {}
+        for i in images:
+            for n in i.get('names', []):
+                images_by_name.setdefault(n, i)
+        return images_by_name
+
+    @classmethod
+    def _get_all_local_layers_by_digest(cls):
+        return cls._containers_index(
+            cls._index_layers, 'overlay-layers', 'layers.json')
+
     @classmethod
     def _get_local_layers_manifest(cls, manifest, config_str):
         """Return a valid local manifest
@@ -2406,15 +3972,9 @@ class PythonImageUploader(BaseImageUploader):
 
     @classmethod
     def _image_manifest_config(cls, name):
-        image = None
-        images = cls._containers_json('overlay-images', 'images.json')
-        for i in images:
-            for n in i.get('names', []):
-                if name == n:
-                    image = i
-                    break
-            if image:
-                break
+        images = cls._containers_index(
+            cls._index_images, 'overlay-images', 'images.json')
+        image = images.get(name)
         if not image:
             raise ImageNotFoundException('Not found image: %s' % name)
         image_id = image['id']
@@ -2514,8 +4074,13 @@ class PythonImageUploader(BaseImageUploader):
         We check to see if the lock object is not set or if it is a threading
         lock. We cannot check if it is a ProcessLock due to the side effect
         of trying to include ProcessLock when running under Mistral breaks
-        Mistral.
+        Mistral. A shared transfer engine always runs tasks in threads.
         """
+        if self.transfer_engine:
+            # tasks mostly wait on layer jobs running on the shared engine
+            # pool, and the engine can only be shared between threads
+            return futures.ThreadPoolExecutor(
+                max_workers=self.transfer_engine.max_workers)
         if not self.lock or isinstance(self.lock, threadinglock.ThreadingLock):
             # workers will scale from 2 to 8 based on the cpu count // 2
             workers = min(max(2, processutils.get_worker_count() // 2), 8)
@@ -2526,15 +4091,250 @@ class PythonImageUploader(BaseImageUploader):
             # RAM required which can lead to OOMs. It's best to limit to 4
             return futures.ProcessPoolExecutor(max_workers=4)
 
+    def _plan_task_layers(self, task):
+        """Collect the source manifests and layers of an upload task
+
+        The result is stored on the task so upload_image does not need
+        to fetch the manifests again.
+        """
+        source_url = task.source_image_url
+        username, password = self.credentials_for_registry(source_url.netloc)
+        try:
+            session = self.authenticate(
+                source_url, username=username, password=password)
+            try:
+                manifests_str = []
+                layers = []
+                self._collect_manifests_layers(
+                    source_url, session, manifests_str, layers,
+                    task.multi_arch)
+            finally:
+                session.close()
+        except Exception as e:
+            # leave it to upload_image to report the failure properly
+            LOG.warning('[%s] Unable to plan layers for image: %s' %
+                        (task.image_name, e))
+            return task, []
+        task.source_manifests = manifests_str
+        task.source_layers = layers
+        return task, layers
+
+    def _fetch_shared_layers(self, task, layers):
+        """Copy the given layers of a task to its target registries"""
+        source_url = task.source_image_url
+        target_url = task.target_image_url
+        target_username, target_password = self.credentials_for_registry(
+            target_url.netloc)
+        source_username, source_password = self.credentials_for_registry(
+            source_url.netloc)
+        target_session = self.authenticate(
+            target_url, username=target_username, password=target_password)
+        extra_targets = []
+        try:
+            self._detect_target_export(target_url, target_session)
+            extra_targets = self._open_extra_targets(task)
+            source_session = self.authenticate(
+                source_url, username=source_username,
+                password=source_password)
+            try:
+                image, _ = self._image_tag_from_url(source_url)
+                copy_jobs = []
+                for layer in layers:
+                    copy_jobs.append((
+                        self._copy_layer_registry_to_registry,
+                        (source_url, target_url),
+                        dict(layer=layer,
+                             source_session=source_session,
+                             target_session=target_session,
+                             extra_targets=extra_targets)
+                    ))
+                self._run_layer_jobs(
+                    image, copy_jobs,
+                    (source_url.netloc, target_url.netloc) +
+                    tuple(url.netloc for url, _ in extra_targets))
+            finally:
+                source_session.close()
+        finally:
+            target_session.close()
+            self._close_sessions({'extra_targets': extra_targets})
+        for layer in layers:
+            self.image_layers.setdefault(layer, target_url)
+
+    def _schedule_shared_layers(self):
+        """Fetch every layer shared between upload tasks exactly once
+
+        The manifests of every task are collected first to build a map of
+        which layers are referenced by which images. Layers referenced by
+        more than one image pushed to the same registry are then copied
+        once, to the target of the first image referencing them. The upload
+        tasks will find these layers in the global view and cross-mount or
+        link them instead of fetching them again.
+
+        Modify tasks and local sources are not planned, they are uploaded
+        as before.
+        """
+        plan_tasks = [t for _, t in self.upload_tasks
+                      if not t.modify_role and
+                      not t.source_image.startswith('containers-storage:')]
+        if len(plan_tasks) < 2:
+            return
+
+        layer_tasks = collections.OrderedDict()
+        workers = min(max(2, processutils.get_worker_count() // 2), 8)
+        with futures.ThreadPoolExecutor(max_workers=workers) as p:
+            for task, layers in p.map(self._plan_task_layers, plan_tasks):
+                for layer in layers:
+                    key = (task.target_image_url.netloc, layer)
+                    layer_tasks.setdefault(key, []).append(task)
+
+        # group each shared layer under the first task referencing it
+        owned_layers = collections.OrderedDict()
+        for (_, layer), tasks in layer_tasks.items():
+            if len(tasks) < 2:
+                continue
+            owned_layers.setdefault(tasks[0], []).append(layer)
+        if not owned_layers:
+            return
+        LOG.info('Fetching %i layers shared between %i images' %
+                 (sum(len(x) for x in owned_layers.values()),
+                  len(plan_tasks)))
+
+        with futures.ThreadPoolExecutor(max_workers=workers) as p:
+            fetch_jobs = [p.submit(self._fetch_shared_layers, task, layers)
+                          for task, layers in owned_layers.items()]
+            for job in futures.as_completed(fetch_jobs):
+                e = job.exception()
+                if e:
+                    # the owning upload task will fetch the layer instead
+                    LOG.warning('Failed fetching shared layers: %s' % e)
+
+    def _local_layers_reused(self):
+        """Check whether a local layer may be uploaded by many tasks
+
+        Modified images are uploaded from containers-storage, and share
+        the layers of the images they are built from, so two modify tasks
+        are taken to reuse layers. Otherwise the layers of the local
+        source images are compared.
+        """
+        local_tasks = [t for _, t in self.upload_tasks
+                       if t.modify_role or
+                       t.source_image.startswith('containers-storage:')]
+        if len(local_tasks) < 2:
+            return False
+        if any(t.modify_role for t in local_tasks):
+            return True
+        seen = set()
+        for t in local_tasks:
+            url = t.source_image_url
+            try:
+                _, manifest, _ = self._image_manifest_config(
+                    '%s%s' % (url.netloc, url.path))
+            except Exception as e:
+                LOG.debug('Unable to read the layers of %s: %s' %
+                          (t.source_image, e))
+                return True
+            layers = set(x['digest'] for x in manifest['layers'])
+            if seen & layers:
+                return True
+            seen |= layers
+        return False
+
+    def _run_modify_batches(self, p, batch_tasks):
+        """Pull, modify and push images in batches on an executor
+
+        The unmodified images of the next batch are pulled and the modified
+        images of the previous batch are pushed while the playbook of a
+        batch runs.
+
+        :param: p: executor to run the pulls and pushes on
+        :param: batch_tasks: (uploader, task) tuples with a modify_role
+        :returns: list of futures, in the order of batch_tasks, of the local
+                  images to clean up and the metrics of every task
+        """
+        if not batch_tasks:
+            return []
+        size = self.modify_batch_size
+        batches = [batch_tasks[i:i + size]
+                   for i in range(0, len(batch_tasks), size)]
+        jobs = collections.OrderedDict(
+            (task, None) for _, task in batch_tasks)
+
+        def done(task, result=None, exception=None):
+            f = futures.Future()
+            if exception:
+                f.set_exception(exception)
+            else:
+                f.set_result((result or [], None))
+            jobs[task] = f
+
+        def submit_pulls(batch):
+            return [(task, p.submit(modify_pull_task, (uploader, task)))
+                    for uploader, task in batch]
+
+        pulls = submit_pulls(batches[0])
+        for i, batch in enumerate(batches):
+            pulled = []
+            for task, job in pulls:
+                try:
+                    state, metrics = job.result()
+                except Exception as e:
+                    done(task, exception=e)
+                    continue
+                upload_metrics.METRICS.merge(metrics)
+                if state is None:
+                    done(task)
+                else:
+                    pulled.append((task, state))
+            if i + 1 < len(batches):
+                pulls = submit_pulls(batches[i + 1])
+
+            LOG.info('Modifying a batch of %i images' % len(pulled))
+            modified = self.run_modify_playbook_batch(
+                [task for task, _ in pulled], forks=self.modify_forks)
+            for task, state in pulled:
+                if task in modified:
+                    jobs[task] = p.submit(modify_push_task,
+                                          (self, task, state))
+                else:
+                    done(task, exception=ImageUploaderException(
+                        'Modifying image %s failed' % task.target_image))
+        return list(jobs.values())
+
     def run_tasks(self):
         if not self.upload_tasks:
             return
         local_images = []
 
-        with self._get_executor() as p:
-            for result in p.map(upload_task, self.upload_tasks):
-                local_images.extend(result)
-            LOG.info('result %s' % local_images)
+        self.probe_task_registries()
+        self._schedule_shared_layers()
+
+        PythonImageUploader.metrics_pid = os.getpid()
+        run_cache_path = None
+        if (not PythonImageUploader.local_layer_cache and
+                self._local_layers_reused()):
+            run_cache_path = tempfile.mkdtemp(prefix='tripleo-layers-')
+            PythonImageUploader.init_local_layer_cache(run_cache_path)
+        batch_tasks = []
+        if self.modify_batch_size:
+            batch_tasks = [x for x in self.upload_tasks if x[1].modify_role]
+        try:
+            with self._get_executor() as p:
+                jobs = [p.submit(upload_task_metrics, x)
+                        for x in self.upload_tasks if x not in batch_tasks]
+                jobs.extend(self._run_modify_batches(p, batch_tasks))
+                for job in jobs:
+                    result, metrics = job.result()
+                    local_images.extend(result)
+                    upload_metrics.METRICS.merge(metrics)
+                LOG.info('result %s' % local_images)
+        finally:
+            if run_cache_path:
+                PythonImageUploader.init_local_layer_cache()
+                shutil.rmtree(run_cache_path, ignore_errors=True)
+        if self.transfer_engine:
+            self.transfer_engine.shutdown()
+        self._save_inspect_cache()
+        self._write_metrics()
 
         # Do cleanup after all the uploads so common layers don't get deleted
         # repeatedly
@@ -2545,7 +4345,7 @@ class UploadTask(object):
 
     def __init__(self, image_name, pull_source, push_destination,
                  append_tag, modify_role, modify_vars, cleanup,
-                 multi_arch):
+                 multi_arch, extra_push_destinations=None):
         self.image_name = image_name
         self.pull_source = pull_source
         self.push_destination = push_destination
@@ -2554,6 +4354,9 @@ class UploadTask(object):
         self.modify_vars = modify_vars
         self.cleanup = cleanup
         self.multi_arch = multi_arch
+        # populated by the layer planning pass of the python uploader
+        self.source_manifests = None
+        self.source_layers = None
 
         if ':' in image_name:
             image = image_name.rpartition(':')[0]
@@ -2570,10 +4373,8 @@ class UploadTask(object):
         else:
             self.repo = image
 
-        if push_destination.endswith('/'):
-            push_destination = push_destination[:-1]
-        self.target_image_no_tag = (push_destination + '/' +
-                                    self.repo.partition('/')[2])
+        self.target_image_no_tag = self._target_image_no_tag(
+            push_destination)
         self.target_tag = self.source_tag + self.append_tag
         self.source_image = self.repo + ':' + self.source_tag
         self.target_image_source_tag = (self.target_image_no_tag + ':' +
@@ -2587,37 +4388,63 @@ class UploadTask(object):
             self.target_image_source_tag
         )
 
+        # the same image is also pushed to these destinations, from a
+        # single fetch of the source
+        self.extra_push_destinations = list(extra_push_destinations or [])
+        if self.extra_push_destinations and modify_role:
+            raise ImageUploaderException(
+                'Multiple push destinations are not supported with '
+                'modify_role for image %s' % image_name)
+        self.extra_target_images = [
+            self._target_image_no_tag(d) + ':' + self.target_tag
+            for d in self.extra_push_destinations]
+        self.extra_target_image_urls = [
+            image_to_url(i) for i in self.extra_target_images]
+
+    def _target_image_no_tag(self, push_destination):
+        if push_destination.endswith('/'):
+            push_destination = push_destination[:-1]
+        return push_destination + '/' + self.repo.partition('/')[2]
+
 
 def upload_task(args):
     uploader, task = args
     return uploader.upload_image(task)
 
 
+def _worker_metrics():
+    """Return the metrics recorded by a worker process
+
+    Metrics recorded in the collecting process are already in place, so
+    None is returned for them.
+    """
+    if os.getpid() == PythonImageUploader.metrics_pid:
+        return None
+    return upload_metrics.METRICS.drain()
+
+
+def upload_task_metrics(args):
+    """Run upload_task, also returning the metrics of a worker process"""
+    return upload_task(args), _worker_metrics()
+
+
+def modify_pull_task(args):
+    uploader, task = args
+    return uploader.pull_modify_image(task), _worker_metrics()
+
+
+def modify_push_task(args):
+    uploader, task, state = args
+    return uploader.push_modify_image(task, state), _worker_metrics()
+
+
 def discover_tag_from_inspect(args):
     self, image, tag_from_label, default_tag = args
     image_url = self._image_to_url(image)
-    username, password = self.credentials_for_registry(image_url.netloc)
-    try:
-        session = self.authenticate(
-            image_url, username=username, password=password)
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 401:
-            raise ImageUploaderException(
-                'Unable to authenticate. This may indicate '
-                'missing registry credentials or the provided '
-                'container or namespace does not exist. %s' % e)
-        raise
+    session = self._authenticate_image(image_url)
     i = self._inspect(image_url, session=session, default_tag=default_tag)
     session.close()
-    if ':' in image_url.path:
-        # break out the tag from the url to be the fallback tag
-        path = image.rpartition(':')
-        fallback_tag = path[2]
-        image = path[0]
-    else:
-        fallback_tag = None
-    return image, self._discover_tag_from_inspect(
-        i, image, tag_from_label, fallback_tag)
+    return self._discover_versioned_image(i, image, tag_from_label)
 
 
 def tags_for_image(args):
@@ -15,14 +15,17 @@
 
 
 import jinja2
+import json
 import os
 import re
+import six
 import subprocess
 import sys
 import tempfile
 import time
 import yaml
 
+from concurrent import futures
 from osc_lib.i18n import _
 from oslo_log import log as logging
 from tripleo_common.image import base
@@ -35,6 +38,10 @@ CONTAINER_IMAGE_PREPARE_PARAM = None
 
 CONTAINER_IMAGES_DEFAULTS = None
 
+# number of ContainerImagePrepare entries rendered and tag discovered at
+# the same time
+PREPARE_WORKERS = 4
+
 
 def init_prepare_defaults(defaults_file):
     global CONTAINER_IMAGE_PREPARE_PARAM_STR
@@ -136,24 +143,61 @@ def set_neutron_driver(pd, mapping_args):
 
 def container_images_prepare_multi(environment, roles_data, dry_run=False,
                                    cleanup=image_uploader.CLEANUP_FULL,
-                                   lock=None):
+                                   lock=None,
+                                   transfer_engine=(
+                                       image_uploader.TRANSFER_ENGINE_POOL),
+                                   layer_index_path=None,
+                                   inspect_cache_path=None,
+                                   registry_cache_path=None,
+                                   registry_cache_ttl=(
+                                       image_uploader.REGISTRY_CACHE_TTL),
+                                   metrics_path=None,
+                                   metrics_textfile=None,
+                                   layer_cache_path=None,
+                                   modify_batch_size=0):
     """Perform multiple container image prepares and merge result
 
     Given the full heat environment and roles data, perform multiple image
     prepare operations. The data to drive the multiple prepares is taken from
-    the ContainerImagePrepare parameter in the provided environment. If
-    push_destination is specified, uploads will be performed during the
-    preparation.
+    the ContainerImagePrepare parameter in the provided environment. The
+    entries are prepared concurrently. If push_destination is specified, the
+    images of every entry are then uploaded together by one upload.
 
     :param environment: Heat environment for deployment
     :param roles_data: Roles file data used to filter services
     :param lock: a locking object to use when handling uploads
+    :param transfer_engine: uploader transfer engine, one of
+                            image_uploader.TRANSFER_ENGINES
+    :param layer_index_path: file path of the persistent index of uploaded
+                             layers and manifests, or None to disable it
+    :param inspect_cache_path: file path of the image inspect cache kept
+                               between runs, or None to only cache for
+                               this run
+    :param registry_cache_path: file path of the registry capability cache
+                                kept between runs, or None to only cache
+                                for this run
+    :param registry_cache_ttl: seconds cached registry capabilities are
+                               trusted for
+    :param metrics_path: file path to write a JSON summary of the upload
+                         metrics to, or None
+    :param metrics_textfile: file path to write the upload metrics to in the
+                             Prometheus text format, or None
+    :param layer_cache_path: directory of compressed local layers kept
+                             between runs, or None to only cache for each
+                             upload
+    :param modify_batch_size: number of images modified by one playbook,
+                              or 0 to run a playbook per image
     :returns: dict containing merged container image parameters from all
               prepare operations
     """
 
     if not lock:
         lock = threadinglock.ThreadingLock()
+    image_uploader.BaseImageUploader.init_inspect_cache(inspect_cache_path)
+    image_uploader.BaseImageUploader.init_registry_cache(
+        registry_cache_path, registry_cache_ttl)
+    image_uploader.PythonImageUploader.init_metrics(
+        metrics_path, metrics_textfile)
 
     pd = environment.get('parameter_defaults', {})
     cip = pd.get('ContainerImagePrepare')
@@ -174,6 +218,7 @@ def container_images_prepare_multi(environment, roles_data, dry_run=False,
     env_params = {}
     service_filter = build_service_filter(environment, roles_data)
 
+    prepares = []
     for cip_entry in cip:
         mapping_args = cip_entry.get('set', {})
         set_neutron_driver(pd, mapping_args)
@@ -203,7 +248,7 @@ def container_images_prepare_multi(environment, roles_data, dry_run=False,
             # so set global multi_arch to False
             multi_arch = False
 
-        prepare_data = container_images_prepare(
+        prepares.append(dict(
             excludes=cip_entry.get('excludes'),
             includes=cip_entry.get('includes'),
             service_filter=service_filter,
@@ -222,26 +267,84 @@ def container_images_prepare_multi(environment, roles_data, dry_run=False,
             registry_credentials=creds,
             multi_arch=multi_arch,
             lock=lock
-        )
-        env_params.update(prepare_data['image_params'])
+        ))
+
+    # render and discover the tags of every entry at the same time, the
+    # results are merged in entry order so later entries still win
+    with futures.ThreadPoolExecutor(max_workers=PREPARE_WORKERS) as p:
+        jobs = [p.submit(container_images_prepare, **kwargs)
+                for kwargs in prepares]
+        results = [job.result() for job in jobs]
 
-        if not dry_run and (push_destination or pull_source or modify_role):
-            with tempfile.NamedTemporaryFile(mode='w') as f:
-                yaml.safe_dump({
-                    'container_images': prepare_data['upload_data']
-                }, f)
-                uploader = image_uploader.ImageUploadManager(
-                    [f.name],
-                    cleanup=cleanup,
-                    mirrors=mirrors,
-                    registry_credentials=creds,
-                    multi_arch=multi_arch,
-                    lock=lock
-                )
-                uploader.upload()
+    upload_data = []
+    for kwargs, prepare_data in zip(prepares, results):
+        env_params.update(prepare_data['image_params'])
+        if not (kwargs['push_destination'] or kwargs['pull_source'] or
+                kwargs['modify_role']):
+            continue
+        for item in prepare_data['upload_data']:
+            item['multi_arch'] = kwargs['multi_arch']
+            upload_data.append(item)
+
+    if not dry_run and upload_data:
+        # a single upload of every entry shares the layers fetched and
+        # pushed, and cleans up once at the end
+        with tempfile.NamedTemporaryFile(mode='w') as f:
+            yaml.safe_dump({
+                'container_images': merge_upload_data(upload_data)
+            }, f)
+            uploader = image_uploader.ImageUploadManager(
+                [f.name],
+                cleanup=cleanup,
+                mirrors=mirrors,
+                registry_credentials=creds,
+                multi_arch=multi_arch,
+                lock=lock,
+                transfer_engine=transfer_engine,
+                layer_index_path=layer_index_path,
+                layer_cache_path=layer_cache_path,
+                modify_batch_size=modify_batch_size
+            )
+            uploader.upload()
     return env_params
 
 
+def merge_upload_data(upload_data):
+    """Merge the upload entries of several prepares
+
+    Duplicate entries are dropped, and entries which only differ in their
+    push_destination become one entry with a list of push destinations, so
+    the image is fetched once for all of them. Entries with a modify_role
+    are only deduplicated.
+
+    :param upload_data: list of container_images upload entries
+    :returns: merged list of upload entries, in the original order
+    """
+    merged = []
+    by_key = {}
+    for item in upload_data:
+        push_destination = item.get('push_destination')
+        mergeable = (isinstance(push_destination, six.string_types) and
+                     not item.get('modify_role'))
+        key_item = dict(item)
+        if mergeable:
+            del key_item['push_destination']
+        key = (mergeable, json.dumps(key_item, sort_keys=True))
+        existing = by_key.get(key)
+        if existing is None:
+            by_key[key] = dict(item)
+            merged.append(by_key[key])
+            continue
+        if not mergeable:
+            continue
+        destinations = existing['push_destination']
+        if not isinstance(destinations, list):
+            destinations = [destinations]
+        if push_destination not in destinations:
+            existing['push_destination'] = destinations + [push_destination]
+    return merged
+
+
 def container_images_prepare_defaults():
     """Return default dict for prepare substitutions
 
@@ -421,8 +524,9 @@ def detect_insecure_registries(params, lock=None):
     """
     insecure = set()
     uploader = image_uploader.ImageUploadManager(lock=lock).uploader('python')
-    for image in params.values():
-        host = image.split('/')[0]
+    hosts = set(image.split('/')[0] for image in params.values())
+    uploader.probe_registries(hosts)
+    for host in hosts:
         if uploader.is_insecure_registry(host):
             insecure.add(host)
     if not insecure:
@@ -0,0 +1,181 @@
+#   Copyright 2020 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+import fcntl
+import json
+import os
+import tempfile
+
+from oslo_log import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+LAYER_INDEX_FILE = '.layer-index'
+
+RECORD_TYPES = (
+    RECORD_LAYER,
+    RECORD_FORGET,
+    RECORD_MANIFEST
+) = (
+    'layer',
+    'forget',
+    'manifest'
+)
+
+
+class LayerIndex(object):
+    """Persistent index of uploaded layers and manifests
+
+    The uploader global view of processed layers only lives as long as the
+    process, so every prepare run used to start cold and check every layer
+    against the target registry again. This index persists that view as an
+    append-only file of JSON records, one per line:
+
+    * layer: a layer digest was processed, with its scope, path, referencing
+      image and size, in the same form as the uploader global view
+    * forget: a layer digest is no longer known for any scope
+    * manifest: a source manifest digest was copied to a target image:tag,
+      with the digest the tag had once copied so the tag can be checked
+
+    Appends are serialized with an exclusive lock on the file. The index is
+    compacted on load once it holds twice as many records as live entries.
+
+    :param path: file path for the index
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _append(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        while True:
+            with open(self.path, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    # the index may have been compacted and replaced while
+                    # waiting for the lock, so write to the new file instead
+                    if os.fstat(f.fileno()).st_ino != os.stat(
+                            self.path).st_ino:
+                        continue
+                    f.write(line)
+                    f.flush()
+                    return
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def add_layer(self, layer, scope, path=None, ref=None, size=None):
+        self._append({
+            'type': RECORD_LAYER,
+            'digest': layer,
+            'scope': scope,
+            'path': path,
+            'ref': ref,
+            'size': size
+        })
+
+    def forget_layer(self, layer):
+        self._append({'type': RECORD_FORGET, 'digest': layer})
+
+    def add_manifest(self, digest, image, target_digest=None):
+        self._append({
+            'type': RECORD_MANIFEST,
+            'digest': digest,
+            'image': image,
+            'target_digest': target_digest
+        })
+
+    def load(self):
+        """Load the index
+
+        :returns: tuple of the layers dict, in the form of the uploader
+                  global view, and a dict of manifest digest to a dict of
+                  the target images it was copied to and their digest
+        """
+        layers = {}
+        manifests = {}
+        if not os.path.isfile(self.path):
+            return layers, manifests
+        records = 0
+        with open(self.path) as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a partially written record from an interrupted run
+                        LOG.warning('Skipping corrupt layer index record')
+                        continue
+                    records += 1
+                    self._apply(record, layers, manifests)
+
+                live = sum(len(x) for x in layers.values())
+                live += sum(len(x) for x in manifests.values())
+                if records > 2 * live:
+                    self._compact(layers, manifests)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return layers, manifests
+
+    @staticmethod
+    def _apply(record, layers, manifests):
+        rtype = record.get('type')
+        digest = record.get('digest')
+        if rtype == RECORD_LAYER:
+            entry = {'ref': record.get('ref'), 'path': record.get('path')}
+            if record.get('size') is not None:
+                entry['size'] = record['size']
+            layers.setdefault(digest, {})[record.get('scope')] = entry
+        elif rtype == RECORD_FORGET:
+            layers.pop(digest, None)
+        elif rtype == RECORD_MANIFEST:
+            manifests.setdefault(digest, {})[record.get('image')] = (
+                record.get('target_digest'))
+
+    def _compact(self, layers, manifests):
+        LOG.debug('Compacting layer index %s' % self.path)
+        index_dir = os.path.dirname(self.path) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=index_dir,
+                                        prefix=LAYER_INDEX_FILE)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for digest, scopes in layers.items():
+                    for scope, entry in scopes.items():
+                        record = {
+                            'type': RECORD_LAYER,
+                            'digest': digest,
+                            'scope': scope,
+                            'path': entry.get('path'),
+                            'ref': entry.get('ref'),
+                            'size': entry.get('size')
+                        }
+                        f.write(json.dumps(record, sort_keys=True) + '\n')
+                for digest, images in manifests.items():
+                    for image in sorted(images):
+                        record = {
+                            'type': RECORD_MANIFEST,
+                            'digest': digest,
+                            'image': image,
+                            'target_digest': images[image]
+                        }
+                        f.write(json.dumps(record, sort_keys=True) + '\n')
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, self.path)
+        except Exception as e:
+            LOG.warning('Unable to compact layer index %s: %s' %
+                        (self.path, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
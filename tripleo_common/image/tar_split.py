@@ -0,0 +1,230 @@
+#   Copyright 2020 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+import base64
+import errno
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import zlib
+
+from oslo_log import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+CHUNK_SIZE = 2 ** 20
+
+COMPRESS_LEVEL = 6
+
+ENTRY_TYPES = (
+    ENTRY_FILE,
+    ENTRY_SEGMENT
+) = (
+    1,
+    2
+)
+
+
+class TarSplitException(Exception):
+    pass
+
+
+def _entry_name(entry):
+    raw = entry.get('name_raw')
+    if raw:
+        return base64.b64decode(raw)
+    return entry.get('name', '')
+
+
+def _entry_path(root, name):
+    if not isinstance(name, str):
+        # python 2 unicode or python 3 bytes names
+        name = name.encode('utf-8') if str is bytes else os.fsdecode(name)
+    path = os.path.normpath(os.path.join(root, name))
+    if path != root and not path.startswith(os.path.join(root, '')):
+        raise TarSplitException('Entry %s is outside of %s' % (name, root))
+    return path
+
+
+def read_entries(tar_split_path):
+    """Yield the entries of a tar-split metadata file
+
+    The file is the gzipped stream of JSON entries containers-storage keeps
+    next to every layer. Segment entries carry the raw tar headers and
+    padding, file entries name a file of the layer diff and its size.
+    """
+    with gzip.open(tar_split_path, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line.decode('utf-8'))
+
+
+def assemble(tar_split_path, diff_path):
+    """Reassemble the original tar stream of a layer
+
+    This is what tar-split asm does, without a process per layer. File
+    sizes are checked against the metadata, the file checksums are not.
+
+    :param tar_split_path: path of the tar-split metadata file
+    :param diff_path: directory with the unpacked layer diff
+    :returns: generator of tar data chunks
+    """
+    diff_path = os.path.normpath(diff_path)
+    for entry in read_entries(tar_split_path):
+        entry_type = entry.get('type')
+        if entry_type == ENTRY_SEGMENT:
+            payload = entry.get('payload')
+            if payload:
+                yield base64.b64decode(payload)
+        elif entry_type == ENTRY_FILE:
+            size = entry.get('size', 0)
+            if not size:
+                continue
+            path = _entry_path(diff_path, _entry_name(entry))
+            remaining = size
+            with open(path, 'rb') as f:
+                while remaining:
+                    data = f.read(min(CHUNK_SIZE, remaining))
+                    if not data:
+                        raise TarSplitException(
+                            'File %s is shorter than %i bytes' %
+                            (path, size))
+                    remaining -= len(data)
+                    yield data
+        else:
+            raise TarSplitException('Unknown tar-split entry type %s' %
+                                    entry_type)
+
+
+def compress(chunks, level=COMPRESS_LEVEL):
+    """Gzip a stream of chunks
+
+    The gzip header carries no file name or time, so compressing the same
+    data always gives the same digest. Output is yielded in chunks of about
+    CHUNK_SIZE.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    buf = []
+    buf_len = 0
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            buf.append(data)
+            buf_len += len(data)
+        if buf_len >= CHUNK_SIZE:
+            yield b''.join(buf)
+            buf = []
+            buf_len = 0
+    buf.append(compressor.flush())
+    data = b''.join(buf)
+    if data:
+        yield data
+
+
+class LayerCache(object):
+    """Cache of compressed local layers, keyed by layer id
+
+    Every blob is stored as <layer id>.tar.gz next to a <layer id>.json
+    entry with its digest, size and the size and time of the tar-split file
+    it was made from, so an entry is not used once the layer is replaced.
+    Reassembly of a layer is serialized across threads and processes with
+    a lock file, and every layer is compressed at most once.
+
+    :param path: directory of the cache, created if missing
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _path(self, layer_id, extension):
+        return os.path.join(self.path, '%s%s' % (layer_id, extension))
+
+    @staticmethod
+    def _source_key(tar_split_path):
+        st = os.stat(tar_split_path)
+        return [st.st_size, st.st_mtime]
+
+    def lookup(self, layer_id, tar_split_path):
+        """Return the cached entry of a layer, or None
+
+        :returns: dict with the path, digest and size of the blob
+        """
+        try:
+            with open(self._path(layer_id, '.json')) as f:
+                entry = json.load(f)
+            source = self._source_key(tar_split_path)
+            blob_size = os.stat(entry['path']).st_size
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        if entry.get('source') != source or blob_size != entry.get('size'):
+            return None
+        return entry
+
+    def get(self, layer_id, tar_split_path, diff_path):
+        """Return the cached entry of a layer, compressing it if needed"""
+        entry = self.lookup(layer_id, tar_split_path)
+        if entry:
+            return entry
+        try:
+            os.makedirs(self.path, 0o775)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        with open(self._path(layer_id, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                entry = self.lookup(layer_id, tar_split_path)
+                if entry:
+                    return entry
+                return self._store(layer_id, tar_split_path, diff_path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _store(self, layer_id, tar_split_path, diff_path):
+        LOG.debug('[%s] Compressing layer to %s' % (layer_id, self.path))
+        source = self._source_key(tar_split_path)
+        blob_path = self._path(layer_id, '.tar.gz')
+        calc_digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.path,
+                                        prefix='.%s' % layer_id)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for data in compress(assemble(tar_split_path, diff_path)):
+                    f.write(data)
+                    calc_digest.update(data)
+                    size += len(data)
+            os.rename(tmp_path, blob_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        entry = {
+            'path': blob_path,
+            'digest': 'sha256:%s' % calc_digest.hexdigest(),
+            'size': size,
+            'source': source,
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=self.path,
+                                        prefix='.%s' % layer_id)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp_path, self._path(layer_id, '.json'))
+        return entry
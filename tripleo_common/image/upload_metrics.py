@@ -0,0 +1,268 @@
+#   Copyright 2020 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+import contextlib
+import functools
+import io
+import os
+import threading
+import time
+
+from oslo_log import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+PROMETHEUS_PREFIX = 'tripleo_image_upload'
+
+TRANSFER_DIRECTIONS = (
+    TRANSFER_PULL, TRANSFER_PUSH
+) = (
+    'pull', 'push'
+)
+
+
+class UploadMetrics(object):
+    """Counters and timers for the image upload pipeline
+
+    Phases are timed where they happen and may nest, for example the
+    layer_transfer phase runs inside upload_image, so phase times do not
+    add up to the wall time. Recorded values are:
+
+    * phases: count, total and max seconds per phase
+    * transfers: bytes and seconds per registry and direction
+    * retries: number of retried attempts per retried function
+    * dedup: hits and misses per kind of deduplication check
+
+    Worker processes get a copy of the metrics when they fork. They hand
+    back what they recorded with drain, and the parent merges it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.pid = os.getpid()
+            self.started = time.time()
+            self.phases = {}
+            self.transfers = {}
+            self.retries = {}
+            self.dedup = {}
+
+    def add_time(self, phase, seconds):
+        with self._lock:
+            entry = self.phases.setdefault(phase, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.time() - start)
+
+    def add_transfer(self, registry, direction, nbytes, seconds):
+        key = '%s|%s' % (registry, direction)
+        with self._lock:
+            entry = self.transfers.setdefault(key, [0, 0.0])
+            entry[0] += nbytes
+            entry[1] += seconds
+
+    def add_retry(self, name):
+        with self._lock:
+            self.retries[name] = self.retries.get(name, 0) + 1
+
+    def add_dedup(self, kind, hit):
+        with self._lock:
+            entry = self.dedup.setdefault(kind, [0, 0])
+            entry[0 if hit else 1] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'phases': dict((k, list(v)) for k, v in self.phases.items()),
+                'transfers': dict(
+                    (k, list(v)) for k, v in self.transfers.items()),
+                'retries': dict(self.retries),
+                'dedup': dict((k, list(v)) for k, v in self.dedup.items()),
+            }
+
+    def drain(self):
+        """Return everything recorded so far and start over"""
+        snapshot = self.snapshot()
+        self.reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        """Add a snapshot recorded by a worker process"""
+        if not snapshot:
+            return
+        with self._lock:
+            for phase, (count, total, longest) in snapshot.get(
+                    'phases', {}).items():
+                entry = self.phases.setdefault(phase, [0, 0.0, 0.0])
+                entry[0] += count
+                entry[1] += total
+                entry[2] = max(entry[2], longest)
+            for key, (nbytes, seconds) in snapshot.get(
+                    'transfers', {}).items():
+                entry = self.transfers.setdefault(key, [0, 0.0])
+                entry[0] += nbytes
+                entry[1] += seconds
+            for name, count in snapshot.get('retries', {}).items():
+                self.retries[name] = self.retries.get(name, 0) + count
+            for kind, (hits, misses) in snapshot.get('dedup', {}).items():
+                entry = self.dedup.setdefault(kind, [0, 0])
+                entry[0] += hits
+                entry[1] += misses
+
+    def summary(self):
+        """Return the recorded metrics as a JSON serializable dict"""
+        snapshot = self.snapshot()
+        phases = {}
+        for phase, (count, total, longest) in snapshot['phases'].items():
+            phases[phase] = {
+                'count': count,
+                'seconds': round(total, 3),
+                'max_seconds': round(longest, 3),
+            }
+        transfers = {}
+        for key, (nbytes, seconds) in snapshot['transfers'].items():
+            registry, direction = key.rsplit('|', 1)
+            transfers.setdefault(registry, {})[direction] = {
+                'bytes': nbytes,
+                'seconds': round(seconds, 3),
+                'bytes_per_second': int(nbytes / seconds) if seconds else 0,
+            }
+        dedup = {}
+        for kind, (hits, misses) in snapshot['dedup'].items():
+            checks = hits + misses
+            dedup[kind] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': round(float(hits) / checks, 3) if checks else 0,
+            }
+        return {
+            'wall_seconds': round(time.time() - self.started, 3),
+            'phases': phases,
+            'transfers': transfers,
+            'retries': snapshot['retries'],
+            'dedup': dedup,
+        }
+
+    def prometheus(self):
+        """Return the recorded metrics in the Prometheus text format"""
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            name = '%s_%s' % (PROMETHEUS_PREFIX, name)
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in sorted(samples):
+                label_str = ','.join(
+                    '%s="%s"' % (k, v) for k, v in labels)
+                if label_str:
+                    label_str = '{%s}' % label_str
+                lines.append('%s%s %s' % (name, label_str, value))
+
+        metric('wall_seconds', 'gauge', 'Time since the metrics started.',
+               [((), round(time.time() - self.started, 3))])
+        phases = snapshot['phases'].items()
+        metric('phase_seconds_total', 'counter', 'Time spent per phase.',
+               [((('phase', p),), round(v[1], 3)) for p, v in phases])
+        metric('phase_total', 'counter', 'Number of times a phase ran.',
+               [((('phase', p),), v[0]) for p, v in phases])
+        transfers = [
+            (k.rsplit('|', 1), v) for k, v in snapshot['transfers'].items()]
+        metric('transfer_bytes_total', 'counter',
+               'Bytes transferred per registry.',
+               [((('registry', r), ('direction', d)), v[0])
+                for (r, d), v in transfers])
+        metric('transfer_seconds_total', 'counter',
+               'Time spent transferring per registry.',
+               [((('registry', r), ('direction', d)), round(v[1], 3))
+                for (r, d), v in transfers])
+        metric('retries_total', 'counter', 'Retried attempts per function.',
+               [((('function', f),), v)
+                for f, v in snapshot['retries'].items()])
+        dedup = []
+        for kind, (hits, misses) in snapshot['dedup'].items():
+            dedup.append(((('kind', kind), ('result', 'hit')), hits))
+            dedup.append(((('kind', kind), ('result', 'miss')), misses))
+        metric('dedup_total', 'counter', 'Deduplication checks per kind.',
+               dedup)
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = UploadMetrics()
+
+
+def timed(phase):
+    """Decorate a function to record its calls as phase"""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with METRICS.timer(phase):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_retry(*args):
+    """tenacity before hook counting every attempt after the first
+
+    Older tenacity releases call the hook with the function and attempt
+    number instead of a retry state.
+    """
+    if len(args) == 1:
+        fn = args[0].fn
+        attempt = args[0].attempt_number
+    else:
+        fn, attempt = args[:2]
+    if attempt > 1:
+        METRICS.add_retry(getattr(fn, '__name__', str(fn)))
+
+
+def _chunk_size(data):
+    if isinstance(data, bytes):
+        return len(data)
+    # a readable file the consumer copies itself, such as a cached layer
+    try:
+        return os.fstat(data.fileno()).st_size
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return 0
+
+
+def count_stream(stream, registry, direction):
+    """Record the bytes of a layer stream and the time it took
+
+    The stream may also yield readable files instead of data chunks, which
+    are counted by their size.
+    """
+    start = time.time()
+    nbytes = 0
+    try:
+        for data in stream:
+            nbytes += _chunk_size(data)
+            yield data
+    finally:
+        METRICS.add_transfer(registry, direction, nbytes,
+                             time.time() - start)
@@ -15,11 +15,17 @@
 """Unit tests for image.builder.buildah"""
 
 import copy
+import json
 import mock
+import os
+import shutil
+import tempfile
+import threading
+import time
 
-from concurrent import futures
-from concurrent.futures import ThreadPoolExecutor as tpe
+from oslo_concurrency import processutils
 
+from tripleo_common.image.builder import buildah
 from tripleo_common.image.builder.buildah import BuildahBuilder as bb
 from tripleo_common.tests import base
 from tripleo_common.utils import process
@@ -36,36 +42,17 @@ BUILD_ALL_DICT_CONTAINERS = {
     'container3': {}
 }
 BUILD_ALL_STR_CONTAINER = 'container1'
-
-
-class ThreadPoolExecutorReturn(object):
-    _exception = None
-
-
-class ThreadPoolExecutorReturnFailed(object):
-    _exception = True
-    exception_info = "This is a test failure"
-
-
-class ThreadPoolExecutorReturnSuccess(object):
-    _exception = False
-
-
-# Iterable version of the return values for predictable submit() returns
-R_FAILED_LIST = [ThreadPoolExecutorReturnSuccess(),
-                 ThreadPoolExecutorReturnSuccess(),
-                 ThreadPoolExecutorReturnFailed()]
-R_OK_LIST = [ThreadPoolExecutorReturnSuccess(),
-             ThreadPoolExecutorReturnSuccess(),
-             ThreadPoolExecutorReturnSuccess()]
-R_BROKEN_LISTS = [[ThreadPoolExecutorReturnSuccess()],
-                  [ThreadPoolExecutorReturn(),
-                   ThreadPoolExecutorReturn()]]
-
-# Return values as done and not_done sets for the ThreadPoolExecutor
-R_FAILED = (set(R_FAILED_LIST), set())
-R_OK = (set(R_OK_LIST), set())
-R_BROKEN = (set(R_BROKEN_LISTS[0]), set(R_BROKEN_LISTS[1]))
+BUILD_ALL_TREE = {
+    'base': {
+        'openstack-base': [
+            'keystone',
+            {'nova-base': ['nova-api', 'nova-compute']},
+            {'neutron-base': {
+                'neutron-agent-base': ['neutron-l3-agent']}},
+        ],
+        'ovn-base': ['ovn-controller'],
+    }
+}
 
 
 class TestBuildahBuilder(base.TestCase):
@@ -134,6 +121,16 @@ class TestBuildahBuilder(base.TestCase):
             'fedora-base')
         assert not mock_process.called
 
+    @mock.patch.object(process, 'execute', autospec=True)
+    def test_pull(self, mock_process):
+        dest = '127.0.0.1:8787/master/fedora-binary-fedora-base:latest'
+        bb(WORK_DIR, DEPS).pull(dest)
+        mock_process.assert_called_once_with(
+            *(BUILDAH_CMD_BASE + ['pull', '--tls-verify=False',
+                                  'docker://' + dest]),
+            run_as_root=False, use_standard_locale=True
+        )
+
     @mock.patch.object(process, 'execute', autospec=True)
     def test_push(self, mock_process):
         args = copy.copy(BUILDAH_CMD_BASE)
@@ -166,50 +163,328 @@ class TestBuildahBuilder(base.TestCase):
         mock_build.assert_called_once_with(builder, container_name, "")
         assert not mock_push.called
 
-    @mock.patch.object(tpe, 'submit', autospec=True)
-    @mock.patch.object(futures, 'wait', autospec=True, return_value=R_BROKEN)
+    def _build_tree(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        for path, data in (
+                ('base/Containerfile', 'FROM ubi8\n'),
+                ('base/base-build.log', 'log\n'),
+                ('base/files/repo', 'repo\n'),
+                ('base/child/Containerfile', 'FROM base\n'),
+                ('other/Containerfile', 'FROM ubi8\n')):
+            path = os.path.join(work_dir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(data)
+        builder = bb(work_dir, DEPS, build_cache=True)
+        builder.parents.update({'child': 'base'})
+        builder.base_digests['ubi8'] = 'sha256:1111'
+        return builder
+
+    def test_base_images(self):
+        builder = self._build_tree()
+        path = os.path.join(builder.work_dir, 'base', 'Containerfile')
+        with open(path, 'w') as f:
+            f.write('FROM --platform=linux/amd64 ubi8 AS build\n'
+                    'RUN make\n'
+                    'FROM build\n'
+                    'from registry.example.com/ubi8-minimal:8.4\n'
+                    'FROM scratch\n')
+        self.assertEqual(
+            ['ubi8', 'registry.example.com/ubi8-minimal:8.4'],
+            builder._base_images(builder.cont_map['base']))
+
     @mock.patch.object(process, 'execute', autospec=True)
-    def test_build_all_list_broken(self, mock_build, mock_wait, mock_submit):
-        mock_submit.side_effect = R_BROKEN_LISTS[0] + R_BROKEN_LISTS[1]
-        _b = bb(WORK_DIR, DEPS)
-        self.assertRaises(
-            SystemError,
-            _b.build_all,
-            deps=BUILD_ALL_LIST_CONTAINERS
-        )
+    def test_base_image_digest(self, mock_process):
+        builder = self._build_tree()
+        mock_process.return_value = (
+            json.dumps({'Digest': 'sha256:2222'}), '')
+        self.assertEqual('sha256:2222', builder._base_image_digest('ubi9'))
+        self.assertEqual('sha256:2222', builder._base_image_digest('ubi9'))
+        mock_process.assert_called_once_with(
+            'skopeo', 'inspect', '--tls-verify=false', 'docker://ubi9',
+            run_as_root=False, use_standard_locale=True)
+
+        mock_process.side_effect = processutils.ProcessExecutionError()
+        self.assertIsNone(builder._base_image_digest('missing'))
+
+    def test_build_digest(self):
+        builder = self._build_tree()
+        self.assertEqual(
+            [os.path.join(builder.work_dir, 'base', 'Containerfile'),
+             os.path.join(builder.work_dir, 'base', 'files', 'repo')],
+            builder._container_files(builder.cont_map['base']))
+        digests = dict((c, builder._build_digest(c))
+                       for c in ('base', 'child', 'other'))
+        self.assertEqual(3, len(set(digests.values())))
+
+        def changed(path, data):
+            with open(os.path.join(builder.work_dir, path), 'w') as f:
+                f.write(data)
+            builder.build_digests.clear()
+            return dict((c, builder._build_digest(c)) for c in digests)
+
+        # build logs are not build inputs
+        self.assertEqual(digests, changed('base/base-build.log', 'new\n'))
+
+        # a change to a child only changes its digest
+        new = changed('base/child/Containerfile', 'FROM base\nRUN true\n')
+        self.assertEqual(digests['base'], new['base'])
+        self.assertNotEqual(digests['child'], new['child'])
+
+        # a change to a parent changes its children
+        new2 = changed('base/files/repo', 'other repo\n')
+        self.assertNotEqual(new['base'], new2['base'])
+        self.assertNotEqual(new['child'], new2['child'])
+        self.assertEqual(digests['other'], new2['other'])
+
+        # a new base image changes every image built from it
+        builder.base_digests['ubi8'] = 'sha256:2222'
+        builder.build_digests.clear()
+        new3 = dict((c, builder._build_digest(c)) for c in digests)
+        self.assertEqual(3, len(set(new3.values()) - set(new2.values())))
+
+        # no build digest without the base image digest
+        builder.base_digests['ubi8'] = None
+        builder.build_digests.clear()
+        self.assertIsNone(builder._build_digest('child'))
+        self.assertIsNone(builder._build_digest('other'))
+
+    @mock.patch.object(process, 'execute', autospec=True)
+    def test_build_digest_label(self, mock_process):
+        builder = self._build_tree()
+        builder.build('child', builder.cont_map['child'])
+        args = mock_process.call_args[0]
+        label = args.index('--label')
+        self.assertEqual(
+            '%s=%s' % (buildah.BUILD_DIGEST_LABEL,
+                       builder._build_digest('child')),
+            args[label + 1])
+
+    @mock.patch.object(bb, 'build', autospec=True)
+    @mock.patch.object(bb, 'push', autospec=True)
+    @mock.patch.object(process, 'execute', autospec=True)
+    def test_generate_container_cached(self, mock_process, mock_push,
+                                       mock_build):
+        builder = self._build_tree()
+        builder.push_containers = True
+        digest = builder._build_digest('child')
+        dest = builder._get_destination('child')
+        labels = {buildah.BUILD_DIGEST_LABEL: digest}
+
+        # up to date in the registry
+        mock_process.side_effect = [
+            (json.dumps({'Labels': labels}), '')
+        ]
+        builder._generate_container('child')
+        mock_process.assert_called_once_with(
+            'skopeo', 'inspect', '--tls-verify=false', 'docker://' + dest,
+            run_as_root=False, use_standard_locale=True)
+        mock_build.assert_not_called()
+        mock_push.assert_not_called()
+
+        # up to date locally
+        mock_process.reset_mock()
+        mock_process.side_effect = [
+            processutils.ProcessExecutionError(),
+            (json.dumps(labels), '')
+        ]
+        builder._generate_container('child')
+        mock_build.assert_not_called()
+        mock_push.assert_called_once_with(builder, dest)
 
-    @mock.patch.object(tpe, 'submit', autospec=True)
-    @mock.patch.object(futures, 'wait', autospec=True, return_value=R_FAILED)
+        # out of date
+        mock_push.reset_mock()
+        mock_process.reset_mock()
+        mock_process.side_effect = [
+            (json.dumps({'Labels': {}}), ''),
+            ('null', '')
+        ]
+        builder._generate_container('child')
+        mock_build.assert_called_once_with(
+            builder, 'child', builder.cont_map['child'])
+        mock_push.assert_called_once_with(builder, dest)
+
+    @mock.patch.object(bb, 'build', autospec=True)
+    @mock.patch.object(bb, 'pull', autospec=True)
+    @mock.patch.object(process, 'execute', autospec=True)
+    def test_generate_container_cached_parent(self, mock_process, mock_pull,
+                                              mock_build):
+        builder = self._build_tree()
+        builder.push_containers = True
+        digest = builder._build_digest('base')
+        dest = builder._get_destination('base')
+        labels = {buildah.BUILD_DIGEST_LABEL: digest}
+
+        # up to date in the registry only, pulled for the children
+        mock_process.side_effect = [
+            (json.dumps({'Labels': labels}), ''),
+            processutils.ProcessExecutionError()
+        ]
+        builder._generate_container('base')
+        mock_build.assert_not_called()
+        mock_pull.assert_called_once_with(builder, dest)
+
+        # up to date locally too
+        mock_pull.reset_mock()
+        mock_process.side_effect = [
+            (json.dumps({'Labels': labels}), ''),
+            (json.dumps(labels), '')
+        ]
+        builder._generate_container('base')
+        mock_build.assert_not_called()
+        mock_pull.assert_not_called()
+
+    @mock.patch.object(bb, 'build', autospec=True)
+    @mock.patch.object(bb, 'push', autospec=True)
     @mock.patch.object(process, 'execute', autospec=True)
-    def test_build_all_list_failed(self, mock_build, mock_wait, mock_submit):
-        mock_submit.side_effect = R_FAILED_LIST
-        _b = bb(WORK_DIR, DEPS)
+    def test_generate_container_unresolved_base(self, mock_process,
+                                                mock_push, mock_build):
+        builder = self._build_tree()
+        builder.base_digests['ubi8'] = None
+        builder._generate_container('other')
+        mock_process.assert_not_called()
+        mock_build.assert_called_once_with(
+            builder, 'other', builder.cont_map['other'])
+        mock_push.assert_called_once_with(
+            builder, builder._get_destination('other'))
+
+    def test_dependency_graph(self):
+        self.assertEqual([
+            ('base', None),
+            ('openstack-base', 'base'),
+            ('keystone', 'openstack-base'),
+            ('nova-base', 'openstack-base'),
+            ('nova-api', 'nova-base'),
+            ('nova-compute', 'nova-base'),
+            ('neutron-base', 'openstack-base'),
+            ('neutron-agent-base', 'neutron-base'),
+            ('neutron-l3-agent', 'neutron-agent-base'),
+            ('ovn-base', 'base'),
+            ('ovn-controller', 'ovn-base'),
+        ], list(bb._dependency_graph(BUILD_ALL_TREE).items()))
+        self.assertEqual(
+            [('container1', None), ('container2', None),
+             ('container3', None)],
+            list(bb._dependency_graph(BUILD_ALL_LIST_CONTAINERS).items()))
+        self.assertEqual(
+            [('container1', None)],
+            list(bb._dependency_graph(BUILD_ALL_STR_CONTAINER).items()))
+
+    @mock.patch.object(bb, '_generate_container', autospec=True)
+    def test_build_all_tree(self, mock_generate):
+        built = []
+        lock = threading.Lock()
+        graph = bb._dependency_graph(BUILD_ALL_TREE)
+
+        def generate(builder, container):
+            with lock:
+                # the parent image is always built first
+                self.assertTrue(graph[container] is None or
+                                graph[container] in built)
+                built.append(container)
+
+        mock_generate.side_effect = generate
+        _b = bb(WORK_DIR, DEPS, workers=4)
+        _b.build_all(deps=BUILD_ALL_TREE)
+        self.assertEqual(sorted(graph), sorted(built))
+        self.assertEqual(sorted(graph), sorted(_b.build_times))
+
+    @mock.patch.object(bb, '_generate_container', autospec=True)
+    def test_build_all_longest_path_first(self, mock_generate):
+        _b = bb(WORK_DIR, DEPS, workers=1)
+        _b.build_all(deps=BUILD_ALL_TREE)
+        self.assertEqual([
+            'base',
+            'openstack-base',
+            'neutron-base',
+            'nova-base',
+            'neutron-agent-base',
+            'ovn-base',
+            'keystone',
+            'nova-api',
+            'nova-compute',
+            'neutron-l3-agent',
+            'ovn-controller',
+        ], [c[0][1] for c in mock_generate.call_args_list])
+
+    @mock.patch.object(bb, '_generate_container', autospec=True)
+    def test_build_all_siblings_parallel(self, mock_generate):
+        # leaves of different parents are built at the same time
+        started = {
+            'nova-api': threading.Event(),
+            'ovn-controller': threading.Event(),
+        }
+        together = []
+
+        def generate(builder, container):
+            if container in started:
+                started[container].set()
+                together.append(all(e.wait(5) for e in started.values()))
+
+        mock_generate.side_effect = generate
+        bb(WORK_DIR, DEPS, workers=4).build_all(deps={
+            'base': {
+                'nova-base': ['nova-api'],
+                'ovn-base': ['ovn-controller'],
+            }
+        })
+        self.assertEqual(5, mock_generate.call_count)
+        self.assertEqual([True, True], together)
+
+    @mock.patch.object(bb, '_generate_container', autospec=True)
+    def test_build_all_failed(self, mock_generate):
+        def generate(builder, container):
+            if container == 'nova-base':
+                raise ValueError('This is a test failure')
+
+        mock_generate.side_effect = generate
+        _b = bb(WORK_DIR, DEPS, workers=1)
         self.assertRaises(
             RuntimeError,
             _b.build_all,
+            deps=BUILD_ALL_TREE
+        )
+        # nothing is started after a failure
+        built = [c[0][1] for c in mock_generate.call_args_list]
+        self.assertEqual('nova-base', built[-1])
+        self.assertNotIn('nova-api', built)
+
+    @mock.patch.object(bb, '_generate_container', autospec=True)
+    def test_build_all_timeout(self, mock_generate):
+        event = threading.Event()
+        self.addCleanup(event.set)
+
+        def generate(builder, container):
+            if container == 'container2':
+                event.wait(5)
+
+        mock_generate.side_effect = generate
+        _b = bb(WORK_DIR, DEPS, workers=2)
+        _b.build_timeout = 0.2
+        start = time.time()
+        e = self.assertRaises(
+            SystemError,
+            _b.build_all,
             deps=BUILD_ALL_LIST_CONTAINERS
         )
+        self.assertLess(time.time() - start, 4)
+        self.assertIn('container2', str(e))
+        self.assertNotIn('container1', str(e))
 
-    @mock.patch.object(tpe, 'submit', autospec=True)
-    @mock.patch.object(futures, 'wait', autospec=True, return_value=R_OK)
     @mock.patch.object(process, 'execute', autospec=True)
-    def test_build_all_list_ok(self, mock_build, mock_wait, mock_submit):
+    def test_build_all_list_ok(self, mock_build):
         bb(WORK_DIR, DEPS).build_all(deps=BUILD_ALL_LIST_CONTAINERS)
 
-    @mock.patch.object(tpe, 'submit', autospec=True)
-    @mock.patch.object(futures, 'wait', autospec=True, return_value=R_OK)
     @mock.patch.object(process, 'execute', autospec=True)
-    def test_build_all_ok_no_deps(self, mock_build, mock_wait, mock_submit):
+    def test_build_all_ok_no_deps(self, mock_build):
         bb(WORK_DIR, DEPS).build_all()
 
-    @mock.patch.object(tpe, 'submit', autospec=True)
-    @mock.patch.object(futures, 'wait', autospec=True, return_value=R_OK)
     @mock.patch.object(process, 'execute', autospec=True)
-    def test_build_all_dict_ok(self, mock_build, mock_wait, mock_submit):
+    def test_build_all_dict_ok(self, mock_build):
         bb(WORK_DIR, DEPS).build_all(deps=BUILD_ALL_DICT_CONTAINERS)
 
-    @mock.patch.object(tpe, 'submit', autospec=True)
-    @mock.patch.object(futures, 'wait', autospec=True, return_value=R_OK)
     @mock.patch.object(process, 'execute', autospec=True)
-    def test_build_all_str_ok(self, mock_build, mock_wait, mock_submit):
+    def test_build_all_str_ok(self, mock_build):
         bb(WORK_DIR, DEPS).build_all(deps=BUILD_ALL_STR_CONTAINER)
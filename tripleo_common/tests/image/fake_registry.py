@@ -0,0 +1,567 @@
+#   Copyright 2020 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+"""In-process stand-in for a Docker v2 registry, and an upload benchmark
+
+The registry keeps blobs and manifests in memory and implements the parts
+of the distribution API the python uploader uses: bearer token auth, blob
+and manifest GET/HEAD/PUT, ranged blob downloads, chunked and monolithic
+blob uploads, cross repository mounts and tag lists. Latency, bandwidth
+and rate limiting can be simulated per registry.
+
+run_benchmark fills a source registry with synthetic images and uploads
+them with ImageUploadManager, either to a push capable registry or to an
+export target, and reports what it took. See
+tools/image_upload_benchmark.py for the command line.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import re
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+import six
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+from six.moves.urllib import parse
+import yaml
+
+from tripleo_common.image import image_export
+from tripleo_common.image import image_uploader
+from tripleo_common.image import upload_metrics
+from tripleo_common.utils.locks import threadinglock
+
+
+MEDIA_MANIFEST_V2 = image_uploader.MEDIA_MANIFEST_V2
+MEDIA_CONFIG = image_uploader.MEDIA_CONFIG
+MEDIA_BLOB_COMPRESSED = image_uploader.MEDIA_BLOB_COMPRESSED
+
+# Size of the chunks bodies are sent and received in when throttled
+THROTTLE_CHUNK_SIZE = 64 * 1024
+
+PATH_RE = re.compile(
+    r'^/v2/(?P<name>.+)/(?P<kind>manifests|blobs|tags)/(?P<ref>.*)$')
+
+
+def digest_of(data):
+    return 'sha256:%s' % hashlib.sha256(data).hexdigest()
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeRegistryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def registry(self):
+        return self.server.registry
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_HEAD(self):
+        self._dispatch('HEAD')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PATCH(self):
+        self._dispatch('PATCH')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        chunks = []
+        while length:
+            chunk = self.rfile.read(min(length, THROTTLE_CHUNK_SIZE))
+            if not chunk:
+                break
+            length -= len(chunk)
+            chunks.append(chunk)
+            self.registry.throttle(len(chunk))
+        return b''.join(chunks)
+
+    def _send(self, status, body=b'', headers=None, head=False):
+        self.send_response(status)
+        headers = dict(headers or {})
+        headers.setdefault('Content-Length', str(len(body)))
+        headers.setdefault('Docker-Distribution-API-Version',
+                           'registry/2.0')
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        if head:
+            return
+        for i in range(0, len(body), THROTTLE_CHUNK_SIZE):
+            chunk = body[i:i + THROTTLE_CHUNK_SIZE]
+            self.wfile.write(chunk)
+            self.registry.throttle(len(chunk))
+
+    def _send_json(self, status, data, headers=None):
+        headers = dict(headers or {})
+        headers['Content-Type'] = 'application/json'
+        self._send(status, json.dumps(data).encode('utf-8'), headers)
+
+    def _dispatch(self, method):
+        url = parse.urlparse(self.path)
+        query = dict(parse.parse_qsl(url.query))
+        body = self._read_body() if method in ('POST', 'PATCH',
+                                               'PUT') else b''
+        reg = self.registry
+        kind = 'token' if url.path == '/token' else 'ping'
+        m = PATH_RE.match(url.path)
+        if m:
+            kind = m.group('kind')
+            if kind == 'blobs' and m.group('ref').startswith('uploads/'):
+                kind = 'uploads'
+        reg.count_request(method, kind)
+        if reg.latency:
+            time.sleep(reg.latency)
+
+        if kind == 'token':
+            return self._send_json(200, reg.issue_token())
+        if reg.rate_limited(kind):
+            return self._send(429, headers={
+                'Retry-After': str(reg.retry_after)})
+        if not reg.authorized(self.headers.get('Authorization')):
+            return self._send(401, headers={
+                'www-authenticate': 'Bearer realm="%s/token",'
+                                    'service="fake-registry"' % reg.url})
+        if kind == 'ping':
+            return self._send_json(200, {})
+        if not m:
+            return self._send(404)
+
+        name, ref = m.group('name'), m.group('ref')
+        if kind == 'manifests':
+            return self._manifests(method, name, ref, body)
+        if kind == 'blobs':
+            return self._blobs(method, ref)
+        if kind == 'uploads':
+            if not reg.push:
+                return self._send(405)
+            form = dict(parse.parse_qsl(body.decode('utf-8'))) if (
+                method == 'POST' and body) else {}
+            query.update(form)
+            return self._uploads(method, name, ref[len('uploads/'):],
+                                 query, body)
+        if kind == 'tags' and method == 'GET':
+            return self._send_json(200, {
+                'name': name, 'tags': reg.tags(name)})
+        return self._send(405)
+
+    def _manifests(self, method, name, ref, body):
+        reg = self.registry
+        head = method == 'HEAD'
+        if method in ('GET', 'HEAD'):
+            found = reg.get_manifest(name, ref)
+            if not found:
+                return self._send(404, head=head)
+            media_type, data = found
+            return self._send(200, data, {
+                'Content-Type': media_type,
+                'Docker-Content-Digest': digest_of(data)}, head=head)
+        if method == 'PUT':
+            if not reg.push:
+                return self._send(405)
+            digest = reg.put_manifest(
+                name, ref, self.headers.get('Content-Type'), body)
+            return self._send(201, headers={
+                'Location': '%s/v2/%s/manifests/%s' % (reg.url, name, digest),
+                'Docker-Content-Digest': digest})
+        return self._send(405)
+
+    def _blobs(self, method, digest):
+        reg = self.registry
+        head = method == 'HEAD'
+        if method not in ('GET', 'HEAD'):
+            return self._send(405)
+        data = reg.blobs.get(digest)
+        if data is None:
+            return self._send(404, head=head)
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'Content-Type': 'application/octet-stream',
+            'Docker-Content-Digest': digest}
+        m = re.match(r'bytes=(\d+)-(\d*)',
+                     self.headers.get('Range') or '')
+        if not m or head:
+            return self._send(200, data, headers, head=head)
+        start = int(m.group(1))
+        end = int(m.group(2)) if m.group(2) else len(data) - 1
+        headers['Content-Range'] = 'bytes %i-%i/%i' % (start, end, len(data))
+        return self._send(206, data[start:end + 1], headers)
+
+    def _uploads(self, method, name, upload_id, query, body):
+        reg = self.registry
+        if method == 'POST':
+            mount = query.get('mount')
+            if mount and mount in reg.blobs:
+                reg.count_mount()
+                return self._send(201, headers={
+                    'Location': '%s/v2/%s/blobs/%s' % (reg.url, name, mount),
+                    'Docker-Content-Digest': mount})
+            upload_id = reg.start_upload()
+            return self._send(202, headers={
+                'Location': '%s/v2/%s/blobs/uploads/%s' % (
+                    reg.url, name, upload_id),
+                'Range': '0-0',
+                'Docker-Upload-UUID': upload_id})
+
+        data = reg.uploads.get(upload_id)
+        if data is None:
+            return self._send(404)
+        location = '%s/v2/%s/blobs/uploads/%s' % (reg.url, name, upload_id)
+        if method == 'GET':
+            return self._send(204, headers={
+                'Location': location,
+                'Range': '0-%i' % max(len(data) - 1, 0)})
+        if method == 'PATCH':
+            data.extend(body)
+            return self._send(202, headers={
+                'Location': location,
+                'Range': '0-%i' % max(len(data) - 1, 0)})
+        if method == 'PUT':
+            data.extend(body)
+            digest = query.get('digest')
+            if digest != digest_of(bytes(data)):
+                return self._send(400)
+            reg.finish_upload(upload_id, digest)
+            return self._send(201, headers={
+                'Location': '%s/v2/%s/blobs/%s' % (reg.url, name, digest),
+                'Docker-Content-Digest': digest})
+        return self._send(405)
+
+
+class FakeRegistry(object):
+    """Docker v2 registry served from memory on a local port
+
+    :param auth: require a bearer token from the /token endpoint
+    :param push: accept uploads, otherwise uploads are refused with a 405
+                 the way an export target (image-serve) refuses them. The
+                 registry does not serve what was exported to it.
+    :param latency: seconds added to every request
+    :param bandwidth: bytes per second each request body is limited to,
+                      or None for no limit
+    :param rate_limit_every: answer every Nth blob, manifest or upload
+                             request with a 429, 0 to disable
+    :param retry_after: Retry-After seconds sent with a 429
+    :param token_ttl: expires_in seconds of issued tokens
+    """
+
+    def __init__(self, auth=False, push=True, latency=0.0, bandwidth=None,
+                 rate_limit_every=0, retry_after=0, token_ttl=300):
+        self.auth = auth
+        self.push = push
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.token_ttl = token_ttl
+        self.blobs = {}
+        self.manifests = {}
+        self.uploads = {}
+        self.requests = collections.Counter()
+        self.mounts = 0
+        self._tokens = set()
+        self._limited = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def netloc(self):
+        return '%s:%s' % self._server.server_address[:2]
+
+    @property
+    def url(self):
+        return 'http://%s' % self.netloc
+
+    def start(self):
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0),
+                                            FakeRegistryHandler)
+        self._server.registry = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def throttle(self, nbytes):
+        if self.bandwidth:
+            time.sleep(float(nbytes) / self.bandwidth)
+
+    def count_request(self, method, kind):
+        with self._lock:
+            self.requests['%s %s' % (method, kind)] += 1
+
+    def count_mount(self):
+        with self._lock:
+            self.mounts += 1
+
+    def rate_limited(self, kind):
+        if not self.rate_limit_every or kind in ('ping', 'token'):
+            return False
+        with self._lock:
+            self._limited += 1
+            return self._limited % self.rate_limit_every == 0
+
+    def issue_token(self):
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._tokens.add(token)
+        return {'token': token, 'expires_in': self.token_ttl}
+
+    def authorized(self, header):
+        if not self.auth:
+            return True
+        if not header or not header.startswith('Bearer '):
+            return False
+        return header[len('Bearer '):] in self._tokens
+
+    def add_blob(self, data):
+        digest = digest_of(data)
+        self.blobs[digest] = data
+        return digest
+
+    def get_manifest(self, name, ref):
+        return self.manifests.get((name, ref))
+
+    def put_manifest(self, name, ref, media_type, data):
+        digest = digest_of(data)
+        with self._lock:
+            self.manifests[(name, ref)] = (media_type, data)
+            self.manifests[(name, digest)] = (media_type, data)
+        return digest
+
+    def tags(self, name):
+        return sorted(ref for (n, ref) in self.manifests
+                      if n == name and not ref.startswith('sha256:'))
+
+    def start_upload(self):
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self.uploads[upload_id] = bytearray()
+        return upload_id
+
+    def finish_upload(self, upload_id, digest):
+        with self._lock:
+            self.blobs[digest] = bytes(self.uploads.pop(upload_id))
+
+    def add_image(self, name, tag, layers):
+        """Store an image made of the given layer blobs
+
+        :returns: digest of the manifest
+        """
+        config = json.dumps({
+            'architecture': 'amd64',
+            'os': 'linux',
+            'config': {'Labels': {'name': name}},
+            'rootfs': {
+                'type': 'layers',
+                'diff_ids': [digest_of(layer) for layer in layers]},
+        }).encode('utf-8')
+        manifest = json.dumps({
+            'schemaVersion': 2,
+            'mediaType': MEDIA_MANIFEST_V2,
+            'config': {
+                'mediaType': MEDIA_CONFIG,
+                'size': len(config),
+                'digest': self.add_blob(config)},
+            'layers': [{
+                'mediaType': MEDIA_BLOB_COMPRESSED,
+                'size': len(layer),
+                'digest': self.add_blob(layer)} for layer in layers],
+        }, indent=3).encode('utf-8')
+        return self.put_manifest(name, tag, MEDIA_MANIFEST_V2, manifest)
+
+
+def synthetic_images(registry, namespace='tripleo', count=10,
+                     layers_per_image=4, shared_layers=2,
+                     layer_size=1024 * 1024, tag='latest'):
+    """Fill a registry with images which share some of their layers
+
+    Every image has layers_per_image layers. The first shared_layers of
+    them are the same for all images, like the base and common layers of
+    the TripleO images, the rest are unique to the image.
+
+    :returns: list of image names, with registry and tag
+    """
+    shared = [os.urandom(layer_size) for i in range(shared_layers)]
+    images = []
+    for i in range(count):
+        name = '%s/image-%03d' % (namespace, i)
+        unique = [os.urandom(layer_size)
+                  for j in range(layers_per_image - shared_layers)]
+        registry.add_image(name, tag, shared + unique)
+        images.append('%s/%s:%s' % (registry.netloc, name, tag))
+    return images
+
+
+def _reset_uploader_state():
+    """Forget what earlier uploads in this process have seen"""
+    uploader = image_uploader.PythonImageUploader
+    uploader.init_registries_cache()
+    uploader.uploaded_layers.clear()
+    uploader.uploaded_manifests.clear()
+    uploader.unverified_layers.clear()
+    uploader.inspect_cache.clear()
+    uploader.token_cache.clear()
+    uploader.lock = None
+    uploader.init_metrics()
+
+
+def _peak_rss_kb():
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss +
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def run_benchmark(target='push', count=10, layers_per_image=4,
+                  shared_layers=2, layer_size=1024 * 1024,
+                  source_options=None, target_options=None,
+                  transfer_engine=image_uploader.TRANSFER_ENGINE_POOL,
+                  destinations=1):
+    """Upload synthetic images between fake registries and measure it
+
+    :param target: 'push' to upload to a registry accepting pushes,
+                   'export' to export to a local image-serve directory
+    :param source_options: FakeRegistry arguments for the source
+    :param target_options: FakeRegistry arguments for the target
+    :param destinations: number of push registries every image is also
+                         uploaded to, from a single fetch of the source
+    :returns: dict report of the run
+    """
+    source = FakeRegistry(**(source_options or {})).start()
+    target_options = dict(target_options or {})
+    target_options['push'] = target == 'push'
+    dest = FakeRegistry(**target_options).start()
+    target_options['push'] = True
+    extra_dests = [FakeRegistry(**target_options).start()
+                   for i in range(destinations - 1)]
+    export_dir = tempfile.mkdtemp(prefix='tripleo-benchmark-export-')
+    saved_export_dir = image_export.IMAGE_EXPORT_DIR
+    config_file = None
+    try:
+        images = synthetic_images(
+            source, count=count, layers_per_image=layers_per_image,
+            shared_layers=shared_layers, layer_size=layer_size)
+        source.requests.clear()
+        image_export.IMAGE_EXPORT_DIR = export_dir
+        _reset_uploader_state()
+        image_uploader.BaseImageUploader.insecure_registries.update(
+            [source.netloc, dest.netloc] + [d.netloc for d in extra_dests])
+
+        push_destination = dest.netloc
+        if extra_dests:
+            push_destination = [dest.netloc] + [d.netloc
+                                                for d in extra_dests]
+        with tempfile.NamedTemporaryFile(
+                mode='w', suffix='.yaml', delete=False) as f:
+            yaml.safe_dump({'container_images': [{
+                'imagename': i,
+                'push_destination': push_destination} for i in images]}, f)
+            config_file = f.name
+        manager = image_uploader.ImageUploadManager(
+            [config_file], cleanup=image_uploader.CLEANUP_NONE,
+            lock=threadinglock.ThreadingLock(),
+            transfer_engine=transfer_engine)
+
+        start = time.time()
+        manager.upload()
+        wall = time.time() - start
+
+        if target == 'push':
+            uploaded = sum(len(v) for v in dest.blobs.values())
+        else:
+            # exported blobs are hard linked into every image using them
+            inodes = {}
+            for root, dirs, files in os.walk(export_dir):
+                for fname in files:
+                    st = os.lstat(os.path.join(root, fname))
+                    inodes[(st.st_dev, st.st_ino)] = st.st_size
+            uploaded = sum(inodes.values())
+        unique_bytes = layer_size * (
+            shared_layers + count * (layers_per_image - shared_layers))
+        return {
+            'target': target,
+            'source': source.netloc,
+            'destination': dest.netloc,
+            'transfer_engine': transfer_engine,
+            'images': count,
+            'layers_per_image': layers_per_image,
+            'shared_layers': shared_layers,
+            'layer_size': layer_size,
+            'wall_seconds': round(wall, 3),
+            'unique_layer_bytes': unique_bytes,
+            'source_bytes_per_second': int(unique_bytes / wall) if wall
+            else 0,
+            'target_bytes': uploaded,
+            'source_requests': dict(source.requests),
+            'target_requests': dict(dest.requests),
+            'target_mounts': dest.mounts,
+            'extra_destinations': [{
+                'destination': d.netloc,
+                'target_bytes': sum(len(v) for v in d.blobs.values()),
+                'target_requests': dict(d.requests),
+            } for d in extra_dests],
+            'peak_rss_kb': _peak_rss_kb(),
+            'metrics': upload_metrics.METRICS.summary(),
+        }
+    finally:
+        image_export.IMAGE_EXPORT_DIR = saved_export_dir
+        _reset_uploader_state()
+        if config_file:
+            os.remove(config_file)
+        shutil.rmtree(export_dir, ignore_errors=True)
+        source.stop()
+        dest.stop()
+        for d in extra_dests:
+            d.stop()
+
+
+def format_report(report):
+    lines = []
+    for key in sorted(report):
+        value = report[key]
+        if isinstance(value, dict):
+            value = json.dumps(value, sort_keys=True)
+        elif isinstance(value, six.binary_type):
+            value = value.decode('utf-8')
+        lines.append('%-26s %s' % (key, value))
+    return '\n'.join(lines)
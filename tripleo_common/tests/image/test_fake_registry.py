@@ -0,0 +1,120 @@
+#   Copyright 2020 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+import requests
+import time
+
+from tripleo_common.image import image_transfer
+from tripleo_common.image import image_uploader
+from tripleo_common.tests import base
+from tripleo_common.tests.image import fake_registry
+
+
+class TestFakeRegistry(base.TestCase):
+
+    def setUp(self):
+        super(TestFakeRegistry, self).setUp()
+        self.registry = fake_registry.FakeRegistry(auth=True).start()
+        self.addCleanup(self.registry.stop)
+
+    def test_auth(self):
+        url = '%s/v2/' % self.registry.url
+        r = requests.get(url)
+        self.assertEqual(401, r.status_code)
+        self.assertIn('Bearer realm=', r.headers['www-authenticate'])
+        token = requests.get('%s/token' % self.registry.url).json()
+        r = requests.get(url, headers={
+            'Authorization': 'Bearer %s' % token['token']})
+        self.assertEqual(200, r.status_code)
+
+    def test_blob_range(self):
+        self.registry.auth = False
+        digest = self.registry.add_blob(b'0123456789')
+        url = '%s/v2/t/foo/blobs/%s' % (self.registry.url, digest)
+        r = requests.get(url, headers={'Range': 'bytes=4-7'})
+        self.assertEqual(206, r.status_code)
+        self.assertEqual(b'4567', r.content)
+        self.assertEqual('bytes 4-7/10', r.headers['Content-Range'])
+
+    def test_rate_limit(self):
+        self.registry.auth = False
+        self.registry.rate_limit_every = 2
+        self.registry.retry_after = 3
+        url = '%s/v2/t/foo/manifests/latest' % self.registry.url
+        self.assertEqual(404, requests.get(url).status_code)
+        r = requests.get(url)
+        self.assertEqual(429, r.status_code)
+        self.assertEqual('3', r.headers['Retry-After'])
+
+    def test_shared_adapter_limiter(self):
+        self.addCleanup(image_transfer.reset_limiters)
+        self.registry.auth = False
+        self.registry.rate_limit_every = 1
+        self.registry.retry_after = 2
+        session = image_uploader.MakeSession().create()
+        url = '%s/v2/t/foo/manifests/latest' % self.registry.url
+        start = time.time()
+        self.assertEqual(429, session.get(url).status_code)
+        limiter = image_transfer.registry_limiter(self.registry.netloc)
+        self.assertEqual(image_transfer.DEFAULT_REGISTRY_LIMIT / 2,
+                         limiter.limit)
+        self.assertGreaterEqual(limiter.paused_until, start + 2)
+        self.assertEqual(0, limiter.in_flight)
+
+
+class TestBenchmark(base.TestCase):
+
+    def _assert_layers_fetched_once(self, report):
+        # every layer and config is only fetched once from the source,
+        # shared layers included
+        unique_layers = report['shared_layers'] + report['images'] * (
+            report['layers_per_image'] - report['shared_layers'])
+        self.assertEqual(unique_layers + report['images'],
+                         report['source_requests']['GET blobs'])
+        self.assertEqual(report['unique_layer_bytes'],
+                         report['metrics']['transfers'][
+                             report['source']]['pull']['bytes'])
+
+    def test_push(self):
+        report = fake_registry.run_benchmark(
+            target='push', count=3, layers_per_image=3, shared_layers=2,
+            layer_size=1024, source_options={'auth': True},
+            target_options={'auth': True})
+        self._assert_layers_fetched_once(report)
+        self.assertEqual(3, report['target_requests']['PUT manifests'])
+        self.assertLessEqual(report['unique_layer_bytes'],
+                             report['target_bytes'])
+
+    def test_export(self):
+        report = fake_registry.run_benchmark(
+            target='export', count=3, layers_per_image=3, shared_layers=2,
+            layer_size=1024,
+            transfer_engine=image_uploader.TRANSFER_ENGINE_SHARED)
+        self._assert_layers_fetched_once(report)
+        self.assertNotIn('PUT manifests', report['target_requests'])
+        self.assertLessEqual(report['unique_layer_bytes'],
+                             report['target_bytes'])
+
+    def test_push_destinations(self):
+        report = fake_registry.run_benchmark(
+            target='push', count=3, layers_per_image=3, shared_layers=2,
+            layer_size=1024, destinations=3)
+        # the source is read once for all the destinations
+        self._assert_layers_fetched_once(report)
+        self.assertEqual(3, report['target_requests']['PUT manifests'])
+        self.assertEqual(2, len(report['extra_destinations']))
+        for dest in report['extra_destinations']:
+            self.assertEqual(3, dest['target_requests']['PUT manifests'])
+            self.assertEqual(report['target_bytes'], dest['target_bytes'])
@@ -111,6 +111,137 @@ class TestImageExport(base.TestCase):
         blob_mode = oct(os.stat(blob_path).st_mode)
         self.assertEqual('644', blob_mode[-3:])
 
+        # the image blob is a link to the content addressed store
+        store_path = image_export.blob_store_path(compressed_digest)
+        self.assertEqual(os.stat(store_path).st_ino,
+                         os.stat(blob_path).st_ino)
+
+        # a stored blob is linked to another image without reading the
+        # stream
+        other_url = urlparse('docker://localhost:8787/t/nova-compute:latest')
+        layer = {
+            'digest': compressed_digest
+        }
+        layer_stream = mock.MagicMock()
+        layer_digest, other_blob_path = image_export.export_stream(
+            other_url, layer, layer_stream)
+        layer_stream.__iter__.assert_not_called()
+        self.assertEqual(compressed_digest, layer_digest)
+        self.assertEqual(len(blob_compressed), layer['size'])
+        self.assertEqual(os.stat(store_path).st_ino,
+                         os.stat(other_blob_path).st_ino)
+
+    def test_export_stream_calc_digest(self):
+        blob_compressed = zlib.compress(six.b('The Blob'))
+        compressed_digest = 'sha256:' + hashlib.sha256(
+            blob_compressed).hexdigest()
+        target_url = urlparse('docker://localhost:8787/t/nova-api:latest')
+        layer = {
+            'digest': compressed_digest
+        }
+
+        # the stream has already hashed the data, it isn't hashed again
+        calc_digest = hashlib.sha256()
+
+        def layer_stream():
+            calc_digest.update(blob_compressed)
+            yield blob_compressed
+
+        with mock.patch('hashlib.sha256') as mock_sha256:
+            layer_digest, blob_path = image_export.export_stream(
+                target_url, layer, layer_stream(), calc_digest=calc_digest)
+        mock_sha256.assert_not_called()
+        self.assertEqual(compressed_digest, layer_digest)
+        with open(blob_path, 'rb') as f:
+            self.assertEqual(blob_compressed, f.read())
+
+    def test_export_stream_concurrent(self):
+        blob_compressed = zlib.compress(six.b('The Blob'))
+        compressed_digest = 'sha256:' + hashlib.sha256(
+            blob_compressed).hexdigest()
+        url1 = urlparse('docker://localhost:8787/t/nova-api:latest')
+        url2 = urlparse('docker://localhost:8787/t/nova-compute:latest')
+
+        def layer_stream():
+            yield blob_compressed[:4]
+            # another writer exports the same digest before this one ends
+            image_export.export_stream(
+                url2, {'digest': compressed_digest},
+                iter([blob_compressed]), verify_digest=False)
+            yield blob_compressed[4:]
+
+        layer = {'digest': compressed_digest}
+        layer_digest, blob_path = image_export.export_stream(
+            url1, layer, layer_stream())
+        self.assertEqual(compressed_digest, layer_digest)
+
+        # both images link the blob stored first, no temporary file is left
+        store_path = image_export.blob_store_path(compressed_digest)
+        other_path = os.path.join(
+            image_export.IMAGE_EXPORT_DIR, 'v2/t/nova-compute/blobs',
+            '%s.gz' % compressed_digest)
+        self.assertEqual(os.stat(store_path).st_ino,
+                         os.stat(blob_path).st_ino)
+        self.assertEqual(os.stat(store_path).st_ino,
+                         os.stat(other_path).st_ino)
+        self.assertEqual([os.path.basename(store_path)],
+                         os.listdir(os.path.dirname(store_path)))
+
+    def _pipe(self, data):
+        r, w = os.pipe()
+        os.write(w, data)
+        os.close(w)
+        return os.fdopen(r, 'rb')
+
+    def _file(self, data):
+        f = tempfile.TemporaryFile()
+        f.write(data)
+        f.seek(0)
+        return f
+
+    def test_export_stream_pipe(self):
+        blob_compressed = zlib.compress(six.b('The Blob'))
+        compressed_digest = 'sha256:' + hashlib.sha256(
+            blob_compressed).hexdigest()
+        target_url = urlparse('docker://localhost:8787/t/nova-api:latest')
+
+        for source in (self._pipe, self._file):
+            for copy in (image_export._kernel_copy, lambda pipe: None):
+                layer = {
+                    'digest': 'sha256:somethingelse'
+                }
+                calc_digest = hashlib.sha256()
+                with source(blob_compressed) as pipe:
+                    with mock.patch('tripleo_common.image.image_export.'
+                                    '_kernel_copy', side_effect=copy):
+                        layer_digest, blob_path = image_export.export_stream(
+                            target_url, layer, iter([pipe]),
+                            verify_digest=False, calc_digest=calc_digest)
+                self.assertEqual(compressed_digest, layer_digest)
+                self.assertEqual(compressed_digest,
+                                 'sha256:' + calc_digest.hexdigest())
+                self.assertEqual(len(blob_compressed), layer['size'])
+                with open(blob_path, 'rb') as f:
+                    self.assertEqual(blob_compressed, f.read())
+                os.remove(blob_path)
+
+    @mock.patch('os.sendfile', create=True)
+    def test_copy_pipe_file(self, mock_sendfile):
+        data = six.b('The Blob')
+        mock_sendfile.side_effect = lambda fd_out, fd_in, offset, count: (
+            os.write(fd_out, os.read(fd_in, count)))
+        with self._file(data) as pipe:
+            with tempfile.TemporaryFile() as f:
+                calc_digest = hashlib.sha256()
+                self.assertEqual(len(data), image_export.copy_pipe(
+                    pipe, f, calc_digest))
+                f.seek(0)
+                self.assertEqual(data, f.read())
+        self.assertEqual(hashlib.sha256(data).hexdigest(),
+                         calc_digest.hexdigest())
+        # the regular file is copied in the kernel
+        self.assertEqual(2, mock_sendfile.call_count)
+
     @mock.patch('os.fdopen',
                 side_effect=MemoryError())
     def test_export_stream_memory_error(self, mock_open):
@@ -251,6 +382,10 @@ Header set ETag "%s"
             self.assertEqual(manifest_str, f.read())
         with open(manifest_htaccess_path, 'r') as f:
             self.assertEqual(expected_htaccess, f.read())
+        self.assertEqual(manifest_digest,
+                         image_export.tag_digest(target_url))
+        self.assertIsNone(image_export.tag_digest(
+            urlparse('docker://localhost:8787/t/nova-api:missing')))
 
     def test_write_parse_type_map_file(self):
         manifest_dir_path = os.path.join(
@@ -446,7 +581,11 @@ URI: sha256:1234abcd/index.json
             deleted=[]
         )
 
-        image_export.delete_image(url2)
+        # only the deleted manifest is read
+        with mock.patch.object(image_export, 'manifest_blobs',
+                               wraps=image_export.manifest_blobs) as m:
+            image_export.delete_image(url2)
+        m.assert_called_once_with(manifest_2)
 
         # assert files deleted for nova-api:abc
         self.assertFiles(
@@ -496,3 +635,202 @@ URI: sha256:1234abcd/index.json
                 os.path.join(blob_dir, 'sha256:4dc536.gz'),
             ]
         )
+
+    def test_delete_image_blob_store(self):
+        url1 = urlparse('docker://localhost:8787/t/nova-api:latest')
+        url2 = urlparse('docker://localhost:8787/t/nova-compute:latest')
+        shared = zlib.compress(six.b('shared'))
+        other = zlib.compress(six.b('other'))
+        shared_digest = 'sha256:' + hashlib.sha256(shared).hexdigest()
+        other_digest = 'sha256:' + hashlib.sha256(other).hexdigest()
+
+        for url, layers in ((url1, [shared]), (url2, [shared, other])):
+            manifest = {
+                'config': {
+                    'digest': 'sha256:5678',
+                    'size': 2,
+                    'mediaType': 'application/vnd.docker.container.'
+                                 'image.v1+json'
+                },
+                'layers': [],
+                'mediaType': image_uploader.MEDIA_MANIFEST_V2,
+            }
+            for data in layers:
+                layer = {'digest': 'sha256:' + hashlib.sha256(
+                    data).hexdigest()}
+                image_export.export_stream(url, layer, [data])
+                manifest['layers'].append(layer)
+            image_export.export_manifest_config(
+                url, json.dumps(manifest), image_uploader.MEDIA_MANIFEST_V2,
+                '{"config": {}}')
+
+        shared_path = image_export.blob_store_path(shared_digest)
+        other_path = image_export.blob_store_path(other_digest)
+        config_path = image_export.blob_store_path(
+            'sha256:5678', compressed=False)
+        v2_dir = os.path.join(image_export.IMAGE_EXPORT_DIR, 'v2')
+        self.assertFiles(
+            dirs=[],
+            files=[shared_path, other_path, config_path],
+            deleted=[]
+        )
+
+        # blobs still referenced by nova-api are kept in the store
+        image_export.delete_image(url2)
+        self.assertFiles(
+            dirs=[os.path.join(v2_dir, 't/nova-api/blobs')],
+            files=[shared_path, config_path],
+            deleted=[other_path, os.path.join(v2_dir, 't/nova-compute')]
+        )
+
+        image_export.delete_image(url1)
+        self.assertFiles(
+            dirs=[v2_dir],
+            files=[],
+            deleted=[shared_path, config_path,
+                     os.path.join(v2_dir, 't/nova-api')]
+        )
+        with open(os.path.join(v2_dir, '_catalog')) as f:
+            self.assertEqual({'repositories': []}, json.load(f))
+
+    def test_update_blob_refs(self):
+        self.assertEqual({}, image_export.update_blob_refs(
+            't/nova-api@sha256:1111', add=['sha256:aaaa', 'sha256:bbbb']))
+        image_export.update_blob_refs(
+            't/nova-compute@sha256:2222', add=['sha256:aaaa'])
+
+        # one file per reference of each blob
+        self.assertEqual(
+            ['t%2Fnova-api%40sha256%3A1111',
+             't%2Fnova-compute%40sha256%3A2222'],
+            sorted(os.listdir(image_export.blob_refs_path('sha256:aaaa'))))
+
+        self.assertEqual({
+            'sha256:aaaa': set(['t/nova-compute@sha256:2222']),
+            'sha256:bbbb': set(),
+            'sha256:cccc': None,
+        }, image_export.update_blob_refs(
+            't/nova-api@sha256:1111',
+            remove=['sha256:aaaa', 'sha256:bbbb', 'sha256:cccc']))
+        self.assertFalse(os.path.exists(
+            image_export.blob_refs_path('sha256:bbbb')))
+
+    def test_repair_stray_blob(self):
+        url = urlparse('docker://localhost:8787/t/nova-api:latest')
+        manifest = {
+            'config': {
+                'digest': 'sha256:5678',
+                'size': 2,
+                'mediaType': 'application/vnd.docker.container.image.v1+json'
+            },
+            'layers': [{'digest': 'sha256:aeb786'}],
+            'mediaType': image_uploader.MEDIA_MANIFEST_V2,
+        }
+        self._write_test_image(url=url, manifest=manifest)
+        self._write_test_image(
+            url=urlparse('docker://localhost:8787/t/nova-api:abc'),
+            manifest=dict(manifest, layers=[]))
+
+        # a layer left by an export interrupted before its manifest
+        stray = zlib.compress(six.b('stray'))
+        layer = {'digest': 'sha256:' + hashlib.sha256(stray).hexdigest()}
+        image_export.export_stream(url, layer, [stray])
+        blob_dir = os.path.join(
+            image_export.IMAGE_EXPORT_DIR, 'v2/t/nova-api/blobs')
+        stray_path = os.path.join(blob_dir, '%s.gz' % layer['digest'])
+        store_path = image_export.blob_store_path(layer['digest'])
+
+        # deleting only checks the blobs of the deleted manifest
+        image_export.delete_image(url)
+        self.assertFiles(
+            dirs=[blob_dir],
+            files=[os.path.join(blob_dir, 'sha256:5678'), stray_path,
+                   store_path],
+            deleted=[os.path.join(blob_dir, 'sha256:aeb786.gz')]
+        )
+
+        # repair removes the blobs no manifest of the image references
+        image_export.repair()
+        self.assertFiles(
+            dirs=[blob_dir],
+            files=[os.path.join(blob_dir, 'sha256:5678')],
+            deleted=[stray_path, store_path]
+        )
+
+    def test_sweep_blob_store(self):
+        url = urlparse('docker://localhost:8787/t/nova-api:latest')
+        blobs = []
+        for data in (six.b('linked'), six.b('unlinked'), six.b('refd')):
+            data = zlib.compress(data)
+            layer = {'digest': 'sha256:' + hashlib.sha256(data).hexdigest()}
+            image_export.export_stream(url, layer, [data])
+            blobs.append(layer['digest'])
+        linked, unlinked, refd = [image_export.blob_store_path(b)
+                                  for b in blobs]
+        blob_dir = os.path.join(
+            image_export.IMAGE_EXPORT_DIR, 'v2/t/nova-api/blobs')
+        os.remove(os.path.join(blob_dir, '%s.gz' % blobs[1]))
+        os.remove(os.path.join(blob_dir, '%s.gz' % blobs[2]))
+        image_export.update_blob_refs('t/nova-api@sha256:1111',
+                                      add=[blobs[0], blobs[2]])
+        tmp_path = os.path.join(os.path.dirname(linked), '.export1234')
+        open(tmp_path, 'w').close()
+
+        # only the blob no image links and no manifest references goes
+        image_export.repair()
+        self.assertFiles(
+            dirs=[],
+            files=[linked, refd, tmp_path],
+            deleted=[unlinked]
+        )
+
+    def test_tags_list_catalog(self):
+        v2_dir = os.path.join(image_export.IMAGE_EXPORT_DIR, 'v2')
+        catalog_path = os.path.join(v2_dir, '_catalog')
+        tags_path = os.path.join(v2_dir, 't/nova-api/tags/list')
+        manifest = {
+            'schemaVersion': 1,
+            'fsLayers': [],
+        }
+        for tag in ('latest', 'abc'):
+            url = urlparse('docker://localhost:8787/t/nova-api:%s' % tag)
+            self._write_test_image(url=url, manifest=manifest)
+        url = urlparse('docker://localhost:8787/t/nova-compute:latest')
+        self._write_test_image(url=url, manifest=manifest)
+
+        def load(path):
+            with open(path) as f:
+                return json.load(f)
+
+        self.assertEqual(
+            {'name': 't/nova-api', 'tags': ['latest', 'abc']},
+            load(tags_path))
+        self.assertEqual(
+            {'repositories': ['t/nova-api', 't/nova-compute']},
+            load(catalog_path))
+
+        # entries are updated without scanning the tree
+        with mock.patch('os.listdir') as mock_listdir:
+            image_export.add_tag('t/nova-api', 'def')
+            image_export.add_tag('t/nova-api', 'def')
+            image_export.remove_tag('t/nova-api', 'abc')
+            image_export.remove_repository('t/nova-compute')
+        mock_listdir.assert_not_called()
+        self.assertEqual(
+            {'name': 't/nova-api', 'tags': ['latest', 'def']},
+            load(tags_path))
+        self.assertEqual({'repositories': ['t/nova-api']},
+                         load(catalog_path))
+
+        # repair rebuilds everything from the tree
+        image_export.repair()
+        self.assertEqual(
+            ['abc', 'latest'], sorted(load(tags_path)['tags']))
+        self.assertEqual(
+            ['t/nova-api', 't/nova-compute'],
+            sorted(load(catalog_path)['repositories']))
+
+        # a missing index is rebuilt on the next update
+        os.remove(tags_path)
+        image_export.remove_tag('t/nova-api', 'latest')
+        self.assertEqual(['abc'], load(tags_path)['tags'])
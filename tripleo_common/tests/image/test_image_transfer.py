@@ -0,0 +1,223 @@
+#   Copyright 2020 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+import mock
+import threading
+import time
+
+from tripleo_common.image import image_transfer
+from tripleo_common.tests import base
+
+
+class TestRegistryBudget(base.TestCase):
+
+    def test_reentrant(self):
+        budget = image_transfer.RegistryBudget('localhost', 1)
+        budget.acquire()
+        # a second acquire from the same thread must not block
+        budget.acquire()
+        budget.release()
+        budget.release()
+        self.assertTrue(budget._semaphore.acquire(False))
+
+
+class TestStreamTee(base.TestCase):
+
+    def _consume(self, tee, count):
+        results = [None] * count
+
+        def read(index):
+            results[index] = list(tee.consumer(index))
+
+        threads = [threading.Thread(target=read, args=(i,))
+                   for i in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+        return results
+
+    def test_consumers(self):
+        read = []
+
+        def stream():
+            for i in range(50):
+                read.append(i)
+                yield b'%d' % i
+
+        tee = image_transfer.StreamTee(stream(), 3, max_chunks=4)
+        expected = [b'%d' % i for i in range(50)]
+        self.assertEqual([expected] * 3, self._consume(tee, 3))
+        # the source was read once
+        self.assertEqual(list(range(50)), read)
+        self.assertEqual(0, len(tee._chunks))
+
+    def test_close(self):
+        tee = image_transfer.StreamTee(
+            (b'%d' % i for i in range(20)), 2, max_chunks=2)
+        first = tee.consumer(0)
+        self.assertEqual(b'0', next(first))
+        first.close()
+        # a closed consumer does not hold back the others
+        self.assertEqual(20, len(list(tee.consumer(1))))
+
+    def test_error(self):
+        def stream():
+            yield b'a'
+            raise IOError('broken')
+
+        tee = image_transfer.StreamTee(stream(), 2)
+        for index in range(2):
+            consumer = tee.consumer(index)
+            self.assertEqual(b'a', next(consumer))
+            self.assertRaises(IOError, next, consumer)
+
+
+class TestTransferEngine(base.TestCase):
+
+    def setUp(self):
+        super(TestTransferEngine, self).setUp()
+        self.engine = image_transfer.TransferEngine(
+            max_workers=8, registry_limit=2)
+        self.addCleanup(self.engine.shutdown)
+
+    def test_submit(self):
+        job = self.engine.submit(('localhost',), lambda x, y=0: x + y,
+                                 1, y=2)
+        self.assertEqual(3, job.result())
+
+    def test_registry_budget_shared(self):
+        self.assertIs(self.engine.registry_budget('localhost'),
+                      self.engine.registry_budget('localhost'))
+        self.assertIsNot(self.engine.registry_budget('localhost'),
+                         self.engine.registry_budget('docker.io'))
+
+    def test_registry_limit(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def transfer():
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.05)
+            with lock:
+                state['running'] -= 1
+
+        jobs = [self.engine.submit(('localhost', 'docker.io'), transfer)
+                for x in range(8)]
+        for job in jobs:
+            job.result()
+        self.assertEqual(2, state['peak'])
+
+    def test_shutdown_recreates_executor(self):
+        self.assertEqual(1, self.engine.submit((), lambda: 1).result())
+        self.engine.shutdown()
+        self.assertIsNone(self.engine._executor)
+        self.assertEqual(2, self.engine.submit((), lambda: 2).result())
+
+
+class TestAdaptiveLimiter(base.TestCase):
+
+    def setUp(self):
+        super(TestAdaptiveLimiter, self).setUp()
+        self.limiter = image_transfer.AdaptiveLimiter(
+            'localhost', initial=2, maximum=4)
+
+    def test_increase_when_saturated(self):
+        limiter = self.limiter
+        # a request which did not use the whole limit does not grow it
+        limiter.acquire()
+        limiter.release(status_code=200, latency=0.1)
+        self.assertEqual(2.0, limiter.limit)
+
+        for x in range(4):
+            limiter.acquire()
+            limiter.acquire()
+            limiter.release(status_code=200, latency=0.1)
+            limiter.release(status_code=200, latency=0.1)
+        self.assertEqual(3, int(limiter.limit))
+
+        # slow responses stop the growth
+        limit = limiter.limit
+        for x in range(5):
+            for y in range(3):
+                limiter.acquire()
+            for y in range(3):
+                limiter.release(status_code=200, latency=5.0)
+        self.assertEqual(limit, limiter.limit)
+
+    @mock.patch('time.time')
+    def test_rate_limited(self, mock_time):
+        mock_time.return_value = 1000.0
+        limiter = self.limiter
+        limiter.limit = 4.0
+        limiter.acquire()
+        limiter.acquire()
+        limiter.release(status_code=429, retry_after='5')
+        self.assertEqual(2.0, limiter.limit)
+        self.assertEqual(1005.0, limiter.paused_until)
+        # a burst of rejected requests only halves the limit once
+        limiter.release(status_code=503)
+        self.assertEqual(2.0, limiter.limit)
+        self.assertEqual(1005.0, limiter.paused_until)
+        self.assertEqual(0, limiter.in_flight)
+
+        # without Retry-After the pause grows exponentially
+        mock_time.return_value = 1010.0
+        limiter.acquire()
+        limiter.release(status_code=429)
+        self.assertEqual(1.0, limiter.limit)
+        self.assertEqual(1010.0 + image_transfer.BACKOFF_PAUSE * 4,
+                         limiter.paused_until)
+
+    def test_pause_blocks_acquire(self):
+        limiter = self.limiter
+        limiter.paused_until = time.time() + 0.2
+        start = time.time()
+        limiter.acquire()
+        self.assertGreaterEqual(time.time() - start, 0.15)
+
+    def test_slot_failed(self):
+        limiter = self.limiter
+
+        def fail():
+            with limiter.slot():
+                raise IOError('connection refused')
+
+        self.assertRaises(IOError, fail)
+        self.assertEqual(1.0, limiter.limit)
+        self.assertEqual(0, limiter.in_flight)
+
+        with limiter.slot() as record:
+            record(status_code=200, latency=0.1)
+        self.assertEqual(0.1, limiter.latency)
+
+    def test_retry_after_seconds(self):
+        parse = image_transfer.retry_after_seconds
+        self.assertIsNone(parse(None))
+        self.assertIsNone(parse('soon'))
+        self.assertEqual(12.0, parse('12'))
+        self.assertEqual(
+            30.0, parse('Wed, 21 Oct 2015 07:28:30 GMT', now=1445412480.0))
+        self.assertEqual(
+            0.0, parse('Wed, 21 Oct 2015 07:28:30 GMT', now=1445412600.0))
+
+    def test_registry_limiter_shared(self):
+        self.addCleanup(image_transfer.reset_limiters)
+        self.assertIs(image_transfer.registry_limiter('localhost'),
+                      image_transfer.registry_limiter('localhost'))
+        self.assertIsNot(image_transfer.registry_limiter('localhost'),
+                         image_transfer.registry_limiter('docker.io'))
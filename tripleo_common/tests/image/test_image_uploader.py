@@ -13,26 +13,35 @@
 #   under the License.
 #
 
+from concurrent import futures
 import hashlib
-import io
 import json
 import mock
 import operator
 import os
 import requests
 from requests_mock.contrib import fixture as rm_fixture
+import shutil
 import six
 from six.moves.urllib.parse import urlparse
 import tempfile
+import threading
+import time
 import zlib
 
 from oslo_concurrency import processutils
 from tripleo_common.image.exception import ImageNotFoundException
 from tripleo_common.image.exception import ImageRateLimitedException
 from tripleo_common.image.exception import ImageUploaderException
+from tripleo_common.image import image_export
+from tripleo_common.image import image_transfer
 from tripleo_common.image import image_uploader
+from tripleo_common.image import layer_index
+from tripleo_common.image import upload_metrics
 from tripleo_common.tests import base
 from tripleo_common.tests.image import fakes
+from tripleo_common.utils import image as image_utils
+from tripleo_common.utils.locks import threadinglock
 
 
 filedata = six.u(
@@ -94,6 +103,17 @@ class TestRegistrySessionHelper(base.TestCase):
                           session,
                           request)
 
+    def test_refresh_token(self):
+        session = mock.Mock()
+        session.auth_args = {}
+        session.auth_refresh_at = time.time() + 60.0
+        image_uploader.RegistrySessionHelper.refresh_token(session)
+        session.reauthenticate.assert_not_called()
+
+        session.auth_refresh_at = time.time() - 1.0
+        image_uploader.RegistrySessionHelper.refresh_token(session)
+        session.reauthenticate.assert_called_once_with()
+
     def test_check_redirect_trusted_no_redirect(self):
         get_mock = mock.Mock()
         session = mock.Mock()
@@ -375,6 +395,25 @@ class TestImageUploadManager(base.TestCase):
                           manager.get_uploader,
                           'unknown')
 
+    def test_transfer_engine(self):
+        manager = image_uploader.ImageUploadManager(self.filelist)
+        uploader = manager.get_uploader('python')
+        self.assertIsNone(uploader.transfer_engine)
+
+        manager = image_uploader.ImageUploadManager(
+            self.filelist,
+            transfer_engine=image_uploader.TRANSFER_ENGINE_SHARED)
+        uploader = manager.get_uploader('python')
+        self.assertIsInstance(uploader.transfer_engine,
+                              image_transfer.TransferEngine)
+        uploader.init_transfer_engine(None)
+
+    def test_transfer_engine_unknown(self):
+        self.assertRaises(ImageUploaderException,
+                          image_uploader.ImageUploadManager,
+                          self.filelist,
+                          transfer_engine='unknown')
+
     def test_validate_registry_credentials(self):
         # valid credentials
         image_uploader.ImageUploadManager(
@@ -483,6 +522,34 @@ class TestUploadTask(base.TestCase):
         self.assertEqual(obj.target_image_no_tag,
                          '127.0.0.1:8787/namespace/foo')
 
+    def test_extra_push_destinations(self):
+        obj = image_uploader.UploadTask(
+            image_name='foo:bar',
+            pull_source='docker.io/namespace',
+            push_destination='127.0.0.1:8787',
+            append_tag=None,
+            modify_role=None,
+            modify_vars=None,
+            cleanup=False,
+            multi_arch=False,
+            extra_push_destinations=['192.0.2.1:8787/'])
+        self.assertEqual(['192.0.2.1:8787/namespace/foo:bar'],
+                         obj.extra_target_images)
+        self.assertEqual(['docker://192.0.2.1:8787/namespace/foo:bar'],
+                         [u.geturl() for u in obj.extra_target_image_urls])
+        self.assertRaises(
+            image_uploader.ImageUploaderException,
+            image_uploader.UploadTask,
+            image_name='foo:bar',
+            pull_source='docker.io/namespace',
+            push_destination='127.0.0.1:8787',
+            append_tag=None,
+            modify_role='add-foo-plugin',
+            modify_vars=None,
+            cleanup=False,
+            multi_arch=False,
+            extra_push_destinations=['192.0.2.1:8787'])
+
 
 class TestBaseImageUploader(base.TestCase):
 
@@ -490,6 +557,8 @@ class TestBaseImageUploader(base.TestCase):
         super(TestBaseImageUploader, self).setUp()
         self.uploader = image_uploader.BaseImageUploader()
         self.uploader.init_registries_cache()
+        self.uploader.inspect_cache.clear()
+        self.uploader.token_cache.clear()
         self.uploader._inspect.retry.sleep = mock.Mock()
         self.requests = self.useFixture(rm_fixture.Fixture())
 
@@ -544,6 +613,81 @@ class TestBaseImageUploader(base.TestCase):
         mock_session.assert_has_calls(calls)
         self.assertEqual(mock_session.call_count, 2)
 
+    @mock.patch.object(requests.Session, 'get',
+                       side_effect=[requests.exceptions.SSLError('err'), True,
+                                    requests.exceptions.ReadTimeout('ouch')])
+    def test_is_insecure_registry_cached(self, mock_session):
+        self.assertTrue(self.uploader.is_insecure_registry('bcert:8787'))
+        self.assertFalse(self.uploader.is_insecure_registry('down:8787'))
+        self.assertEqual(
+            image_uploader.REGISTRY_TLS_NO_VERIFY,
+            self.uploader.registry_cache['bcert:8787']['tls'])
+        # an unreachable registry is not cached
+        self.assertNotIn('down:8787', self.uploader.registry_cache)
+
+        # a later run trusts the cache instead of probing again
+        self.uploader.no_verify_registries.clear()
+        self.assertTrue(self.uploader.is_insecure_registry('bcert:8787'))
+        self.assertIn('bcert:8787', self.uploader.no_verify_registries)
+        self.assertEqual(3, mock_session.call_count)
+
+        # until the entry expires
+        self.uploader.no_verify_registries.clear()
+        self.uploader.registry_cache['bcert:8787']['time'] -= (
+            image_uploader.REGISTRY_CACHE_TTL)
+        self.assertIsNone(
+            self.uploader._registry_capability('bcert:8787', 'tls'))
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'BaseImageUploader.is_insecure_registry')
+    def test_probe_registries(self, mock_insecure):
+        self.uploader.secure_registries.add('192.0.2.1:8787')
+        self.uploader.probe_registries(
+            ['192.0.2.1:8787', '192.0.2.2:8787', '192.0.2.3:8787',
+             '192.0.2.2:8787', ''])
+        self.assertEqual(
+            ['192.0.2.2:8787', '192.0.2.3:8787'],
+            sorted(c[0][0] for c in mock_insecure.call_args_list))
+
+    def test_init_registry_cache(self):
+        u = image_uploader.BaseImageUploader
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        path = os.path.join(cache_dir, 'registries.json')
+        self.addCleanup(setattr, u, 'registry_cache_ttl',
+                        image_uploader.REGISTRY_CACHE_TTL)
+
+        u.init_registry_cache(path)
+        self.assertEqual({}, u.registry_cache)
+        u._record_registry_capability(
+            '192.0.2.1:8787', tls=image_uploader.REGISTRY_TLS_INSECURE)
+        u._save_registry_cache()
+
+        # capabilities saved by another process are kept
+        u.registry_cache.clear()
+        u._record_registry_capability(
+            '192.0.2.1:8787', target=image_uploader.REGISTRY_TARGET_PUSH)
+        u._save_registry_cache()
+
+        u.registry_cache_path = None
+        u.init_registry_cache(path)
+        self.assertEqual(
+            image_uploader.REGISTRY_TLS_INSECURE,
+            u._registry_capability('192.0.2.1:8787', 'tls'))
+        self.assertEqual(
+            image_uploader.REGISTRY_TARGET_PUSH,
+            u._registry_capability('192.0.2.1:8787', 'target'))
+
+        # an entry probed without the mirror configured now is not used
+        u.mirrors['192.0.2.1:8787'] = 'http://192.0.2.2/reg/'
+        self.assertIsNone(u._registry_capability('192.0.2.1:8787', 'tls'))
+
+        # a shorter ttl expires the entry
+        del u.mirrors['192.0.2.1:8787']
+        u.registry_cache_path = None
+        u.init_registry_cache(path, ttl=0)
+        self.assertIsNone(u._registry_capability('192.0.2.1:8787', 'tls'))
+
     @mock.patch('tripleo_common.image.image_uploader.'
                 'BaseImageUploader.authenticate')
     @mock.patch('tripleo_common.image.image_uploader.'
@@ -717,19 +861,23 @@ class TestBaseImageUploader(base.TestCase):
             (self.uploader, 'docker.io/t/foo', 'rdo_version', False)
         )
 
-    @mock.patch('concurrent.futures.ThreadPoolExecutor')
-    def test_discover_image_tags(self, mock_pool):
-        mock_map = mock.Mock()
-        mock_map.return_value = (
-            ('docker.io/t/foo', 'a'),
-            ('docker.io/t/bar', 'b'),
-            ('docker.io/t/baz', 'c')
-        )
-        mock_pool.return_value.__enter__.return_value.map = mock_map
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'discover_tag_from_inspect')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'BaseImageUploader.inspect_many')
+    def test_discover_image_tags(self, mock_inspect_many, mock_discover):
+        mock_inspect_many.return_value = {
+            'docker.io/t/foo': {
+                'Labels': {'rdo_release': 'a'}, 'RepoTags': ['a']},
+            'docker.io/t/bar': {
+                'Labels': {'rdo_release': 'b'}, 'RepoTags': ['b']},
+            'docker.io/t/baz:latest': {
+                'Labels': {'rdo_release': 'c'}, 'RepoTags': ['c']}
+        }
         images = [
             'docker.io/t/foo',
             'docker.io/t/bar',
-            'docker.io/t/baz'
+            'docker.io/t/baz:latest'
         ]
         self.assertEqual(
             {
@@ -739,13 +887,130 @@ class TestBaseImageUploader(base.TestCase):
             },
             self.uploader.discover_image_tags(images, 'rdo_release')
         )
-        mock_map.assert_called_once_with(
-            image_uploader.discover_tag_from_inspect,
-            [
-                (self.uploader, 'docker.io/t/foo', 'rdo_release', False),
-                (self.uploader, 'docker.io/t/bar', 'rdo_release', False),
-                (self.uploader, 'docker.io/t/baz', 'rdo_release', False)
-            ])
+        mock_inspect_many.assert_called_once_with(images, default_tag=False)
+        mock_discover.assert_not_called()
+
+        # a cached inspect with out of date tags is inspected again
+        url = urlparse('docker://docker.io/t/foo')
+        self.uploader.inspect_cache[
+            self.uploader._inspect_cache_key(url)] = {}
+        mock_inspect_many.return_value['docker.io/t/foo']['RepoTags'] = []
+        mock_discover.return_value = ('docker.io/t/foo', 'a')
+        self.assertEqual(
+            'a',
+            self.uploader.discover_image_tags(
+                images, 'rdo_release')['docker.io/t/foo']
+        )
+        mock_discover.assert_called_once_with(
+            (self.uploader, 'docker.io/t/foo', 'rdo_release', False))
+        self.assertEqual({}, self.uploader.inspect_cache)
+
+        # without a cached entry the error is raised
+        self.assertRaises(
+            ImageUploaderException,
+            self.uploader.discover_image_tags, images, 'rdo_release')
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'BaseImageUploader._inspect')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'BaseImageUploader.authenticate')
+    def test_inspect_many(self, mock_auth, mock_inspect):
+        sessions = [mock.Mock(), mock.Mock()]
+        mock_auth.side_effect = sessions
+        mock_inspect.side_effect = lambda url, session, default_tag: {
+            'Name': url.path, 'Session': session}
+        self.uploader.registry_credentials = {
+            'docker.io': {'user': 'pass'}}
+
+        inspected = self.uploader.inspect_many([
+            'docker.io/t/foo:a',
+            'docker.io/t/foo:b',
+            'docker.io/t/bar'
+        ])
+        self.assertEqual(3, len(inspected))
+        # one session per repository
+        self.assertEqual(2, mock_auth.call_count)
+        mock_auth.assert_any_call(
+            urlparse('docker://docker.io/t/foo:a'),
+            username='user', password='pass')
+        self.assertIs(inspected['docker.io/t/foo:a']['Session'],
+                      inspected['docker.io/t/foo:b']['Session'])
+        self.assertIsNot(inspected['docker.io/t/foo:a']['Session'],
+                         inspected['docker.io/t/bar']['Session'])
+        for session in sessions:
+            session.close.assert_called_once_with()
+
+    def test_inspect_cache(self):
+        req = self.requests
+        session = requests.Session()
+        inspect = image_uploader.BaseImageUploader._inspect
+        url = urlparse('docker://docker.io/t/nova-api:latest')
+        manifest_url = ('https://registry-1.docker.io/v2/t/nova-api/'
+                        'manifests/latest')
+        manifest = {
+            'schemaVersion': 2,
+            'config': {
+                'mediaType': 'text/html',
+                'digest': 'abcdef'
+            },
+            'layers': [{'digest': 'aaa'}]
+        }
+        config = {
+            'created': '2018-10-02T11:13:45.567533229Z',
+            'config': {'Labels': {'foo': 'bar'}},
+            'architecture': 'amd64',
+            'os': 'linux',
+        }
+        req.get('https://registry-1.docker.io/v2/t/nova-api/tags/list',
+                json={'tags': ['latest']})
+        req.get('https://registry-1.docker.io/v2/t/nova-api/blobs/abcdef',
+                json=config)
+        req.get(manifest_url, json=manifest,
+                headers={'Docker-Content-Digest': 'eeeeee'})
+        result = inspect(url, session=session)
+        self.assertEqual('eeeeee', result['Digest'])
+        self.assertEqual(3, req.call_count)
+
+        # unchanged manifest, only revalidated
+        req.head(manifest_url, status_code=304)
+        self.assertEqual(result, inspect(url, session=session))
+        self.assertEqual(4, req.call_count)
+        self.assertEqual('"eeeeee"',
+                         req.last_request.headers['If-None-Match'])
+
+        # changed manifest is inspected again
+        req.head(manifest_url, status_code=200,
+                 headers={'Docker-Content-Digest': 'ffffff'})
+        req.get(manifest_url, json=manifest,
+                headers={'Docker-Content-Digest': 'ffffff'})
+        self.assertEqual('ffffff', inspect(url, session=session)['Digest'])
+        self.assertEqual(8, req.call_count)
+        self.assertEqual(
+            'ffffff',
+            self.uploader.inspect_cache[
+                'docker.io/t/nova-api:latest']['Digest'])
+
+    def test_init_inspect_cache(self):
+        u = image_uploader.BaseImageUploader
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        path = os.path.join(cache_dir, 'inspect.json')
+        self.addCleanup(setattr, u, 'inspect_cache_path', None)
+
+        u.init_inspect_cache(path)
+        self.assertEqual({}, u.inspect_cache)
+        u.inspect_cache['docker.io/t/foo:a'] = {'Digest': 'sha256:1234'}
+        u._save_inspect_cache()
+
+        # the same path keeps the in memory cache
+        u.inspect_cache['docker.io/t/bar:a'] = {'Digest': 'sha256:5678'}
+        u.init_inspect_cache(path)
+        self.assertEqual(2, len(u.inspect_cache))
+
+        u.inspect_cache_path = None
+        u.init_inspect_cache(path)
+        self.assertEqual({'docker.io/t/foo:a': {'Digest': 'sha256:1234'}},
+                         u.inspect_cache)
 
     @mock.patch('tripleo_common.image.image_uploader.'
                 'BaseImageUploader._inspect')
@@ -778,6 +1043,7 @@ class TestBaseImageUploader(base.TestCase):
         self.assertNotIn('Authorization', auth(url1).headers)
 
         # missing 'www-authenticate' header
+        self.uploader.token_cache.clear()
         req.get('https://registry-1.docker.io/v2/', status_code=401)
         self.assertRaises(ImageUploaderException, auth, url1)
 
@@ -800,6 +1066,106 @@ class TestBaseImageUploader(base.TestCase):
             auth(url1).headers['Authorization']
         )
 
+    def test_authenticate_cached_challenge(self):
+        req = self.requests
+        auth = self.uploader.authenticate
+        url1 = urlparse('docker://docker.io/t/nova-api:latest')
+        headers = {
+            'www-authenticate': 'Bearer '
+                                'realm="https://auth.docker.io/token",'
+                                'service="registry.docker.io"'
+        }
+        ping = req.get('https://registry-1.docker.io/v2/', status_code=401,
+                       headers=headers)
+        token = req.get('https://auth.docker.io/token',
+                        json={"token": "asdf1234"})
+        auth(url1)
+        self.assertEqual(headers['www-authenticate'],
+                         self.uploader._registry_capability(
+                             'docker.io', 'auth'))
+
+        # a new token does not ping the registry again
+        self.uploader.token_cache.clear()
+        self.assertEqual('Bearer asdf1234',
+                         auth(url1).headers['Authorization'])
+        self.assertEqual(1, ping.call_count)
+        self.assertEqual(2, token.call_count)
+
+        # a cached challenge which fails is probed again
+        self.uploader.token_cache.clear()
+        token = req.get('https://auth.docker.io/token', [
+            {'status_code': 404}, {'json': {"token": "qwer5678"}}])
+        self.assertEqual('Bearer qwer5678',
+                         auth(url1).headers['Authorization'])
+        self.assertEqual(2, ping.call_count)
+
+    @mock.patch('time.time')
+    def test_authenticate_token_cache(self, mock_time):
+        req = self.requests
+        auth = self.uploader.authenticate
+        url1 = urlparse('docker://docker.io/t/nova-api:latest')
+        url2 = urlparse('docker://docker.io/t/nova-compute:latest')
+        mock_time.return_value = 1000.0
+
+        headers = {
+            'www-authenticate': 'Bearer '
+                                'realm="https://auth.docker.io/token",'
+                                'service="registry.docker.io"'
+        }
+        ping = req.get('https://registry-1.docker.io/v2/', status_code=401,
+                       headers=headers)
+        token = req.get('https://auth.docker.io/token',
+                        json={"token": "asdf1234", "expires_in": 300})
+
+        session = auth(url1)
+        self.assertEqual('Bearer asdf1234', session.headers['Authorization'])
+        self.assertEqual(1225.0, session.auth_refresh_at)
+        self.assertEqual(1, ping.call_count)
+        self.assertEqual(1, token.call_count)
+
+        # same scope, the cached token is used
+        session = auth(url1)
+        self.assertEqual('Bearer asdf1234', session.headers['Authorization'])
+        self.assertEqual(1, ping.call_count)
+        self.assertEqual(1, token.call_count)
+
+        # another scope needs its own token
+        auth(url2)
+        self.assertEqual(2, token.call_count)
+
+        # the token is refreshed once it is due
+        mock_time.return_value = 1226.0
+        auth(url1)
+        self.assertEqual(3, token.call_count)
+
+        # a rejected token is not reused when re-authenticating
+        token = req.get('https://auth.docker.io/token',
+                        json={"token": "qwer5678"})
+        session = auth(url1)
+        session.reauthenticate(**session.auth_args)
+        self.assertEqual('Bearer qwer5678', session.headers['Authorization'])
+        self.assertEqual(1, token.call_count)
+        self.assertEqual(
+            1226.0 + image_uploader.DEFAULT_TOKEN_EXPIRES_IN *
+            image_uploader.TOKEN_REFRESH_RATIO,
+            session.auth_refresh_at)
+
+    def test_make_session_shared_adapter(self):
+        s1 = image_uploader.MakeSession().create()
+        s2 = image_uploader.MakeSession(verify=False).create()
+        adapter = s1.get_adapter('https://localhost')
+        self.assertIs(adapter, s2.get_adapter('https://localhost'))
+        # closing a session keeps the shared connection pools
+        with mock.patch.object(adapter.poolmanager, 'clear') as clear:
+            s1.close()
+            clear.assert_not_called()
+
+        image_uploader.MakeSession.init_pool(4)
+        self.addCleanup(image_uploader.MakeSession.init_pool)
+        adapter = image_uploader.MakeSession().create().get_adapter(
+            'https://localhost')
+        self.assertEqual(4, adapter._pool_maxsize)
+
     def test_authenticate_basic_auth(self):
         req = self.requests
         auth = self.uploader.authenticate
@@ -1536,6 +1902,9 @@ class TestPythonImageUploader(base.TestCase):
         super(TestPythonImageUploader, self).setUp()
         self.uploader = image_uploader.PythonImageUploader()
         self.uploader.init_registries_cache()
+        self.uploader.inspect_cache.clear()
+        self.uploader.token_cache.clear()
+        self.uploader.containers_index.clear()
         u = self.uploader
         u._fetch_manifest.retry.sleep = mock.Mock()
         u._upload_url.retry.sleep = mock.Mock()
@@ -1543,8 +1912,47 @@ class TestPythonImageUploader(base.TestCase):
         u._copy_layer_registry_to_registry.retry.sleep = mock.Mock()
         u._copy_registry_to_registry.retry.sleep = mock.Mock()
         u._copy_local_to_registry.retry.sleep = mock.Mock()
+        u._layer_segment_fetch.retry.sleep = mock.Mock()
         self.requests = self.useFixture(rm_fixture.Fixture())
 
+    @mock.patch('tripleo_common.image.upload_metrics.METRICS')
+    @mock.patch('os.getpid', return_value=2)
+    def test_upload_task_metrics(self, mock_getpid, mock_metrics):
+        u = self.uploader
+        u.upload_image = mock.Mock(return_value=['foo'])
+        mock_metrics.drain.return_value = {'retries': {'foo': 1}}
+        self.addCleanup(setattr, image_uploader.PythonImageUploader,
+                        'metrics_pid', None)
+
+        # tasks run in the collecting process record in place
+        image_uploader.PythonImageUploader.metrics_pid = 2
+        self.assertEqual(
+            (['foo'], None),
+            image_uploader.upload_task_metrics((u, mock.Mock())))
+        mock_metrics.drain.assert_not_called()
+
+        # worker processes hand back what they recorded
+        image_uploader.PythonImageUploader.metrics_pid = 1
+        self.assertEqual(
+            (['foo'], {'retries': {'foo': 1}}),
+            image_uploader.upload_task_metrics((u, mock.Mock())))
+
+    def test_write_metrics(self):
+        u = self.uploader
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        json_path = os.path.join(metrics_dir, 'metrics.json')
+        prom_path = os.path.join(metrics_dir, 'metrics.prom')
+        self.addCleanup(u.init_metrics)
+        u.init_metrics(json_path, prom_path)
+        upload_metrics.METRICS.add_dedup('layer', True)
+        u._write_metrics()
+        with open(json_path) as f:
+            summary = json.load(f)
+        self.assertEqual(1, summary['dedup']['layer']['hits'])
+        with open(prom_path) as f:
+            self.assertIn('tripleo_image_upload_dedup_total', f.read())
+
     @mock.patch('tripleo_common.image.image_uploader.'
                 'RegistrySessionHelper.check_status')
     @mock.patch('tripleo_common.image.image_uploader.'
@@ -1636,7 +2044,8 @@ class TestPythonImageUploader(base.TestCase):
             source_session=source_session,
             target_session=target_session,
             source_layers=['sha256:aaa', 'sha256:bbb', 'sha256:ccc'],
-            multi_arch=False
+            multi_arch=False,
+            extra_targets=[]
         )
 
     @mock.patch('tripleo_common.image.image_uploader.'
@@ -1867,7 +2276,8 @@ class TestPythonImageUploader(base.TestCase):
             source_session=source_session,
             target_session=target_session,
             source_layers=['sha256:aaa', 'sha256:bbb', 'sha256:ccc'],
-            multi_arch=False
+            multi_arch=False,
+            extra_targets=[]
         )
 
     @mock.patch('tripleo_common.image.image_uploader.'
@@ -1886,15 +2296,19 @@ class TestPythonImageUploader(base.TestCase):
                 'PythonImageUploader._copy_registry_to_local')
     @mock.patch('tripleo_common.image.image_uploader.'
                 'PythonImageUploader.run_modify_playbook')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._source_layers_by_diff_id')
     @mock.patch('tripleo_common.image.image_uploader.'
                 'PythonImageUploader._copy_local_to_registry')
     def test_upload_image_modify(
-            self, _copy_local_to_registry, run_modify_playbook,
-            _copy_registry_to_local, _copy_registry_to_registry,
-            _cross_repo_mount, _fetch_manifest, _image_exists, authenticate,
-            check_status):
+            self, _copy_local_to_registry, _source_layers_by_diff_id,
+            run_modify_playbook, _copy_registry_to_local,
+            _copy_registry_to_registry, _cross_repo_mount, _fetch_manifest,
+            _image_exists, authenticate, check_status):
 
         _image_exists.return_value = False
+        source_diff_layers = {'sha256:a1': {'digest': 'sha256:aaa'}}
+        _source_layers_by_diff_id.return_value = source_diff_layers
         target_session = mock.Mock()
         source_session = mock.Mock()
         authenticate.side_effect = [
@@ -1997,7 +2411,8 @@ class TestPythonImageUploader(base.TestCase):
             source_session=source_session,
             target_session=target_session,
             source_layers=['sha256:aaa', 'sha256:bbb', 'sha256:ccc'],
-            multi_arch=False
+            multi_arch=False,
+            extra_targets=[]
         )
         _copy_registry_to_local.assert_called_once_with(unmodified_target_url)
         run_modify_playbook.assert_called_once_with(
@@ -2010,11 +2425,237 @@ class TestPythonImageUploader(base.TestCase):
             'modify-123',
             container_build_tool='buildah'
         )
+        _source_layers_by_diff_id.assert_called_once_with(
+            source_url, [manifest], source_session)
         _copy_local_to_registry.assert_called_once_with(
             local_modified_url,
             target_url,
-            session=target_session
+            session=target_session,
+            source_layers=source_diff_layers
+        )
+
+    @mock.patch('tripleo_common.actions.'
+                'ansible.AnsiblePlaybookAction', autospec=True)
+    def test_run_modify_playbook_batch(self, mock_ansible):
+        tasks = [image_uploader.UploadTask(
+            image_name='docker.io/t/%s:latest' % name,
+            pull_source=None,
+            push_destination='localhost:8787',
+            append_tag='modify-123',
+            modify_role=role,
+            modify_vars=modify_vars,
+            cleanup='full',
+            multi_arch=False
+        ) for name, role, modify_vars in (
+            ('nova-api', 'yum-update', {'update_repo': 'a'}),
+            ('nova-compute', 'yum-update', {'update_repo': 'b'}),
+            ('heat-api', 'add-foo-plugin', None),
+        )]
+
+        def run(context):
+            # nova-compute fails to update
+            kwargs = mock_ansible.call_args[1]
+            for play in kwargs['playbook']:
+                path = play['tasks'][1]['file']['path']
+                for host in ('image_0', 'image_2'):
+                    open(path.replace('{{ inventory_hostname }}', host),
+                         'w').close()
+            raise processutils.ProcessExecutionError(stdout='failed')
+
+        mock_ansible.return_value.run.side_effect = run
+
+        self.assertEqual(
+            [tasks[0], tasks[2]],
+            self.uploader.run_modify_playbook_batch(tasks, forks=2))
+
+        kwargs = mock_ansible.call_args[1]
+        self.assertEqual(2, kwargs['forks'])
+        self.assertEqual(
+            ['image_0', 'image_1'],
+            sorted(kwargs['inventory']['modify_0']['hosts']))
+        self.assertEqual({
+            'ansible_connection': 'local',
+            'ansible_python_interpreter': '{{ ansible_playbook_python }}',
+            'tripleo_modify_vars': {
+                'source_image': 'localhost:8787/t/heat-api:latest',
+                'target_image': 'localhost:8787/t/heat-api:latest',
+                'modified_append_tag': 'modify-123',
+                'container_build_tool': 'buildah',
+            }
+        }, kwargs['inventory']['modify_1']['hosts']['image_2'])
+        plays = kwargs['playbook']
+        self.assertEqual(['modify_0', 'modify_1'],
+                         [x['hosts'] for x in plays])
+        self.assertEqual({
+            'name': 'Import role yum-update',
+            'import_role': {'name': 'yum-update'},
+            'vars': {
+                'container_build_tool':
+                    "{{ tripleo_modify_vars['container_build_tool'] }}",
+                'modified_append_tag':
+                    "{{ tripleo_modify_vars['modified_append_tag'] }}",
+                'source_image': "{{ tripleo_modify_vars['source_image'] }}",
+                'target_image': "{{ tripleo_modify_vars['target_image'] }}",
+                'update_repo': "{{ tripleo_modify_vars['update_repo'] }}",
+            }
+        }, plays[0]['tasks'][0])
+        shutil.rmtree(kwargs['work_dir'])
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.run_modify_playbook_batch')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.push_modify_image')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.pull_modify_image')
+    def test_run_modify_batches(self, pull_modify_image, push_modify_image,
+                                run_modify_playbook_batch):
+        u = self.uploader
+        tasks = [mock.Mock(target_image='t%i' % i) for i in range(5)]
+        states = {
+            tasks[0]: {'cleanup': ['s0']},
+            tasks[1]: None,
+            tasks[3]: {'cleanup': ['s3']},
+            tasks[4]: {'cleanup': ['s4']},
+        }
+
+        def pull(task):
+            if task is tasks[2]:
+                raise ImageUploaderException('pull failed')
+            return states[task]
+
+        pull_modify_image.side_effect = pull
+        push_modify_image.side_effect = lambda t, state: state['cleanup']
+        # tasks[3] fails to be modified
+        run_modify_playbook_batch.side_effect = lambda x, forks: [
+            t for t in x if t is not tasks[3]]
+        self.addCleanup(u.init_modify_batch)
+        u.init_modify_batch(2, forks=4)
+        self.addCleanup(setattr, image_uploader.PythonImageUploader,
+                        'metrics_pid', None)
+        image_uploader.PythonImageUploader.metrics_pid = os.getpid()
+
+        with futures.ThreadPoolExecutor(max_workers=2) as p:
+            jobs = u._run_modify_batches(p, [(u, t) for t in tasks])
+        self.assertEqual((['s0'], None), jobs[0].result())
+        self.assertEqual(([], None), jobs[1].result())
+        self.assertRaises(ImageUploaderException, jobs[2].result)
+        self.assertRaises(ImageUploaderException, jobs[3].result)
+        self.assertEqual((['s4'], None), jobs[4].result())
+
+        run_modify_playbook_batch.assert_has_calls([
+            mock.call([tasks[0]], forks=4),
+            mock.call([tasks[3]], forks=4),
+            mock.call([tasks[4]], forks=4),
+        ])
+        self.assertEqual(2, push_modify_image.call_count)
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._detect_target_export')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.authenticate')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._push_modified_image')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._pull_unmodified_image')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._start_upload')
+    def test_pull_push_modify_image(self, _start_upload,
+                                    _pull_unmodified_image,
+                                    _push_modified_image, authenticate,
+                                    _detect_target_export):
+        u = self.uploader
+        task = image_uploader.UploadTask(
+            image_name='docker.io/t/nova-api:latest',
+            pull_source=None,
+            push_destination='localhost:8787',
+            append_tag='modify-123',
+            modify_role='yum-update',
+            modify_vars=None,
+            cleanup='full',
+            multi_arch=False
         )
+        target_session = mock.Mock()
+        source_session = mock.Mock()
+        _start_upload.return_value = {
+            'target_session': target_session,
+            'source_session': source_session,
+            'manifests': ['{}'],
+            'layers': ['sha256:aaa'],
+            'cleanup': [],
+        }
+
+        def pull(t, state):
+            state['cleanup'].append(t.target_image_source_tag)
+
+        _pull_unmodified_image.side_effect = pull
+
+        state = u.pull_modify_image(task)
+        # the sessions are closed and not part of the state
+        self.assertEqual({
+            'manifests': ['{}'],
+            'layers': ['sha256:aaa'],
+            'cleanup': ['localhost:8787/t/nova-api:latest'],
+        }, state)
+        target_session.close.assert_called_once_with()
+        source_session.close.assert_called_once_with()
+
+        new_target_session = mock.Mock()
+        new_source_session = mock.Mock()
+        authenticate.side_effect = [new_target_session, new_source_session]
+        self.assertEqual([
+            'localhost:8787/t/nova-api:latest',
+            'localhost:8787/t/nova-api:latestmodify-123',
+        ], u.push_modify_image(task, state))
+        _push_modified_image.assert_called_once_with(task, mock.ANY)
+        pushed_state = _push_modified_image.call_args[0][1]
+        self.assertIs(new_target_session, pushed_state['target_session'])
+        self.assertIs(new_source_session, pushed_state['source_session'])
+        new_target_session.close.assert_called_once_with()
+        new_source_session.close.assert_called_once_with()
+
+        # nothing to modify
+        _start_upload.return_value = None
+        self.assertIsNone(u.pull_modify_image(task))
+
+    def test_source_layers_by_diff_id(self):
+        source_url = urlparse('docker://docker.io/t/nova-api:latest')
+        manifest = json.dumps({
+            'schemaVersion': 2,
+            'mediaType': image_uploader.MEDIA_MANIFEST_V2,
+            'config': {'digest': 'sha256:1234'},
+            'layers': [
+                {'digest': 'sha256:aaa', 'size': 10,
+                 'mediaType': image_uploader.MEDIA_BLOB_COMPRESSED},
+                {'digest': 'sha256:bbb', 'size': 20,
+                 'mediaType': image_uploader.MEDIA_BLOB_COMPRESSED},
+            ],
+        })
+        manifest_list = json.dumps({
+            'mediaType': image_uploader.MEDIA_MANIFEST_V2_LIST,
+            'manifests': [],
+        })
+        self.requests.get(
+            'https://registry-1.docker.io/v2/t/nova-api/blobs/sha256:1234',
+            json={'rootfs': {'diff_ids': ['sha256:a1', 'sha256:b1']}})
+
+        self.assertEqual({
+            'sha256:a1': {
+                'digest': 'sha256:aaa',
+                'size': 10,
+                'mediaType': image_uploader.MEDIA_BLOB_COMPRESSED},
+            'sha256:b1': {
+                'digest': 'sha256:bbb',
+                'size': 20,
+                'mediaType': image_uploader.MEDIA_BLOB_COMPRESSED},
+        }, self.uploader._source_layers_by_diff_id(
+            source_url, [manifest_list, manifest], requests.Session()))
+
+        # a config not matching the manifest maps nothing
+        self.requests.get(
+            'https://registry-1.docker.io/v2/t/nova-api/blobs/sha256:1234',
+            json={'rootfs': {'diff_ids': ['sha256:a1']}})
+        self.assertEqual({}, self.uploader._source_layers_by_diff_id(
+            source_url, [manifest], requests.Session()))
 
     @mock.patch('tripleo_common.image.image_uploader.'
                 'PythonImageUploader._detect_target_export')
@@ -2199,6 +2840,39 @@ class TestPythonImageUploader(base.TestCase):
             layer_entry
         )
 
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._layer_stream_registry')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._copy_layer_stream_to_registry')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._target_layer_exists_registry',
+                return_value=False)
+    @mock.patch('tripleo_common.utils.image.uploaded_layers_details',
+                return_value=(None, None))
+    def test_copy_layer_registry_to_registry_tee_errors(
+            self, global_check, _layer_exists, _copy_stream, _layer_stream):
+        source_url = urlparse('docker://docker.io/t/nova-api:latest')
+        targets = [urlparse('docker://192.0.2.%i:8787/t/nova-api:latest' % i)
+                   for i in range(1, 4)]
+        _layer_stream.return_value = iter([six.b('The Blob')])
+
+        def copy_stream(url, session, layer_entry, calc_digest,
+                        layer_stream, resume_stream):
+            list(layer_stream)
+            raise ValueError('failed %s' % url.netloc)
+        _copy_stream.side_effect = copy_stream
+
+        e = self.assertRaises(
+            ValueError, self.uploader._copy_layer_registry_to_registry,
+            source_url, targets[0], 'sha256:1234',
+            extra_targets=[(t, None) for t in targets[1:]])
+        # the primary upload error is raised, after every upload ran
+        self.assertEqual('failed 192.0.2.1:8787', str(e))
+        self.assertEqual(3, _copy_stream.call_count)
+        # the uploads hash the data, the source does not
+        self.assertIsInstance(_layer_stream.call_args[0][2],
+                              image_transfer.NullDigest)
+
     def test_assert_scheme(self):
         self.uploader._assert_scheme(
             urlparse('docker://docker.io/foo/bar:latest'),
@@ -2301,6 +2975,38 @@ class TestPythonImageUploader(base.TestCase):
         )
         self.assertEqual(target_manifest, put_manifest)
 
+    def test_run_layer_jobs(self):
+        copy_layer = mock.Mock(side_effect=['sha256:aaaa', None])
+        self.uploader._run_layer_jobs(
+            'nova-api',
+            [(copy_layer, ('a',), {'layer': 'sha256:aaaa'}),
+             (copy_layer, ('a',), {'layer': 'sha256:bbbb'})],
+            ('docker.io', 'localhost:8787'))
+        copy_layer.assert_has_calls([
+            mock.call('a', layer='sha256:aaaa'),
+            mock.call('a', layer='sha256:bbbb'),
+        ], any_order=True)
+
+    def test_run_layer_jobs_engine(self):
+        engine = image_transfer.TransferEngine(max_workers=2,
+                                               registry_limit=1)
+        self.uploader.init_transfer_engine(engine)
+        self.addCleanup(self.uploader.init_transfer_engine, None)
+        self.addCleanup(engine.shutdown)
+
+        copy_layer = mock.Mock(return_value='sha256:aaaa')
+        self.uploader._run_layer_jobs(
+            'nova-api', [(copy_layer, (), {'layer': 'sha256:aaaa'})],
+            ('docker.io', 'localhost:8787'))
+        copy_layer.assert_called_once_with(layer='sha256:aaaa')
+        self.assertEqual(
+            ['docker.io', 'localhost:8787'], sorted(engine._budgets))
+
+        copy_layer = mock.Mock(side_effect=IOError('failed'))
+        self.assertRaises(
+            IOError, self.uploader._run_layer_jobs, 'nova-api',
+            [(copy_layer, (), {})], ('docker.io',))
+
     @mock.patch('tripleo_common.image.image_uploader.'
                 'RegistrySessionHelper.check_status')
     @mock.patch('tripleo_common.image.image_uploader.'
@@ -2514,12 +3220,14 @@ class TestPythonImageUploader(base.TestCase):
         self.assertEqual(mock_success.communicate.call_count, 1)
 
     @mock.patch('os.path.exists')
-    @mock.patch('subprocess.Popen')
+    @mock.patch('tripleo_common.image.tar_split.compress')
+    @mock.patch('tripleo_common.image.tar_split.assemble')
     @mock.patch('tripleo_common.image.image_uploader.'
                 'PythonImageUploader._upload_url')
     @mock.patch('tripleo_common.utils.image.uploaded_layers_details')
     def test_copy_layer_local_to_registry(self, global_check, _upload_url,
-                                          mock_popen, mock_exists):
+                                          mock_assemble, mock_compress,
+                                          mock_exists):
         mock_exists.return_value = True
         _upload_url.return_value = 'https://192.168.2.1:5000/v2/upload'
         target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
@@ -2564,10 +3272,8 @@ class TestPythonImageUploader(base.TestCase):
         )
 
         # layer needs uploading
-        mock_success = mock.Mock()
-        mock_success.stdout = io.BytesIO(blob_compressed)
-        mock_success.returncode = 0
-        mock_popen.return_value = mock_success
+        mock_assemble.return_value = iter([blob_data])
+        mock_compress.return_value = iter([blob_compressed])
 
         target_session = requests.Session()
         self.requests.head(
@@ -2597,14 +3303,10 @@ class TestPythonImageUploader(base.TestCase):
             )
         )
         # test tar-split assemble call
-        mock_popen.assert_called_once_with([
-            'tar-split', 'asm',
-            '--input',
+        mock_assemble.assert_called_once_with(
             '/var/lib/containers/storage/overlay-layers/aaaa.tar-split.gz',
-            '--path',
-            '/var/lib/containers/storage/overlay/aaaa/diff',
-            '--compress'
-        ], stdout=-1)
+            '/var/lib/containers/storage/overlay/aaaa/diff')
+        mock_compress.assert_called_once_with(mock_assemble.return_value)
 
         # test side-effect of layer being fully populated
         self.assertEqual({
@@ -2681,10 +3383,12 @@ class TestPythonImageUploader(base.TestCase):
             status_code=200
         )
 
+        source_layer = {'digest': 'sha256:5ab123'}
         self.uploader._copy_local_to_registry(
             source_url=source_url,
             target_url=target_url,
-            session=target_session
+            session=target_session,
+            source_layers={'sha256:aeb786': source_layer}
         )
 
         _containers_json.assert_called_once_with(
@@ -2694,13 +3398,15 @@ class TestPythonImageUploader(base.TestCase):
             target_url,
             target_session,
             {'digest': 'sha256:aeb786'},
-            layers[0]
+            layers[0],
+            source_layer=source_layer
         )
         _copy_layer_local_to_registry.assert_any_call(
             target_url,
             target_session,
             {'digest': 'sha256:4dc536'},
-            layers[1]
+            layers[1],
+            source_layer=None
         )
         self.assertTrue(put_config.called)
         self.assertTrue(put_manifest.called)
@@ -2751,6 +3457,139 @@ class TestPythonImageUploader(base.TestCase):
                     'overlay-layers', 'layers.json')
             )
 
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._containers_json')
+    def test_containers_index(self, _containers_json):
+        storage = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, storage)
+        os.mkdir(os.path.join(storage, 'overlay-layers'))
+        layers_path = os.path.join(storage, 'overlay-layers', 'layers.json')
+        with open(layers_path, 'w') as f:
+            f.write('[]')
+        layers = [{
+            'id': 'aaaa',
+            'diff-digest': 'sha256:1111',
+            'compressed-diff-digest': 'sha256:2222',
+        }]
+        _containers_json.return_value = layers
+
+        with mock.patch('tripleo_common.image.image_uploader.'
+                        'CONTAINERS_STORAGE_DIR', storage):
+            for i in range(3):
+                self.assertEqual({
+                    'sha256:1111': layers[0],
+                    'sha256:2222': layers[0],
+                }, self.uploader._get_all_local_layers_by_digest())
+            _containers_json.assert_called_once_with(
+                'overlay-layers', 'layers.json')
+
+            # a new layers.json is parsed again
+            with open(layers_path, 'w') as f:
+                f.write('[{}]')
+            _containers_json.return_value = []
+            self.assertEqual(
+                {}, self.uploader._get_all_local_layers_by_digest())
+            self.assertEqual(2, _containers_json.call_count)
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._target_layer_exists_registry')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._local_layer_paths')
+    def test_copy_layer_local_to_registry_cached(self, _local_layer_paths,
+                                                 _layer_exists):
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        layer = {'digest': 'sha256:1111'}
+        layer_entry = {
+            'diff-digest': 'sha256:1111',
+            'diff-size': 10,
+            'id': 'aaaa'
+        }
+        _local_layer_paths.return_value = ('/tar-split.gz', '/diff')
+        cache = mock.Mock()
+        cache.lookup.return_value = {
+            'path': '/cache/aaaa.tar.gz',
+            'digest': 'sha256:3333',
+            'size': 5,
+        }
+        self.addCleanup(self.uploader.init_local_layer_cache)
+        image_uploader.PythonImageUploader.local_layer_cache = cache
+        _layer_exists.return_value = True
+
+        # the source layer and the digest an earlier push compressed the
+        # layer to are checked
+        source_layer = {
+            'digest': 'sha256:2222',
+            'size': 4,
+            'mediaType': image_uploader.MEDIA_BLOB_COMPRESSED,
+        }
+        self.assertIsNone(self.uploader._copy_layer_local_to_registry(
+            target_url, None, layer, layer_entry, source_layer=source_layer))
+        _layer_exists.assert_called_once_with(target_url, layer, [
+            source_layer,
+            {
+                'digest': 'sha256:1111',
+                'size': 10,
+                'mediaType': image_uploader.MEDIA_BLOB,
+            },
+            {
+                'digest': 'sha256:3333',
+                'size': 5,
+                'mediaType': image_uploader.MEDIA_BLOB_COMPRESSED,
+            }
+        ], None)
+        cache.lookup.assert_called_once_with('aaaa', '/tar-split.gz')
+        cache.get.assert_not_called()
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.uploaded_layers', {})
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.lock', threadinglock.ThreadingLock())
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._target_layer_exists_registry',
+                return_value=False)
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._local_layer_paths')
+    def test_copy_layer_local_to_export_cached(self, _local_layer_paths,
+                                               _layer_exists):
+        export_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, export_dir)
+        self.addCleanup(setattr, image_export, 'IMAGE_EXPORT_DIR',
+                        image_export.IMAGE_EXPORT_DIR)
+        image_export.IMAGE_EXPORT_DIR = os.path.join(export_dir, 'serve')
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        self.uploader.export_registries.add(target_url.netloc)
+
+        # a compressed layer in the local layer cache is piped to the
+        # export as a file
+        data = zlib.compress(b'layer data')
+        blob = os.path.join(export_dir, 'aaaa.tar.gz')
+        with open(blob, 'wb') as f:
+            f.write(data)
+        digest = 'sha256:%s' % hashlib.sha256(data).hexdigest()
+        _local_layer_paths.return_value = ('/tar-split.gz', '/diff')
+        cache = mock.Mock()
+        cache.lookup.return_value = cache.get.return_value = {
+            'path': blob, 'digest': digest, 'size': len(data)}
+        self.addCleanup(self.uploader.init_local_layer_cache)
+        image_uploader.PythonImageUploader.local_layer_cache = cache
+
+        layer = {'digest': 'sha256:1111'}
+        layer_entry = {
+            'diff-digest': 'sha256:1111',
+            'diff-size': 10,
+            'id': 'aaaa'
+        }
+        with mock.patch('tripleo_common.image.upload_metrics.'
+                        'METRICS') as metrics:
+            self.assertEqual(digest, self.uploader.
+                             _copy_layer_local_to_registry(
+                                 target_url, None, layer, layer_entry))
+        metrics.add_transfer.assert_called_once_with(
+            target_url.netloc, upload_metrics.TRANSFER_PUSH, len(data),
+            mock.ANY)
+        with open(image_export.blob_store_path(digest), 'rb') as f:
+            self.assertEqual(data, f.read())
+
     @mock.patch('tripleo_common.image.image_uploader.'
                 'PythonImageUploader._get_local_layers_manifest')
     @mock.patch('tripleo_common.image.image_uploader.'
@@ -3156,3 +3995,646 @@ class TestPythonImageUploader(base.TestCase):
             ],
             layers
         )
+
+    def _planning_task(self, name, push_destination='localhost:8787',
+                       modify_role=None):
+        return image_uploader.UploadTask(
+            image_name='docker.io/t/%s:latest' % name,
+            pull_source=None,
+            push_destination=push_destination,
+            append_tag=None,
+            modify_role=modify_role,
+            modify_vars=None,
+            cleanup='full',
+            multi_arch=False
+        )
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._fetch_shared_layers')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._fetch_manifest')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.authenticate')
+    def test_schedule_shared_layers(self, authenticate, _fetch_manifest,
+                                    _fetch_shared_layers):
+        manifests = {
+            'cinder-volume': ['sha256:base', 'sha256:cinder', 'sha256:vol'],
+            'cinder-backup': ['sha256:base', 'sha256:cinder', 'sha256:bak'],
+            'nova-api': ['sha256:base', 'sha256:nova'],
+            'glance-api': ['sha256:base', 'sha256:glance'],
+        }
+
+        def fetch_manifest(url, session, multi_arch):
+            name = url.path.split('/')[-1].split(':')[0]
+            return json.dumps({
+                'schemaVersion': 2,
+                'mediaType': image_uploader.MEDIA_MANIFEST_V2,
+                'layers': [{'digest': x} for x in manifests[name]]
+            })
+        _fetch_manifest.side_effect = fetch_manifest
+
+        volume = self._planning_task('cinder-volume')
+        backup = self._planning_task('cinder-backup')
+        nova = self._planning_task('nova-api')
+        # modify tasks are not planned
+        modify = self._planning_task('glance-api', modify_role='foo')
+        for t in (volume, backup, nova, modify):
+            self.uploader.add_upload_task(t)
+
+        self.uploader._schedule_shared_layers()
+
+        _fetch_shared_layers.assert_called_once_with(
+            volume, ['sha256:base', 'sha256:cinder'])
+        self.assertEqual(3, _fetch_manifest.call_count)
+        self.assertEqual(manifests['cinder-backup'], backup.source_layers)
+        self.assertEqual(1, len(backup.source_manifests))
+        self.assertIsNone(modify.source_layers)
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._image_manifest_config')
+    def test_local_layers_reused(self, _image_manifest_config):
+        layers = {
+            'nova-api': ['sha256:base', 'sha256:nova'],
+            'nova-compute': ['sha256:base', 'sha256:compute'],
+            'glance-api': ['sha256:glance'],
+        }
+
+        def manifest_config(name):
+            image = name.split('/')[-1].split(':')[0]
+            return None, {'layers': [
+                {'digest': x} for x in layers[image]]}, '{}'
+        _image_manifest_config.side_effect = manifest_config
+
+        def local_task(name):
+            return image_uploader.UploadTask(
+                image_name='containers-storage:t/%s:latest' % name,
+                pull_source=None,
+                push_destination='localhost:8787',
+                append_tag=None,
+                modify_role=None,
+                modify_vars=None,
+                cleanup='full',
+                multi_arch=False
+            )
+
+        # remote sources and a single local source reuse nothing
+        self.uploader.add_upload_task(self._planning_task('cinder-api'))
+        self.uploader.add_upload_task(local_task('glance-api'))
+        self.assertFalse(self.uploader._local_layers_reused())
+        _image_manifest_config.assert_not_called()
+
+        self.uploader.add_upload_task(local_task('nova-api'))
+        self.assertFalse(self.uploader._local_layers_reused())
+
+        self.uploader.add_upload_task(local_task('nova-compute'))
+        self.assertTrue(self.uploader._local_layers_reused())
+
+        # modified images are uploaded from local layers too
+        self.uploader.upload_tasks = []
+        self.uploader.add_upload_task(local_task('glance-api'))
+        self.uploader.add_upload_task(
+            self._planning_task('keystone', modify_role='foo'))
+        self.assertTrue(self.uploader._local_layers_reused())
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._fetch_shared_layers')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._fetch_manifest')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.authenticate')
+    def test_schedule_shared_layers_per_registry(
+            self, authenticate, _fetch_manifest, _fetch_shared_layers):
+        _fetch_manifest.return_value = json.dumps({
+            'schemaVersion': 2,
+            'mediaType': image_uploader.MEDIA_MANIFEST_V2,
+            'layers': [{'digest': 'sha256:base'}]
+        })
+        # the same layer pushed to different registries cannot be mounted
+        # between them, so it is not shared
+        self.uploader.add_upload_task(
+            self._planning_task('nova-api', 'localhost:8787'))
+        self.uploader.add_upload_task(
+            self._planning_task('nova-api', '192.0.2.1:8787'))
+
+        self.uploader._schedule_shared_layers()
+        _fetch_shared_layers.assert_not_called()
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._fetch_manifest')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.authenticate')
+    def test_plan_task_layers_failure(self, authenticate, _fetch_manifest):
+        _fetch_manifest.side_effect = ImageNotFoundException('not found')
+        task = self._planning_task('nova-api')
+        self.assertEqual((task, []),
+                         self.uploader._plan_task_layers(task))
+        self.assertIsNone(task.source_manifests)
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._detect_target_export')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.authenticate')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._fetch_manifest')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._cross_repo_mount')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._copy_registry_to_registry')
+    def test_upload_image_planned(
+            self, _copy_registry_to_registry, _cross_repo_mount,
+            _fetch_manifest, authenticate, _detect_target_export):
+        task = self._planning_task('nova-api')
+        task.source_manifests = ['{}']
+        task.source_layers = ['sha256:aaa']
+
+        self.assertEqual([], self.uploader.upload_image(task))
+        _fetch_manifest.assert_not_called()
+        _copy_registry_to_registry.assert_called_once_with(
+            task.source_image_url,
+            task.target_image_url,
+            source_manifests=['{}'],
+            source_session=mock.ANY,
+            target_session=mock.ANY,
+            source_layers=['sha256:aaa'],
+            multi_arch=False,
+            extra_targets=[]
+        )
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'RegistrySessionHelper.post')
+    def test_detect_target_export_cached(self, mock_post):
+        url = urlparse('docker://192.0.2.0:8787/t/nova-api:latest')
+        mock_post.side_effect = requests.exceptions.HTTPError(
+            response=mock.Mock(status_code=404))
+        self.assertTrue(self.uploader._detect_target_export(url, None))
+        self.assertEqual(
+            image_uploader.REGISTRY_TARGET_EXPORT,
+            self.uploader._registry_capability('192.0.2.0:8787', 'target'))
+
+        # a later run does not request an upload URL again
+        self.uploader.export_registries.clear()
+        self.assertTrue(self.uploader._detect_target_export(url, None))
+        self.assertEqual(1, mock_post.call_count)
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.uploaded_layers', {})
+    def test_init_layer_index(self):
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir)
+        index_path = os.path.join(index_dir, '.layer-index')
+        blob_path = os.path.join(index_dir, 'sha256:aaaa.gz')
+        with open(blob_path, 'w') as f:
+            f.write('blob')
+        index = layer_index.LayerIndex(index_path)
+        index.add_layer('sha256:aaaa', 'local', path=blob_path,
+                        ref='t/nova-api')
+        index.add_layer('sha256:bbbb', 'local', path=blob_path + '.gone',
+                        ref='t/nova-api')
+        index.add_layer('sha256:cccc', 'remote',
+                        path='https://192.0.2.1/v2/t/nova-api:latest',
+                        ref='t/nova-api')
+        index.add_manifest('sha256:1234', '192.0.2.1/t/nova-api:latest',
+                           'sha256:5678')
+
+        u = image_uploader.PythonImageUploader
+        with mock.patch.object(u, 'lock', threadinglock.ThreadingLock()):
+            u.init_layer_index(index_path)
+            self.addCleanup(u.init_layer_index, None)
+            self.assertEqual({
+                'sha256:aaaa': {
+                    'local': {'path': blob_path, 'ref': 't/nova-api'}},
+                'sha256:cccc': {
+                    'remote': {
+                        'path': 'https://192.0.2.1/v2/t/nova-api:latest',
+                        'ref': 't/nova-api'}},
+            }, u._global_view_snapshot())
+            self.assertEqual(
+                {'sha256:1234': {
+                    '192.0.2.1/t/nova-api:latest': 'sha256:5678'}},
+                u.uploaded_manifests)
+            self.assertEqual(set(['sha256:cccc']), u.unverified_layers)
+
+            # tracked layers are written back to the index
+            u._track_uploaded_layers('sha256:aaaa', forget=True)
+            layers, _ = index.load()
+            self.assertNotIn('sha256:aaaa', layers)
+
+    def test_uploaded_layers_view(self):
+        local = {
+            'sha256:aaaa': {'local': {'path': '/a', 'ref': 't/a'}},
+            'sha256:bbbb': {'remote': {'path': 'http://b', 'ref': 't/b'}},
+        }
+        shared = mock.MagicMock(wraps={
+            'sha256:bbbb': {'local': {'path': '/b', 'ref': 't/b'}},
+            'sha256:cccc': {'remote': {'path': 'http://c', 'ref': 't/c'}},
+        })
+        view = image_uploader.UploadedLayersView(local, shared)
+
+        self.assertEqual(local['sha256:aaaa'], view['sha256:aaaa'])
+        self.assertEqual({'local': {'path': '/b', 'ref': 't/b'}},
+                         view.get('sha256:bbbb'))
+        self.assertIn('sha256:cccc', view)
+        self.assertNotIn('sha256:dddd', view)
+        self.assertIsNone(view.get('sha256:dddd'))
+        self.assertRaises(KeyError, view.__getitem__, 'sha256:dddd')
+        self.assertEqual(
+            ('/b', 't/b'),
+            image_utils.uploaded_layers_details(view, 'sha256:bbbb',
+                                                'local'))
+        # lookups never copy the shared view
+        shared.copy.assert_not_called()
+
+        self.assertEqual(
+            ['sha256:aaaa', 'sha256:bbbb', 'sha256:cccc'],
+            sorted(view.copy()))
+        self.assertEqual({'local': {'path': '/b', 'ref': 't/b'}},
+                         view.copy()['sha256:bbbb'])
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.uploaded_layers', {})
+    def test_global_view_read_unlocked(self):
+        u = image_uploader.PythonImageUploader
+        lock = mock.Mock(wraps=threadinglock.ThreadingLock())
+        lock._global_view = {}
+        with mock.patch.object(u, 'lock', lock):
+            u._track_uploaded_layers('sha256:aaaa', known_path='/a',
+                                     image_ref='t/a', scope='local')
+            self.assertEqual(1, lock.get_lock.call_count)
+
+            # lookups do not wait for writers
+            view = u._global_view_proxy()
+            self.assertIn('sha256:aaaa', view)
+            self.assertEqual(
+                ('/a', 't/a'),
+                image_utils.uploaded_layers_details(
+                    view, 'sha256:aaaa', 'local'))
+            self.assertEqual(1, lock.get_lock.call_count)
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.uploaded_layers', {})
+    def test_layer_fetch_lock(self):
+        u = image_uploader.PythonImageUploader
+        lock = threadinglock.ThreadingLock()
+        done = []
+
+        def fetch():
+            u._layer_fetch_lock('sha256:aaaa')
+            done.append(dict(lock.objects()))
+            u._layer_fetch_unlock('sha256:aaaa')
+
+        with mock.patch.object(u, 'lock', lock):
+            u._layer_fetch_lock('sha256:aaaa')
+            self.assertIn('sha256:aaaa', lock.objects())
+            t = threading.Thread(target=fetch)
+            t.start()
+            time.sleep(0.1)
+            self.assertEqual([], done)
+
+            # the waiter is woken up by the release, and does not hold a
+            # layer which was uploaded meanwhile
+            u._track_uploaded_layers(
+                'sha256:aaaa', known_path='https://192.0.2.1/v2/t/a',
+                image_ref='t/a')
+            u._layer_fetch_unlock('sha256:aaaa')
+            t.join(5)
+            self.assertEqual([{}], done)
+
+            # processed layers are not held
+            u._layer_fetch_lock('sha256:aaaa')
+            self.assertEqual({}, dict(lock.objects()))
+
+    def test_init_layer_index_missing_dir(self):
+        u = image_uploader.PythonImageUploader
+        u.init_layer_index('/does/not/exist/.layer-index')
+        self.assertIsNone(u.layer_index)
+
+    @mock.patch('os.path.isdir', return_value=True)
+    def test_init_layer_index_export_dir(self, mock_isdir):
+        u = image_uploader.PythonImageUploader
+        u.init_layer_index(os.path.join(image_export.IMAGE_EXPORT_DIR,
+                                        '.layer-index'))
+        self.assertIsNone(u.layer_index)
+        mock_isdir.assert_not_called()
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.uploaded_layers', {})
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader.unverified_layers',
+                set(['sha256:aaaa']))
+    def test_target_layer_exists_registry_index(self):
+        u = image_uploader.PythonImageUploader
+        target_url = urlparse('docker://192.0.2.1:8787/t/nova-api:latest')
+        blob_url = ('https://192.0.2.1:8787/v2/t/nova-api/blobs/'
+                    'sha256:aaaa')
+        session = requests.Session()
+        layer = {'digest': 'sha256:aaaa'}
+        with mock.patch.object(u, 'lock', threadinglock.ThreadingLock()):
+            u._global_view_proxy(value={'sha256:aaaa': {'remote': {
+                'path': 'https://192.0.2.1:8787/v2/t/nova-api:latest',
+                'ref': 't/nova-api'}}})
+
+            # a layer from the index is checked in the registry first
+            self.requests.head(blob_url, status_code=404)
+            self.assertFalse(u._target_layer_exists_registry(
+                target_url, layer, [layer], session))
+            self.requests.head(blob_url, status_code=200)
+            self.assertTrue(u._target_layer_exists_registry(
+                target_url, layer, [layer], session))
+            self.assertEqual(2, len([r for r in self.requests.request_history
+                                     if r.method == 'HEAD']))
+
+            # and trusted once seen there
+            self.assertTrue(u._target_layer_exists_registry(
+                target_url, layer, [layer], session))
+            self.assertEqual(2, len([r for r in self.requests.request_history
+                                     if r.method == 'HEAD']))
+
+    def test_manifest_uploaded(self):
+        u = image_uploader.PythonImageUploader
+        target_url = urlparse('docker://192.0.2.1:8787/t/nova-api:latest')
+        manifest_str = '{"schemaVersion": 2}'
+        manifest_url = ('https://192.0.2.1:8787/v2/t/nova-api/'
+                        'manifests/latest')
+        session = requests.Session()
+
+        # no index, always upload
+        self.assertFalse(u._manifest_uploaded(
+            manifest_str, target_url, session))
+
+        index = mock.Mock()
+        self.addCleanup(u.init_layer_index, None)
+        with mock.patch.object(u, 'layer_index', index):
+            self.assertFalse(u._manifest_uploaded(
+                manifest_str, target_url, session))
+
+            self.requests.head(
+                manifest_url, status_code=200,
+                headers={'Docker-Content-Digest': 'sha256:5678'})
+            u._index_manifest(manifest_str, target_url, session)
+            digest = u._manifest_digest(manifest_str)
+            index.add_manifest.assert_called_once_with(
+                digest, '192.0.2.1:8787/t/nova-api:latest', 'sha256:5678')
+
+            self.assertTrue(u._manifest_uploaded(
+                manifest_str, target_url, session))
+
+            # the tag was pushed over since the last run
+            self.requests.head(
+                manifest_url, status_code=200,
+                headers={'Docker-Content-Digest': 'sha256:9999'})
+            self.assertFalse(u._manifest_uploaded(
+                manifest_str, target_url, session))
+
+            # deleted from the target registry since the last run
+            self.requests.head(manifest_url, status_code=404)
+            self.assertFalse(u._manifest_uploaded(
+                manifest_str, target_url, session))
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'RegistrySessionHelper.put')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'RegistrySessionHelper.get')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'RegistrySessionHelper.patch')
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'PythonImageUploader._upload_url')
+    def test_copy_stream_to_registry_resume(self, _upload_url, mock_patch,
+                                            mock_get, mock_put):
+        blob_data = six.b('aaaabbbbcccc')
+        blob_digest = 'sha256:' + hashlib.sha256(blob_data).hexdigest()
+        target_url = urlparse('docker://192.168.2.1:5000/t/nova-api:latest')
+        session = mock.Mock()
+        _upload_url.return_value = 'https://192.168.2.1:5000/v2/upload'
+
+        def stream(data, calc_digest):
+            for i in range(0, len(data), 4):
+                chunk = data[i:i + 4]
+                calc_digest.update(chunk)
+                yield chunk
+
+        resumed = []
+
+        def resume_stream(offset, calc_digest):
+            resumed.append(offset)
+            return stream(blob_data[offset:], calc_digest)
+
+        patch_resp = mock.Mock(headers={})
+        # the registry committed half of the failed chunk
+        mock_patch.side_effect = [
+            patch_resp,
+            requests.exceptions.ConnectionError('reset'),
+            patch_resp,
+            patch_resp
+        ]
+        mock_get.return_value = mock.Mock(headers={
+            'Range': '0-5',
+            'Location': 'https://192.168.2.1:5000/v2/upload2'
+        })
+
+        calc_digest = hashlib.sha256()
+        layer = {'digest': blob_digest}
+        self.assertEqual(
+            (blob_digest,
+             'https://192.168.2.1:5000/v2/t/nova-api:latest'),
+            self.uploader._copy_stream_to_registry(
+                target_url, layer, calc_digest,
+                stream(blob_data, calc_digest), session,
+                resume_stream=resume_stream)
+        )
+        self.assertEqual([4], resumed)
+        self.assertEqual(12, layer['size'])
+        mock_get.assert_called_once_with(
+            session, 'https://192.168.2.1:5000/v2/upload', timeout=30)
+        self.assertEqual(
+            [('0-3', six.b('aaaa')), ('4-7', six.b('bbbb')),
+             ('6-7', six.b('bb')), ('8-11', six.b('cccc'))],
+            [(c[1]['headers']['Content-Range'], c[1]['data'])
+             for c in mock_patch.call_args_list]
+        )
+        mock_put.assert_called_once_with(
+            session, 'https://192.168.2.1:5000/v2/upload', timeout=30,
+            params={'digest': blob_digest})
+
+        # the registry lost committed data, the upload can't be resumed
+        mock_patch.reset_mock()
+        mock_patch.side_effect = [
+            patch_resp,
+            requests.exceptions.ConnectionError('reset'),
+        ]
+        mock_get.return_value = mock.Mock(headers={'Range': '0-0'})
+        calc_digest = hashlib.sha256()
+        self.assertRaises(
+            requests.exceptions.ConnectionError,
+            self.uploader._copy_stream_to_registry,
+            target_url, layer, calc_digest,
+            stream(blob_data, calc_digest), session,
+            resume_stream=resume_stream)
+
+        # without a resume stream the error is raised as before
+        mock_patch.reset_mock()
+        mock_patch.side_effect = requests.exceptions.ConnectionError('reset')
+        calc_digest = hashlib.sha256()
+        self.assertRaises(
+            requests.exceptions.ConnectionError,
+            self.uploader._copy_stream_to_registry,
+            target_url, layer, calc_digest,
+            stream(blob_data, calc_digest), session)
+
+    def test_layer_stream_registry_offset(self):
+        blob_data = six.b('The Blob')
+        source_url = urlparse('docker://docker.io/t/nova-api:latest')
+        blob_url = ('https://registry-1.docker.io/v2/t/nova-api/blobs/'
+                    'sha256:1234')
+        session = requests.Session()
+
+        # source honours the range
+        self.requests.get(blob_url, content=blob_data[4:], status_code=206)
+        calc_digest = hashlib.sha256()
+        self.assertEqual(
+            six.b('Blob'),
+            six.b('').join(self.uploader._layer_stream_registry(
+                'sha256:1234', source_url, calc_digest, session, offset=4))
+        )
+        self.assertEqual('bytes=4-',
+                         self.requests.last_request.headers['Range'])
+        self.assertEqual(hashlib.sha256(six.b('Blob')).hexdigest(),
+                         calc_digest.hexdigest())
+
+        # source ignores the range and sends the whole blob
+        self.requests.get(blob_url, content=blob_data, status_code=200)
+        calc_digest = hashlib.sha256()
+        self.assertEqual(
+            six.b('Blob'),
+            six.b('').join(self.uploader._layer_stream_registry(
+                'sha256:1234', source_url, calc_digest, session, offset=4))
+        )
+        self.assertEqual(hashlib.sha256(six.b('Blob')).hexdigest(),
+                         calc_digest.hexdigest())
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'LAYER_SEGMENT_SIZE', 3)
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'LAYER_SEGMENT_THRESHOLD', 4)
+    def test_layer_stream_registry_segments(self):
+        blob_data = six.b('The Blob Data')
+        source_url = urlparse('docker://docker.io/t/nova-api:latest')
+        blob_url = ('https://registry-1.docker.io/v2/t/nova-api/blobs/'
+                    'sha256:1234')
+        cdn_url = 'https://cdn.example.com/blobs/sha256:1234'
+        session = requests.Session()
+        session.headers['Authorization'] = 'Bearer x'
+
+        def blob_content(request, context):
+            context.headers['Accept-Ranges'] = 'bytes'
+            if 'Range' not in request.headers:
+                context.headers['Content-Length'] = str(len(blob_data))
+                return blob_data
+            start, end = request.headers['Range'][6:].split('-')
+            end = int(end) + 1 if end else len(blob_data)
+            context.status_code = 206
+            context.headers['Content-Length'] = str(end - int(start))
+            return blob_data[int(start):end]
+
+        self.requests.get(blob_url, status_code=307,
+                          headers={'Location': cdn_url})
+        self.requests.get(cdn_url, content=blob_content)
+
+        calc_digest = hashlib.sha256()
+        chunks = list(self.uploader._layer_stream_registry(
+            'sha256:1234', source_url, calc_digest, session))
+        self.assertEqual(
+            [six.b('The'), six.b(' Bl'), six.b('ob '), six.b('Dat'),
+             six.b('a')],
+            chunks
+        )
+        self.assertEqual(hashlib.sha256(blob_data).hexdigest(),
+                         calc_digest.hexdigest())
+        ranges = sorted(r.headers['Range']
+                        for r in self.requests.request_history
+                        if r.url == cdn_url and 'Range' in r.headers)
+        self.assertEqual(
+            ['bytes=12-12', 'bytes=3-5', 'bytes=6-8', 'bytes=9-11'],
+            ranges
+        )
+        # the registry token is not sent to the untrusted redirect target
+        for r in self.requests.request_history:
+            if r.url == cdn_url:
+                self.assertNotIn('Authorization', r.headers)
+
+        # resuming from an offset only fetches the tail
+        calc_digest = hashlib.sha256()
+        self.assertEqual(
+            blob_data[5:],
+            six.b('').join(self.uploader._layer_stream_registry(
+                'sha256:1234', source_url, calc_digest, session, offset=5))
+        )
+        self.assertEqual(hashlib.sha256(blob_data[5:]).hexdigest(),
+                         calc_digest.hexdigest())
+
+        # small blobs are streamed in one request
+        calls = self.requests.call_count
+        self.requests.get(cdn_url, content=blob_data[:4],
+                          headers={'Accept-Ranges': 'bytes',
+                                   'Content-Length': '4'})
+        self.assertEqual(
+            blob_data[:4],
+            six.b('').join(self.uploader._layer_stream_registry(
+                'sha256:1234', source_url, hashlib.sha256(), session))
+        )
+        self.assertEqual(calls + 2, self.requests.call_count)
+
+    def test_layer_segment_fetch(self):
+        blob_data = six.b('The Blob')
+        blob_url = 'https://192.0.2.1:8787/v2/t/nova-api/blobs/sha256:1234'
+        session = requests.Session()
+        responses = [
+            # the token expired, the helper re-authenticates
+            {'status_code': 401, 'content': six.b('')},
+            # the connection is cut short
+            {'status_code': 206, 'content': blob_data[2:5]},
+            {'status_code': 206, 'content': blob_data[5:]},
+        ]
+        self.requests.get(blob_url, responses)
+        chunks = []
+
+        def put(data):
+            chunks.append(data)
+            return True
+
+        position = [2]
+        self.uploader._layer_segment_fetch(
+            blob_url, position, len(blob_data) - 1, session, {}, put)
+        self.assertEqual(blob_data[2:], six.b('').join(chunks))
+        self.assertEqual([len(blob_data)], position)
+        # the retry resumes after the data already put
+        self.assertEqual(
+            ['bytes=2-7', 'bytes=2-7', 'bytes=5-7'],
+            [r.headers['Range'] for r in self.requests.request_history])
+
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'LAYER_SEGMENT_BUFFER', 1)
+    @mock.patch('tripleo_common.image.image_uploader.'
+                'LAYER_SEGMENT_CHUNK_SIZE', 1)
+    def test_layer_segments_stream_bounded(self):
+        blob_data = six.b('The Blob Data')
+        blob_url = 'https://192.0.2.1:8787/v2/t/nova-api/blobs/sha256:1234'
+        session = requests.Session()
+
+        def blob_content(request, context):
+            start, end = request.headers['Range'][6:].split('-')
+            context.status_code = 206
+            return blob_data[int(start):int(end) + 1]
+
+        self.requests.get(blob_url, content=blob_content)
+        segments = [(0, 5), (6, 9), (10, 12)]
+        self.assertEqual(blob_data, six.b('').join(
+            self.uploader._layer_segments_stream(
+                blob_url, segments, session, {})))
+
+        # segment workers blocked on a full buffer stop with the stream
+        stream = self.uploader._layer_segments_stream(
+            blob_url, segments, session, {})
+        self.assertEqual(six.b('T'), next(stream))
+        start = time.time()
+        stream.close()
+        self.assertLess(time.time() - start, 5)
@@ -1064,8 +1064,10 @@ class TestPrepare(base.TestCase):
             }
         }
         roles_data = []
-        mock_cip.side_effect = [
-            {
+        # entries are prepared concurrently, so results are keyed by the
+        # tag_from_label of each entry rather than by call order
+        prepare_data = {
+            'foo': {
                 'image_params': {
                     'FooImage': 't/foo:latest',
                     'BarImage': 't/bar:latest',
@@ -1073,20 +1075,8 @@ class TestPrepare(base.TestCase):
                     'BinkImage': 't/bink:latest'
                 },
                 'upload_data': []
-            }, {
-                'image_params': {
-                    'BarImage': 't/bar:1.0',
-                    'BazImage': 't/baz:1.0'
-                },
-                'upload_data': [{
-                    'imagename': 't/bar:1.0',
-                    'push_destination': '192.0.2.1:8787'
-                }, {
-                    'imagename': 't/baz:1.0',
-                    'push_destination': '192.0.2.1:8787'
-                }]
             },
-            {
+            'bar': {
                 'image_params': {
                     'BarImage': 't/bar:1.0',
                     'BazImage': 't/baz:1.0'
@@ -1099,7 +1089,9 @@ class TestPrepare(base.TestCase):
                     'push_destination': '192.0.2.1:8787'
                 }]
             },
-        ]
+        }
+        mock_cip.side_effect = lambda **kwargs: copy.deepcopy(
+            prepare_data[kwargs['tag_from_label']])
 
         image_params = kb.container_images_prepare_multi(env, roles_data,
                                                          lock=mock_lock)
@@ -1177,9 +1169,11 @@ class TestPrepare(base.TestCase):
                 multi_arch=False,
                 lock=mock_lock
             )
-        ])
+        ], any_order=True)
 
-        self.assertEqual(mock_im.call_count, 2)
+        # every entry is uploaded by one manager
+        self.assertEqual(mock_im.call_count, 1)
+        mock_im.return_value.upload.assert_called_once_with()
 
         self.assertEqual(
             {
@@ -1191,6 +1185,50 @@ class TestPrepare(base.TestCase):
             image_params
         )
 
+    def test_merge_upload_data(self):
+        self.assertEqual([{
+            'imagename': 't/bar:1.0',
+            'push_destination': ['192.0.2.1:8787', '192.0.2.3:8787']
+        }, {
+            'imagename': 't/baz:1.0',
+            'push_destination': '192.0.2.1:8787',
+            'modify_role': 'add-foo-plugin'
+        }, {
+            'imagename': 't/baz:1.0',
+            'push_destination': '192.0.2.3:8787',
+            'modify_role': 'add-foo-plugin'
+        }, {
+            'imagename': 't/bink:1.0',
+            'push_destination': True
+        }], kb.merge_upload_data([{
+            'imagename': 't/bar:1.0',
+            'push_destination': '192.0.2.1:8787'
+        }, {
+            'imagename': 't/baz:1.0',
+            'push_destination': '192.0.2.1:8787',
+            'modify_role': 'add-foo-plugin'
+        }, {
+            'imagename': 't/bar:1.0',
+            'push_destination': '192.0.2.3:8787'
+        }, {
+            'imagename': 't/bar:1.0',
+            'push_destination': '192.0.2.1:8787'
+        }, {
+            'imagename': 't/baz:1.0',
+            'push_destination': '192.0.2.1:8787',
+            'modify_role': 'add-foo-plugin'
+        }, {
+            'imagename': 't/baz:1.0',
+            'push_destination': '192.0.2.3:8787',
+            'modify_role': 'add-foo-plugin'
+        }, {
+            'imagename': 't/bink:1.0',
+            'push_destination': True
+        }, {
+            'imagename': 't/bink:1.0',
+            'push_destination': True
+        }]))
+
     @mock.patch('tripleo_common.image.kolla_builder.container_images_prepare')
     def test_container_images_prepare_multi_dry_run(self, mock_cip):
         mock_lock = mock.MagicMock()
@@ -1217,8 +1255,8 @@ class TestPrepare(base.TestCase):
             }
         }
         roles_data = []
-        mock_cip.side_effect = [
-            {
+        prepare_data = {
+            None: {
                 'image_params': {
                     'FooImage': 't/foo:latest',
                     'BarImage': 't/bar:latest',
@@ -1226,7 +1264,8 @@ class TestPrepare(base.TestCase):
                     'BinkImage': 't/bink:latest'
                 },
                 'upload_data': []
-            }, {
+            },
+            '192.0.2.1:8787': {
                 'image_params': {
                     'BarImage': 't/bar:1.0',
                     'BazImage': 't/baz:1.0'
@@ -1239,7 +1278,9 @@ class TestPrepare(base.TestCase):
                     'push_destination': '192.0.2.1:8787'
                 }]
             },
-        ]
+        }
+        mock_cip.side_effect = lambda **kwargs: copy.deepcopy(
+            prepare_data[kwargs['push_destination']])
 
         image_params = kb.container_images_prepare_multi(env, roles_data, True,
                                                          lock=mock_lock)
@@ -1285,7 +1326,7 @@ class TestPrepare(base.TestCase):
                 multi_arch=False,
                 lock=mock_lock
             )
-        ])
+        ], any_order=True)
         self.assertEqual(
             {
                 'BarImage': 't/bar:1.0',
@@ -1328,8 +1369,8 @@ class TestPrepare(base.TestCase):
             }
         }
         roles_data = []
-        mock_cip.side_effect = [
-            {
+        prepare_data = {
+            None: {
                 'image_params': {
                     'FooImage': 't/foo:latest',
                     'BarImage': 't/bar:latest',
@@ -1337,7 +1378,8 @@ class TestPrepare(base.TestCase):
                     'BinkImage': 't/bink:latest'
                 },
                 'upload_data': []
-            }, {
+            },
+            '192.0.2.1:8787': {
                 'image_params': {
                     'BarImage': 't/bar:1.0',
                     'BazImage': 't/baz:1.0'
@@ -1350,7 +1392,9 @@ class TestPrepare(base.TestCase):
                     'push_destination': '192.0.2.1:8787'
                 }]
             },
-        ]
+        }
+        mock_cip.side_effect = lambda **kwargs: copy.deepcopy(
+            prepare_data[kwargs['push_destination']])
 
         image_params = kb.container_images_prepare_multi(env, roles_data, True,
                                                          lock=mock_lock)
@@ -1396,7 +1440,7 @@ class TestPrepare(base.TestCase):
                 multi_arch=False,
                 lock=mock_lock
             )
-        ])
+        ], any_order=True)
 
         self.assertEqual(
             {
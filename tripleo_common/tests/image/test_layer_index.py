@@ -0,0 +1,101 @@
+#   Copyright 2020 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+import os
+import shutil
+import tempfile
+
+from tripleo_common.image import layer_index
+from tripleo_common.tests import base
+
+
+class TestLayerIndex(base.TestCase):
+
+    def setUp(self):
+        super(TestLayerIndex, self).setUp()
+        self.index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.index_dir)
+        self.path = os.path.join(self.index_dir,
+                                 layer_index.LAYER_INDEX_FILE)
+        self.index = layer_index.LayerIndex(self.path)
+
+    def test_load_missing(self):
+        self.assertEqual(({}, {}), self.index.load())
+
+    def test_add_layer(self):
+        self.index.add_layer('sha256:aaaa', 'local',
+                             path='/v2/t/nova-api/blobs/sha256:aaaa.gz',
+                             ref='t/nova-api', size=10)
+        self.index.add_layer('sha256:aaaa', 'remote',
+                             path='https://192.0.2.1/v2/t/nova-api:latest',
+                             ref='t/nova-api')
+        layers, manifests = self.index.load()
+        self.assertEqual({
+            'sha256:aaaa': {
+                'local': {
+                    'path': '/v2/t/nova-api/blobs/sha256:aaaa.gz',
+                    'ref': 't/nova-api',
+                    'size': 10
+                },
+                'remote': {
+                    'path': 'https://192.0.2.1/v2/t/nova-api:latest',
+                    'ref': 't/nova-api'
+                }
+            }
+        }, layers)
+        self.assertEqual({}, manifests)
+
+    def test_forget_layer(self):
+        self.index.add_layer('sha256:aaaa', 'local', path='/a', ref='t/a')
+        self.index.add_layer('sha256:bbbb', 'local', path='/b', ref='t/b')
+        self.index.forget_layer('sha256:aaaa')
+        layers, _ = self.index.load()
+        self.assertEqual(['sha256:bbbb'], list(layers))
+
+    def test_add_manifest(self):
+        self.index.add_manifest('sha256:1234', '192.0.2.1/t/nova-api:16',
+                                'sha256:5678')
+        self.index.add_manifest('sha256:1234', '192.0.2.1/t/nova-api:17',
+                                'sha256:5678')
+        self.index.add_manifest('sha256:1234', '192.0.2.1/t/nova-api:16',
+                                'sha256:9999')
+        _, manifests = self.index.load()
+        self.assertEqual({
+            'sha256:1234': {'192.0.2.1/t/nova-api:16': 'sha256:9999',
+                            '192.0.2.1/t/nova-api:17': 'sha256:5678'}
+        }, manifests)
+
+    def test_corrupt_record(self):
+        self.index.add_layer('sha256:aaaa', 'local', path='/a', ref='t/a')
+        with open(self.path, 'a') as f:
+            f.write('{"type": "lay')
+        layers, _ = self.index.load()
+        self.assertEqual(['sha256:aaaa'], list(layers))
+
+    def test_compact(self):
+        for i in range(5):
+            self.index.add_layer('sha256:aaaa', 'local', path='/a',
+                                 ref='t/a')
+        self.index.add_manifest('sha256:1234', '192.0.2.1/t/a:latest',
+                                'sha256:5678')
+        before = self.index.load()
+        with open(self.path) as f:
+            self.assertEqual(2, len(f.readlines()))
+        self.assertEqual(before, self.index.load())
+
+        # appends still land in the compacted file
+        self.index.add_layer('sha256:bbbb', 'local', path='/b', ref='t/b')
+        layers, _ = self.index.load()
+        self.assertEqual(['sha256:aaaa', 'sha256:bbbb'], sorted(layers))
@@ -0,0 +1,156 @@
+#   Copyright 2020 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+import base64
+import gzip
+import hashlib
+import io
+import json
+import mock
+import os
+import shutil
+import tarfile
+import tempfile
+import zlib
+
+from tripleo_common.image import tar_split
+from tripleo_common.tests import base
+
+
+def make_layer(root, files):
+    """Write a layer diff and the tar-split metadata of its tar
+
+    :returns: tuple of the tar data, tar-split path and diff path
+    """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w', format=tarfile.GNU_FORMAT) as t:
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                t.addfile(info)
+                continue
+            info.size = len(data)
+            t.addfile(info, io.BytesIO(data))
+    tar_data = buf.getvalue()
+
+    diff_path = os.path.join(root, 'diff')
+    buf.seek(0)
+    with tarfile.open(fileobj=buf) as t:
+        t.extractall(diff_path)
+        members = t.getmembers()
+
+    entries = []
+
+    def segment(data):
+        entries.append({
+            'type': tar_split.ENTRY_SEGMENT,
+            'payload': base64.b64encode(data).decode('ascii'),
+            'position': len(entries)
+        })
+
+    pos = 0
+    for m in members:
+        segment(tar_data[pos:m.offset_data])
+        entries.append({
+            'type': tar_split.ENTRY_FILE,
+            'name': m.name,
+            'size': m.size,
+            'payload': None,
+            'position': len(entries)
+        })
+        pos = m.offset_data + m.size
+    segment(tar_data[pos:])
+
+    tar_split_path = os.path.join(root, 'layer.tar-split.gz')
+    with gzip.open(tar_split_path, 'wb') as f:
+        for e in entries:
+            f.write(json.dumps(e).encode('utf-8') + b'\n')
+    return tar_data, tar_split_path, diff_path
+
+
+class TestTarSplit(base.TestCase):
+
+    def setUp(self):
+        super(TestTarSplit, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.tar_data, self.tar_split_path, self.diff_path = make_layer(
+            self.root, [
+                ('etc', None),
+                ('etc/hosts', b'127.0.0.1 localhost\n'),
+                ('etc/empty', b''),
+                ('usr/lib/big', b'x' * (tar_split.CHUNK_SIZE + 100)),
+            ])
+
+    def test_assemble(self):
+        self.assertEqual(
+            self.tar_data,
+            b''.join(tar_split.assemble(self.tar_split_path,
+                                        self.diff_path)))
+
+    def test_assemble_short_file(self):
+        with open(os.path.join(self.diff_path, 'etc', 'hosts'), 'wb') as f:
+            f.write(b'127')
+        self.assertRaises(
+            tar_split.TarSplitException, b''.join,
+            tar_split.assemble(self.tar_split_path, self.diff_path))
+
+    def test_assemble_outside_diff(self):
+        with gzip.open(self.tar_split_path, 'wb') as f:
+            f.write(json.dumps({
+                'type': tar_split.ENTRY_FILE,
+                'name': '../layer.tar-split.gz',
+                'size': 10,
+            }).encode('utf-8'))
+        self.assertRaises(
+            tar_split.TarSplitException, b''.join,
+            tar_split.assemble(self.tar_split_path, self.diff_path))
+
+    def test_compress(self):
+        compressed = list(tar_split.compress(iter([self.tar_data])))
+        self.assertEqual(
+            self.tar_data,
+            zlib.decompress(b''.join(compressed), 16 + zlib.MAX_WBITS))
+        self.assertEqual(
+            compressed, list(tar_split.compress(iter([self.tar_data]))))
+
+    def test_layer_cache(self):
+        cache = tar_split.LayerCache(os.path.join(self.root, 'cache'))
+        self.assertIsNone(cache.lookup('aaaa', self.tar_split_path))
+
+        entry = cache.get('aaaa', self.tar_split_path, self.diff_path)
+        with open(entry['path'], 'rb') as f:
+            data = f.read()
+        self.assertEqual(
+            'sha256:%s' % hashlib.sha256(data).hexdigest(), entry['digest'])
+        self.assertEqual(len(data), entry['size'])
+        self.assertEqual(
+            self.tar_data, zlib.decompress(data, 16 + zlib.MAX_WBITS))
+
+        # a cached layer is not assembled again
+        with mock.patch('tripleo_common.image.tar_split.assemble') as m:
+            self.assertEqual(entry, cache.get(
+                'aaaa', self.tar_split_path, self.diff_path))
+            self.assertEqual(entry, tar_split.LayerCache(cache.path).lookup(
+                'aaaa', self.tar_split_path))
+        m.assert_not_called()
+
+        # a replaced layer is
+        st = os.stat(self.tar_split_path)
+        os.utime(self.tar_split_path, (st.st_atime, st.st_mtime + 10))
+        self.assertIsNone(cache.lookup('aaaa', self.tar_split_path))
+        self.assertEqual(entry['digest'], cache.get(
+            'aaaa', self.tar_split_path, self.diff_path)['digest'])
@@ -0,0 +1,139 @@
+#   Copyright 2020 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+import mock
+import tenacity
+
+from tripleo_common.image import upload_metrics
+from tripleo_common.tests import base
+
+
+class TestUploadMetrics(base.TestCase):
+
+    def setUp(self):
+        super(TestUploadMetrics, self).setUp()
+        self.metrics = upload_metrics.UploadMetrics()
+
+    @mock.patch('time.time')
+    def test_summary(self, mock_time):
+        mock_time.return_value = 100.0
+        m = self.metrics
+        m.reset()
+        m.add_time('layer_check', 0.5)
+        m.add_time('layer_check', 1.5)
+        m.add_transfer('localhost:8787', 'push', 4096, 2.0)
+        m.add_transfer('localhost:8787', 'push', 4096, 2.0)
+        m.add_retry('_copy_layer_registry_to_registry')
+        m.add_dedup('layer', True)
+        m.add_dedup('layer', True)
+        m.add_dedup('layer', False)
+        mock_time.return_value = 110.0
+
+        self.assertEqual({
+            'wall_seconds': 10.0,
+            'phases': {
+                'layer_check': {
+                    'count': 2, 'seconds': 2.0, 'max_seconds': 1.5}
+            },
+            'transfers': {
+                'localhost:8787': {
+                    'push': {
+                        'bytes': 8192,
+                        'seconds': 4.0,
+                        'bytes_per_second': 2048
+                    }
+                }
+            },
+            'retries': {'_copy_layer_registry_to_registry': 1},
+            'dedup': {
+                'layer': {'hits': 2, 'misses': 1, 'hit_rate': 0.667}
+            },
+        }, m.summary())
+
+    def test_drain_merge(self):
+        worker = upload_metrics.UploadMetrics()
+        worker.add_time('upload_image', 3.0)
+        worker.add_transfer('docker.io', 'pull', 10, 1.0)
+        worker.add_retry('_fetch_manifest')
+        worker.add_dedup('manifest', False)
+        snapshot = worker.drain()
+        self.assertEqual({}, worker.snapshot()['phases'])
+
+        self.metrics.add_time('upload_image', 1.0)
+        self.metrics.add_retry('_fetch_manifest')
+        self.metrics.merge(snapshot)
+        self.metrics.merge(None)
+        self.assertEqual({
+            'phases': {'upload_image': [2, 4.0, 3.0]},
+            'transfers': {'docker.io|pull': [10, 1.0]},
+            'retries': {'_fetch_manifest': 2},
+            'dedup': {'manifest': [0, 1]},
+        }, self.metrics.snapshot())
+
+    def test_prometheus(self):
+        m = self.metrics
+        m.add_time('authenticate', 0.25)
+        m.add_transfer('docker.io', 'pull', 10, 1.0)
+        m.add_dedup('layer', True)
+        text = m.prometheus()
+        self.assertIn(
+            '# TYPE tripleo_image_upload_phase_seconds_total counter\n'
+            'tripleo_image_upload_phase_seconds_total'
+            '{phase="authenticate"} 0.25\n', text)
+        self.assertIn(
+            'tripleo_image_upload_transfer_bytes_total'
+            '{registry="docker.io",direction="pull"} 10\n', text)
+        self.assertIn(
+            'tripleo_image_upload_dedup_total'
+            '{kind="layer",result="hit"} 1\n', text)
+        self.assertIn(
+            'tripleo_image_upload_dedup_total'
+            '{kind="layer",result="miss"} 0\n', text)
+
+    @mock.patch('tripleo_common.image.upload_metrics.METRICS')
+    def test_count_retry(self, mock_metrics):
+        calls = []
+
+        @tenacity.retry(
+            before=upload_metrics.count_retry,
+            retry=tenacity.retry_if_exception_type(IOError),
+            wait=tenacity.wait_none(),
+            stop=tenacity.stop_after_attempt(3))
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise IOError()
+
+        flaky()
+        self.assertEqual(
+            [mock.call('flaky'), mock.call('flaky')],
+            mock_metrics.add_retry.mock_calls)
+
+    @mock.patch('tripleo_common.image.upload_metrics.METRICS')
+    def test_timed(self, mock_metrics):
+        @upload_metrics.timed('inspect')
+        def inspect(x):
+            return x
+
+        self.assertEqual(1, inspect(1))
+        mock_metrics.timer.assert_called_once_with('inspect')
+
+    @mock.patch('tripleo_common.image.upload_metrics.METRICS')
+    def test_count_stream(self, mock_metrics):
+        stream = upload_metrics.count_stream(
+            iter([b'abc', b'de']), 'localhost:8787', 'push')
+        self.assertEqual(b'abcde', b''.join(stream))
+        mock_metrics.add_transfer.assert_called_once_with(
+            'localhost:8787', 'push', 5, mock.ANY)
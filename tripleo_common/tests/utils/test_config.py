@@ -708,15 +708,8 @@ class TestConfig(base.TestCase):
         repo = self.config.initialize_git_repo(self.tmp_dir)
         self.assertIsInstance(repo, git.Repo)
 
-    @patch('tripleo_common.utils.config.Config.get_config_dict')
-    @patch('tripleo_common.utils.config.Config.get_deployment_data')
-    def test_write_config(self, mock_deployment_data, mock_config_dict):
-        heat = mock.MagicMock()
-        self.config = ooo_config.Config(heat)
-        stack = mock.MagicMock()
-        heat.stacks.get.return_value = stack
-
-        stack.outputs = [
+    def _write_config_outputs(self):
+        return [
             {'output_key': 'RoleNetHostnameMap',
              'output_value': {
                  'Controller': {
@@ -755,7 +748,17 @@ class TestConfig(base.TestCase):
                      'max_fail_percentage': 15}}},
             {'output_key': 'HostnameNetworkConfigMap',
              'output_value': {}}
-            ]
+        ]
+
+    @patch('tripleo_common.utils.config.Config.get_config_dict')
+    @patch('tripleo_common.utils.config.Config.get_deployment_data')
+    def test_write_config(self, mock_deployment_data, mock_config_dict):
+        heat = mock.MagicMock()
+        self.config = ooo_config.Config(heat)
+        stack = mock.MagicMock()
+        heat.stacks.get.return_value = stack
+
+        stack.outputs = self._write_config_outputs()
         deployment_data, configs = \
             self._get_config_data('config_data.yaml')
         self.configs = configs
@@ -823,6 +826,61 @@ class TestConfig(base.TestCase):
                         'overcloud-novacompute-2',
                         d)))
 
+    @patch('tripleo_common.utils.config.Config.get_config_dict')
+    @patch('tripleo_common.utils.config.Config.get_deployment_data')
+    def test_write_config_workers(self, mock_deployment_data,
+                                  mock_config_dict):
+        deployment_data, configs = \
+            self._get_config_data('config_data.yaml')
+        self.configs = configs
+        self.deployments = deployment_data
+        mock_deployment_data.return_value = deployment_data
+        mock_config_dict.side_effect = self._get_config_dict
+
+        def write_config(workers):
+            heat = mock.MagicMock()
+            heat.stacks.get.return_value.outputs = \
+                self._write_config_outputs()
+            config = ooo_config.Config(heat, workers=workers)
+            stack_data = config.fetch_config('overcloud')
+            config_dir = self.useFixture(fixtures.TempDir()).path
+            config.write_config(stack_data, 'overcloud', config_dir)
+            files = {}
+            for root, dirs, fnames in os.walk(config_dir):
+                for fname in fnames:
+                    path = os.path.join(root, fname)
+                    with open(path) as f:
+                        files[os.path.relpath(path, config_dir)] = f.read()
+            return files
+
+        serial = write_config(1)
+        self.assertIn(os.path.join('Compute', 'overcloud-novacompute-2',
+                                   'AnsibleDeployment'), serial)
+        self.assertEqual(serial, write_config(4))
+
+    def test_get_grandparent_resource_name(self):
+        heat = mock.MagicMock()
+        heat.stacks.get.return_value.parent = 'grandparent'
+        heat.resources.list.return_value = [
+            mock.MagicMock(resource_name='MyDeployment')]
+        self.config = ooo_config.Config(heat, workers=4)
+
+        with self.config._executor() as p:
+            names = list(p.map(self.config.get_grandparent_resource_name,
+                               ['parent'] * 10))
+        self.assertEqual(['MyDeployment'] * 10, names)
+        heat.stacks.get.assert_called_once_with('parent',
+                                                resolve_outputs=False)
+        heat.resources.list.assert_called_once_with(
+            'grandparent', filters=dict(physical_resource_id='parent'))
+
+        heat.resources.list.return_value = []
+        self.assertRaises(ValueError,
+                          self.config.get_grandparent_resource_name, 'other')
+        self.assertRaises(ValueError,
+                          self.config.get_grandparent_resource_name, 'other')
+        self.assertEqual(2, heat.resources.list.call_count)
+
     @patch('tripleo_common.utils.config.Config.get_config_dict')
     @patch('tripleo_common.utils.config.Config.get_deployment_data')
     @patch.object(ooo_config.yaml, 'safe_load')
@@ -884,11 +942,11 @@ class TestConfig(base.TestCase):
         config_dir = '/tmp/tht'
         self.config.render_network_config(stack, config_dir, server_roles)
 
-    @patch.object(ooo_config.Config, '_open_file')
+    @patch.object(ooo_config.Config, '_write_file')
     @patch('tripleo_common.utils.config.Config.get_network_config_data')
     def test_render_network_config(self,
                                    mock_get_network_config_data,
-                                   mock_open):
+                                   mock_write):
         heat = mock.MagicMock()
         heat.stacks.get.return_value = fakes.create_tht_stack()
         config_mock = mock.MagicMock()
@@ -902,11 +960,62 @@ class TestConfig(base.TestCase):
                                                          node2='config')
         config_dir = '/tmp/tht'
         self.config.render_network_config(stack, config_dir, server_roles)
-        self.assertEqual(2, mock_open.call_count)
-        self.assertEqual('/tmp/tht/Controller/node1/NetworkConfig',
-                         mock_open.call_args_list[0][0][0])
-        self.assertEqual('/tmp/tht/Controller/NetworkConfig',
-                         mock_open.call_args_list[1][0][0])
+        self.assertEqual([
+            mock.call('/tmp/tht/Controller/node1/NetworkConfig',
+                      'some config', 0o600),
+            mock.call('/tmp/tht/Controller/NetworkConfig',
+                      'some config', 0o600),
+        ], mock_write.call_args_list)
+
+    def test_get_config_dict_cached(self):
+        heat = mock.MagicMock()
+        heat.software_deployments.get.side_effect = \
+            lambda d: mock.MagicMock(config_id='config-%s' % d[-1])
+        heat.software_configs.get.side_effect = \
+            lambda c: mock.MagicMock(to_dict=lambda: {'id': c})
+        self.config = ooo_config.Config(heat)
+
+        self.assertEqual([{'id': 'config-1'}, {'id': 'config-1'},
+                          {'id': 'config-2'}],
+                         [self.config.get_config_dict(d)
+                          for d in ('dep-a-1', 'dep-b-1', 'dep-c-2')])
+        self.assertEqual(3, heat.software_deployments.get.call_count)
+        self.assertEqual([mock.call('config-1'), mock.call('config-2')],
+                         heat.software_configs.get.call_args_list)
+
+    def test_render_network_config_shared(self):
+        heat = mock.MagicMock()
+        heat.software_configs.get.return_value.config = 'some config'
+        self.config = ooo_config.Config(heat)
+        config_dir = self.useFixture(fixtures.TempDir()).path
+        server_roles = dict(node1='Compute', node2='Compute')
+        self.config.stack_outputs['HostnameNetworkConfigMap'] = dict(
+            node1='config', node2='config')
+
+        self.config.render_network_config(mock.Mock(), config_dir,
+                                          server_roles)
+        # one software config fetch and one file for every server and role
+        heat.software_configs.get.assert_called_once_with('config')
+        paths = [os.path.join(config_dir, 'Compute', p, 'NetworkConfig')
+                 for p in ('node1', 'node2', '')]
+        for path in paths:
+            with open(path) as f:
+                self.assertEqual('some config', f.read())
+            self.assertEqual(os.stat(paths[0]).st_ino, os.stat(path).st_ino)
+            self.assertEqual(0o600, os.stat(path).st_mode & 0o777)
+        self.assertEqual(['NetworkConfig', 'node1', 'node2'],
+                         sorted(os.listdir(os.path.join(config_dir,
+                                                        'Compute'))))
+
+        # files are replaced, not written through their links
+        self.config._write_file(paths[0], 'new config', 0o600)
+        with open(paths[1]) as f:
+            self.assertEqual('some config', f.read())
+        self.config._write_file(paths[1], 'some config', 0o600)
+        self.config._write_file(paths[2], 'some config', 0o600)
+        self.assertEqual(os.stat(paths[1]).st_ino, os.stat(paths[2]).st_ino)
+        self.assertNotEqual(os.stat(paths[0]).st_ino,
+                            os.stat(paths[1]).st_ino)
 
     @patch.object(ooo_config.Config, '_open_file')
     def test_overcloud_config__write_tasks_per_step(self, mock_open_file):
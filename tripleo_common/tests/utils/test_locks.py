@@ -0,0 +1,113 @@
+#   Copyright 2020 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+import errno
+import threading
+
+import mock
+
+from tripleo_common.tests import base
+from tripleo_common.utils.locks import processlock
+from tripleo_common.utils.locks import threadinglock
+
+
+class TestThreadingLock(base.TestCase):
+
+    def get_lock(self):
+        return threadinglock.ThreadingLock()
+
+    def test_hold_release(self):
+        lock = self.get_lock()
+        lock.hold_object('sha256:aaaa')
+        # holding twice from the same thread does not block
+        lock.hold_object('sha256:aaaa')
+        lock.hold_object('sha256:bbbb')
+        self.assertIn('sha256:aaaa', lock.objects())
+        lock.release_object('sha256:aaaa')
+        self.assertNotIn('sha256:aaaa', lock.objects())
+        self.assertIn('sha256:bbbb', lock.objects())
+        # releasing an object which is not held does nothing
+        lock.release_object('sha256:aaaa')
+        lock.release_object('sha256:bbbb')
+        self.assertEqual({}, dict(lock.objects()))
+
+    def test_hold_wait(self):
+        lock = self.get_lock()
+        lock.hold_object('sha256:aaaa')
+        events = []
+        held = threading.Event()
+
+        def hold():
+            # a thread which does not hold the object cannot release it
+            lock.release_object('sha256:aaaa')
+            events.append('waiting')
+            lock.hold_object('sha256:aaaa')
+            events.append('held')
+            held.set()
+            lock.release_object('sha256:aaaa')
+
+        t = threading.Thread(target=hold)
+        t.start()
+        self.assertFalse(held.wait(0.2))
+        self.assertEqual(['waiting'], events)
+        events.append('released')
+        lock.release_object('sha256:aaaa')
+        self.assertTrue(held.wait(5))
+        t.join()
+        self.assertEqual(['waiting', 'released', 'held'], events)
+        self.assertNotIn('sha256:aaaa', lock.objects())
+
+    def test_hold_exited_thread(self):
+        lock = self.get_lock()
+        t = threading.Thread(target=lock.hold_object, args=('sha256:aaaa',))
+        t.start()
+        t.join()
+        # the thread exited without releasing, so the object is taken over
+        lock.hold_object('sha256:aaaa')
+        self.assertEqual(lock._holder(), lock.objects()['sha256:aaaa'])
+        lock.release_object('sha256:aaaa')
+        self.assertNotIn('sha256:aaaa', lock.objects())
+
+    @mock.patch('os.kill')
+    def test_hold_exited_process(self, mock_kill):
+        lock = self.get_lock()
+        lock.objects()['sha256:aaaa'] = '999999:1'
+        mock_kill.side_effect = OSError(errno.ESRCH, 'No such process')
+        lock.hold_object('sha256:aaaa')
+        mock_kill.assert_called_once_with(999999, 0)
+        self.assertEqual(lock._holder(), lock.objects()['sha256:aaaa'])
+
+    @mock.patch('tripleo_common.utils.locks.base.HOLD_CHECK_INTERVAL', 0.1)
+    def test_hold_live_process(self):
+        lock = self.get_lock()
+        lock.objects()['sha256:aaaa'] = '999999:1'
+        calls = []
+
+        def kill(pid, sig):
+            calls.append(pid)
+            if len(calls) > 2:
+                raise OSError(errno.ESRCH, 'No such process')
+
+        with mock.patch('os.kill', side_effect=kill):
+            lock.hold_object('sha256:aaaa')
+        # the holder was checked again after each timed wait
+        self.assertEqual([999999, 999999, 999999], calls)
+        self.assertEqual(lock._holder(), lock.objects()['sha256:aaaa'])
+
+
+class TestProcessLock(TestThreadingLock):
+
+    def get_lock(self):
+        return processlock.ProcessLock()
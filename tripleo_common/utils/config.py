@@ -13,12 +13,16 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from concurrent import futures
+import hashlib
 import json
 import logging
 import os
 import re
 import shutil
 import six
+import threading
+import uuid
 import warnings
 import yaml
 
@@ -30,12 +34,105 @@ from tripleo_common.utils.safe_import import git
 warnings.filterwarnings('once')
 
 
+class _SerialExecutor(object):
+    """Executor running every call when it is submitted"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def submit(self, fn, *args, **kwargs):
+        future = futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def map(self, fn, *iterables):
+        return six.moves.map(fn, *iterables)
+
+
 class Config(object):
 
-    def __init__(self, orchestration_client):
+    def __init__(self, orchestration_client, workers=1):
+        """Config-download writer
+
+        :param orchestration_client: heat client
+        :param workers: number of software configs fetched, and of
+            deployment files rendered, at the same time. With 1, everything
+            is done in the calling thread.
+        """
         self.log = logging.getLogger(__name__ + ".Config")
         self.client = orchestration_client
         self.stack_outputs = {}
+        self.workers = workers
+        self._lock = threading.Lock()
+        # Grandparent resource name of parent stacks, as futures
+        self._grandparent_names = {}
+        # Software configs by id, as futures. Heat never updates a software
+        # config, so they are kept for the life of the object.
+        self._software_configs = {}
+        # Path of the first file written with a given content and mode,
+        # and the reverse mapping
+        self._written_files = {}
+        self._file_keys = {}
+
+    def _executor(self):
+        if self.workers > 1:
+            return futures.ThreadPoolExecutor(max_workers=self.workers)
+        return _SerialExecutor()
+
+    def _memoize(self, cache, key, fn, *args):
+        """Return fn(*args), called once per key of cache by all threads"""
+        with self._lock:
+            future = cache.get(key)
+            call = future is None
+            if call:
+                future = futures.Future()
+                cache[key] = future
+        if call:
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    def _write_file(self, path, data, mode=0o666):
+        """Write a file, hard linked to a file written with the same data
+
+        The file is replaced with a rename, so an existing file, and the
+        other links to it, are never written through.
+        """
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        key = (hashlib.sha256(data).hexdigest(), mode)
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        with self._lock:
+            source = self._written_files.get(key)
+        try:
+            os.link(source, tmp_path)
+        except (OSError, TypeError):
+            source = None
+        try:
+            if not source:
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                             mode)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+            os.rename(tmp_path, path)
+        finally:
+            # left in place by rename if path is already a link to source
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self._lock:
+            old_key = self._file_keys.get(path)
+            if old_key != key and self._written_files.get(old_key) == path:
+                del self._written_files[old_key]
+            self._written_files.setdefault(key, path)
+            self._file_keys[path] = key
 
     def get_server_names(self):
         servers = {}
@@ -88,14 +185,110 @@ class Config(object):
                 deployment.attributes['value']['deployment']
         return deployment_resource_id
 
+    def get_software_config(self, config_id):
+        """Return a software config, fetched once per config id"""
+        return self._memoize(self._software_configs, config_id,
+                             self.client.software_configs.get, config_id)
+
     def get_config_dict(self, deployment_resource_id):
         deployment_rsrc = self.client.software_deployments.get(
             deployment_resource_id)
-        config = self.client.software_configs.get(
-            deployment_rsrc.config_id)
+        config = self.get_software_config(deployment_rsrc.config_id)
 
         return config.to_dict()
 
+    def get_grandparent_resource_name(self, parent_stack):
+        """Return the name of the resource of a stack in its parent stack
+
+        Lookups are memoized per stack, as every deployment of a nested
+        stack has the same grandparent.
+        """
+        return self._memoize(self._grandparent_names, parent_stack,
+                             self._get_grandparent_resource_name,
+                             parent_stack)
+
+    def _get_grandparent_resource_name(self, parent_stack):
+        grandparent_stack = self.client.stacks.get(
+            parent_stack, resolve_outputs=False).parent
+        resources = self.client.resources.list(
+            grandparent_stack,
+            filters=dict(physical_resource_id=parent_stack))
+        if not resources:
+            message = "The deployment resource grandparent name" \
+                      "could not be determined."
+            raise ValueError(message)
+        return resources[0].resource_name
+
+    def get_deployment_config(self, deployment):
+        """Return the config dict of a deployment with its name
+
+        :returns: the config dict, or None if the deployment has no
+            physical resource to get the config from
+        """
+        # Check if the deployment value is the resource name. If that's the
+        # case, Heat did not create a physical_resource_id for this
+        # deployment since it does not trigger on this stack action. Such
+        # as a deployment that only triggers on DELETE, but this is a stack
+        # create. If that's the case, just skip this deployment, otherwise
+        # it will result in a Not found error if we try and query the
+        # deployment API for this deployment.
+        dep_value_resource_name = deployment.attributes[
+            'value'].get('deployment') == 'TripleOSoftwareDeployment'
+
+        # if not check the physical_resource_id
+        if not dep_value_resource_name:
+            deployment_resource_id = self.get_deployment_resource_id(
+                deployment)
+
+        if dep_value_resource_name or not deployment_resource_id:
+            warnings.warn('Skipping deployment %s because it has no '
+                          'valid uuid (physical_resource_id) '
+                          'associated.' %
+                          deployment.physical_resource_id)
+            return None
+
+        config_dict = self.get_config_dict(deployment_resource_id)
+
+        # deployment_name should be set via the name property on the
+        # Deployment resources in the templates, however, if it's None
+        # or empty string, default to the name of the parent_resource.
+        deployment_name = deployment.attributes['value'].get(
+            'name') or deployment.parent_resource
+        if not deployment_name:
+            message = "The deployment name cannot be determined. It " \
+                      "should be set via the name property on the " \
+                      "Deployment resources in the templates."
+            raise ValueError(message)
+
+        try:
+            int(deployment_name)
+        except ValueError:
+            pass
+        else:
+            # We can't have an integer here, let's figure out the
+            # grandparent resource name
+            deployment_ref = deployment.attributes['value']['deployment']
+            warnings.warn('Determining grandparent resource name for '
+                          'deployment %s. Ensure the name property is '
+                          'set on the deployment resource in the '
+                          'templates.' % deployment_ref)
+
+            if '/' in deployment_ref:
+                deployment_stack_id = deployment_ref.split('/')[-1]
+            else:
+                for link in deployment.links:
+                    if link['rel'] == 'stack':
+                        deployment_stack_id = link['href'].split('/')[-1]
+                        break
+                else:
+                    raise ValueError("Couldn't not find parent stack")
+            deployment_stack = self.client.stacks.get(
+                deployment_stack_id, resolve_outputs=False)
+            deployment_name = self.get_grandparent_resource_name(
+                deployment_stack.parent)
+        config_dict['deployment_name'] = deployment_name
+        return config_dict
+
     def get_jinja_env(self, tmp_path):
         templates_path = os.path.join(
             os.path.dirname(__file__), '..', 'templates')
@@ -228,16 +421,54 @@ class Config(object):
                     server_deployment_dir, "NetworkConfig")
                 network_config_role_path = os.path.join(
                     config_dir, server_roles[server], "NetworkConfig")
-                s_config = self.client.software_configs.get(config)
+                s_config = self.get_software_config(config)
                 if getattr(s_config, 'config', ''):
-                    with self._open_file(network_config_path) as f:
-                        f.write(s_config.config)
-                    with self._open_file(network_config_role_path) as f:
-                        f.write(s_config.config)
+                    self._write_file(network_config_path, s_config.config,
+                                     0o600)
+                    self._write_file(network_config_role_path,
+                                     s_config.config, 0o600)
             else:
                 self.log.warning('Server with id %s is ignored from config '
                                  '(Possibly blacklisted)' % server)
 
+    def _write_deployment(self, deployment_template, d, deployment_path,
+                          server_id):
+        # See if the config can be loaded as a JSON data structure
+        # In some cases, it may already be JSON (hiera), or it may just
+        # be a string (script). In those cases, just use the value
+        # as-is.
+        try:
+            data = json.loads(d['config'])
+        except Exception:
+            data = d['config']
+
+        # If the value is not a string already, pretty print it as a
+        # string so it's rendered in a readable format.
+        if not (isinstance(data, six.text_type) or
+                isinstance(data, six.string_types)):
+            data = json.dumps(data, indent=2)
+
+        d['config'] = data
+
+        # The hiera Heat hook expects an actual dict for the config
+        # value, not a scalar. All other hooks expect a scalar.
+        if d['group'] == 'hiera':
+            d['scalar'] = False
+        else:
+            d['scalar'] = True
+
+        if d['group'] == 'os-apply-config':
+            message = ("group:os-apply-config is deprecated. "
+                       "Deployment %s will not be applied by "
+                       "config-download." % d['deployment_name'])
+            warnings.warn(message, DeprecationWarning)
+
+        template_data = deployment_template.render(
+            deployment=d,
+            server_id=server_id)
+        self.validate_config(template_data, deployment_path)
+        self._write_file(deployment_path, template_data)
+
     def write_config(self, stack, name, config_dir, config_type=None):
         # Get role data:
         role_data = self.stack_outputs.get('RoleData', {})
@@ -329,135 +560,8 @@ class Config(object):
         # lookup
         server_roles = {}
 
-        for deployment in deployments_data:
-            # Check if the deployment value is the resource name. If that's the
-            # case, Heat did not create a physical_resource_id for this
-            # deployment since it does not trigger on this stack action. Such
-            # as a deployment that only triggers on DELETE, but this is a stack
-            # create. If that's the case, just skip this deployment, otherwise
-            # it will result in a Not found error if we try and query the
-            # deployment API for this deployment.
-            dep_value_resource_name = deployment.attributes[
-                'value'].get('deployment') == 'TripleOSoftwareDeployment'
-
-            # if not check the physical_resource_id
-            if not dep_value_resource_name:
-                deployment_resource_id = self.get_deployment_resource_id(
-                    deployment)
-
-            if dep_value_resource_name or not deployment_resource_id:
-                warnings.warn('Skipping deployment %s because it has no '
-                              'valid uuid (physical_resource_id) '
-                              'associated.' %
-                              deployment.physical_resource_id)
-                continue
-
-            server_id = deployment.attributes['value']['server']
-            config_dict = self.get_config_dict(deployment_resource_id)
-
-            # deployment_name should be set via the name property on the
-            # Deployment resources in the templates, however, if it's None
-            # or empty string, default to the name of the parent_resource.
-            deployment_name = deployment.attributes['value'].get(
-                'name') or deployment.parent_resource
-            if not deployment_name:
-                message = "The deployment name cannot be determined. It " \
-                          "should be set via the name property on the " \
-                          "Deployment resources in the templates."
-                raise ValueError(message)
-
-            try:
-                int(deployment_name)
-            except ValueError:
-                pass
-            else:
-                # We can't have an integer here, let's figure out the
-                # grandparent resource name
-                deployment_ref = deployment.attributes['value']['deployment']
-                warnings.warn('Determining grandparent resource name for '
-                              'deployment %s. Ensure the name property is '
-                              'set on the deployment resource in the '
-                              'templates.' % deployment_ref)
-
-                if '/' in deployment_ref:
-                    deployment_stack_id = deployment_ref.split('/')[-1]
-                else:
-                    for link in deployment.links:
-                        if link['rel'] == 'stack':
-                            deployment_stack_id = link['href'].split('/')[-1]
-                            break
-                    else:
-                        raise ValueError("Couldn't not find parent stack")
-                deployment_stack = self.client.stacks.get(
-                    deployment_stack_id, resolve_outputs=False)
-                parent_stack = deployment_stack.parent
-                grandparent_stack = self.client.stacks.get(
-                    parent_stack, resolve_outputs=False).parent
-                resources = self.client.resources.list(
-                    grandparent_stack,
-                    filters=dict(physical_resource_id=parent_stack))
-                if not resources:
-                    message = "The deployment resource grandparent name" \
-                              "could not be determined."
-                    raise ValueError(message)
-                deployment_name = resources[0].resource_name
-            config_dict['deployment_name'] = deployment_name
-
-            # reset deploy_server_id to the actual server_id since we have to
-            # use a dummy server resource to create the deployment in the
-            # templates
-            deploy_server_id_input = \
-                [i for i in config_dict['inputs']
-                 if i['name'] == 'deploy_server_id'].pop()
-            deploy_server_id_input['value'] = server_id
-
-            # We don't want to fail if server_id can't be found, as it's
-            # most probably due to blacklisted nodes. However we fail for
-            # other errors.
-            try:
-                server_deployments.setdefault(
-                    server_names[server_id],
-                    []).append(config_dict)
-            except KeyError:
-                self.log.warning('Server with id %s is ignored from config '
-                                 '(may be blacklisted)' % server_id)
-                # continue the loop as this server_id is probably excluded
-                continue
-            except Exception as err:
-                err_msg = ('Error retrieving server name from this server_id: '
-                           '%s with this error: %s' % server_id, err)
-                raise Exception(err_msg)
-
-            role = self.get_role_from_server_id(stack, server_id)
-            server_pre_deployments = server_deployment_names.setdefault(
-                server_names[server_id], {}).setdefault(
-                'pre_deployments', [])
-            server_post_deployments = server_deployment_names.setdefault(
-                server_names[server_id], {}).setdefault(
-                'post_deployments', [])
-
-            server_roles[server_names[server_id]] = role
-
-            # special handling of deployments that are run post the deploy
-            # steps. We have to look these up based on the
-            # physical_resource_id, but these names should be consistent since
-            # they are consistent interfaces in our templates.
-            if 'ExtraConfigPost' in deployment.physical_resource_id or \
-                    'PostConfig' in deployment.physical_resource_id:
-                if deployment_name not in server_post_deployments:
-                    server_post_deployments.append(deployment_name)
-            else:
-                if deployment_name not in server_pre_deployments:
-                    server_pre_deployments.append(deployment_name)
-
-        # Make sure server_roles is populated b/c it won't be if there are no
-        # server deployments.
-        for name, server_id in server_ids.items():
-            server_roles.setdefault(
-                name,
-                self.get_role_from_server_id(stack, server_id))
-
         env, templates_path = self.get_jinja_env(config_dir)
+        deployment_template = env.get_template('deployment.j2')
 
         templates_dest = os.path.join(config_dir, 'templates')
         self._mkdir(templates_dest)
@@ -470,53 +574,95 @@ class Config(object):
         host_vars_dir = os.path.join(config_dir, 'host_vars')
         self._mkdir(host_vars_dir)
 
-        for server, deployments in server_deployments.items():
-            deployment_template = env.get_template('deployment.j2')
-
-            for d in deployments:
+        # Software configs are fetched by one pool, in the order of the
+        # deployments, while the deployment files are written by another.
+        self._grandparent_names = {}
+        self._written_files = {}
+        self._file_keys = {}
+        with self._executor() as fetch_pool, \
+                self._executor() as render_pool:
+            # deployment path to the future of its rendering
+            renders = {}
+            deployment_configs = fetch_pool.map(self.get_deployment_config,
+                                                deployments_data)
+            for deployment, config_dict in six.moves.zip(
+                    deployments_data, deployment_configs):
+                if config_dict is None:
+                    continue
+                server_id = deployment.attributes['value']['server']
+                deployment_name = config_dict['deployment_name']
+
+                # reset deploy_server_id to the actual server_id since we
+                # have to use a dummy server resource to create the
+                # deployment in the templates
+                deploy_server_id_input = \
+                    [i for i in config_dict['inputs']
+                     if i['name'] == 'deploy_server_id'].pop()
+                deploy_server_id_input['value'] = server_id
+
+                # We don't want to fail if server_id can't be found, as it's
+                # most probably due to blacklisted nodes. However we fail for
+                # other errors.
+                try:
+                    server_deployments.setdefault(
+                        server_names[server_id],
+                        []).append(config_dict)
+                except KeyError:
+                    self.log.warning('Server with id %s is ignored from '
+                                     'config (may be blacklisted)'
+                                     % server_id)
+                    # continue the loop as this server_id is probably
+                    # excluded
+                    continue
+                except Exception as err:
+                    err_msg = ('Error retrieving server name from this '
+                               'server_id: %s with this error: %s'
+                               % server_id, err)
+                    raise Exception(err_msg)
+
+                server = server_names[server_id]
+                role = self.get_role_from_server_id(stack, server_id)
+                server_pre_deployments = server_deployment_names.setdefault(
+                    server, {}).setdefault('pre_deployments', [])
+                server_post_deployments = server_deployment_names.setdefault(
+                    server, {}).setdefault('post_deployments', [])
+
+                server_roles[server] = role
+
+                # special handling of deployments that are run post the
+                # deploy steps. We have to look these up based on the
+                # physical_resource_id, but these names should be consistent
+                # since they are consistent interfaces in our templates.
+                if 'ExtraConfigPost' in deployment.physical_resource_id or \
+                        'PostConfig' in deployment.physical_resource_id:
+                    if deployment_name not in server_post_deployments:
+                        server_post_deployments.append(deployment_name)
+                else:
+                    if deployment_name not in server_pre_deployments:
+                        server_pre_deployments.append(deployment_name)
 
                 server_deployment_dir = os.path.join(
-                    config_dir, server_roles[server], server)
+                    config_dir, role, server)
                 self._mkdir(server_deployment_dir)
                 deployment_path = os.path.join(
-                    server_deployment_dir, d['deployment_name'])
+                    server_deployment_dir, deployment_name)
+                # a deployment with the same name is written over the
+                # previous one, not at the same time
+                if deployment_path in renders:
+                    renders[deployment_path].result()
+                renders[deployment_path] = render_pool.submit(
+                    self._write_deployment, deployment_template,
+                    config_dict, deployment_path, server_ids[server])
+
+            for render in renders.values():
+                render.result()
 
-                # See if the config can be loaded as a JSON data structure
-                # In some cases, it may already be JSON (hiera), or it may just
-                # be a string (script). In those cases, just use the value
-                # as-is.
-                try:
-                    data = json.loads(d['config'])
-                except Exception:
-                    data = d['config']
-
-                # If the value is not a string already, pretty print it as a
-                # string so it's rendered in a readable format.
-                if not (isinstance(data, six.text_type) or
-                        isinstance(data, six.string_types)):
-                    data = json.dumps(data, indent=2)
-
-                d['config'] = data
-
-                # The hiera Heat hook expects an actual dict for the config
-                # value, not a scalar. All other hooks expect a scalar.
-                if d['group'] == 'hiera':
-                    d['scalar'] = False
-                else:
-                    d['scalar'] = True
-
-                if d['group'] == 'os-apply-config':
-                    message = ("group:os-apply-config is deprecated. "
-                               "Deployment %s will not be applied by "
-                               "config-download." % d['deployment_name'])
-                    warnings.warn(message, DeprecationWarning)
-
-                with open(deployment_path, 'wb') as f:
-                    template_data = deployment_template.render(
-                        deployment=d,
-                        server_id=server_ids[server])
-                    self.validate_config(template_data, deployment_path)
-                    f.write(template_data.encode('utf-8'))
+        # Make sure server_roles is populated b/c it won't be if there are no
+        # server deployments.
+        for name, server_id in server_ids.items():
+            server_roles.setdefault(
+                name,
+                self.get_role_from_server_id(stack, server_id))
 
         # Render group_vars
         for role in set(server_roles.values()):
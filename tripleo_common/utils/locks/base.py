@@ -12,10 +12,84 @@
 #   License for the specific language governing permissions and limitations
 #   under the License.
 
+import errno
+import logging
+import os
+import threading
+import zlib
+
+LOG = logging.getLogger(__name__)
+
+# Number of condition variables shared by the held objects of a lock
+STRIPES = 64
+
+# Seconds a waiter sleeps before checking that the holder is still alive
+HOLD_CHECK_INTERVAL = 10
+
 
 class BaseLock(object):
+    """Global lock, with a table of held objects
+
+    Subclasses set _lock, a dict of held object to holder in _objects and
+    a list of condition variables in _stripes. Every object is guarded by
+    one condition, picked by a hash of the object, so holding, checking and
+    releasing an object costs the same however many objects are held.
+    """
+
     def get_lock(self):
         return self._lock
 
     def objects(self):
         return self._objects
+
+    def _stripe(self, obj):
+        key = zlib.crc32(obj.encode('utf-8')) & 0xffffffff
+        return self._stripes[key % len(self._stripes)]
+
+    @staticmethod
+    def _holder():
+        return '%i:%i' % (os.getpid(), threading.current_thread().ident)
+
+    @staticmethod
+    def _holder_alive(holder):
+        pid, ident = [int(i) for i in holder.split(':')]
+        if pid == os.getpid():
+            return any(t.ident == ident for t in threading.enumerate())
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno != errno.ESRCH
+        return True
+
+    def hold_object(self, obj):
+        """Wait until no other thread or process holds obj, then hold it
+
+        An object left held by a thread or process which has since exited
+        is taken over, so its waiters do not wait forever.
+
+        :param obj: string, such as a layer digest
+        """
+        holder = self._holder()
+        stripe = self._stripe(obj)
+        with stripe:
+            while True:
+                current = self._objects.get(obj)
+                if current in (None, holder):
+                    break
+                if not self._holder_alive(current):
+                    LOG.warning('Taking over %s from exited holder %s' %
+                                (obj, current))
+                    break
+                stripe.wait(HOLD_CHECK_INTERVAL)
+            self._objects[obj] = holder
+
+    def release_object(self, obj):
+        """Release obj if held by this thread, and wake up its waiters
+
+        :param obj: string, such as a layer digest
+        """
+        stripe = self._stripe(obj)
+        with stripe:
+            if self._objects.get(obj) == self._holder():
+                del self._objects[obj]
+                stripe.notify_all()
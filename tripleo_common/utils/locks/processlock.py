@@ -24,7 +24,10 @@ class ProcessLock(base.BaseLock):
     # the manager cannot live in __init__
     _mgr = multiprocessing.Manager()
     _global_view = _mgr.dict()
+    _token_cache = _mgr.dict()
 
     def __init__(self):
         self._lock = self._mgr.Lock()
-        self._objects = self._mgr.list()
+        self._objects = self._mgr.dict()
+        self._stripes = [self._mgr.Condition()
+                         for i in range(base.STRIPES)]
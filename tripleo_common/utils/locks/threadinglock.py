@@ -19,4 +19,6 @@ import threading
 class ThreadingLock(base.BaseLock):
     def __init__(self):
         self._lock = threading.Lock()
-        self._objects = []
+        self._objects = {}
+        self._stripes = [threading.Condition()
+                         for i in range(base.STRIPES)]